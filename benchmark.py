@@ -0,0 +1,787 @@
+# =============================================================================
+# BENCHMARK FOR construct_ai.py
+# =============================================================================
+# Runs the summarization pipeline against a local stand-in for the Ollama
+# server, so pipeline changes can be measured without a GPU or the real model.
+# The stand-in serves /api/tags, /api/show, /api/generate (model load only)
+# and streaming /api/chat with a
+# configurable time-to-first-token, prefill and generation speed, a limited
+# number of parallel slots, a per-slot prompt (prefix) cache and injected
+# failures.
+#
+# Example:
+#   python benchmark.py --tokens-per-sec 40 --ttft 0.5 --server-parallel 2 \
+#       --llm-concurrency 2 --failure-rate 0.05
+#
+# --servers N starts N stand-ins and spreads the work over them through the
+# endpoint pool (BASE_URL plus OLLAMA_ENDPOINTS).
+#
+# Results are printed and saved as JSON (see --output); pass --compare with an
+# earlier results file to print the change in the headline metrics.
+
+import os
+import re
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+from datetime import datetime
+from dataclasses import dataclass, field, asdict, replace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional, Dict, Any, Callable, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import construct_ai
+
+# =============================================================================
+# BENCHMARK CONFIGURATION
+# =============================================================================
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Folders with real PDFs that ship with the repository
+BUNDLED_FOLDERS = ["AI Ethics", "Finance"]
+
+# Approximate sizes (in tokens) of the generated documents; together they
+# cover the single-pass, incremental and tree strategies
+SYNTHETIC_DOC_TOKENS = [3000, 12000, 30000, 80000]
+
+SCENARIOS = ["extraction", "summarize", "synthetic", "bundled"]
+
+DEFAULT_RESULTS_DIR = "benchmark_results"
+
+# How often the resident set size is sampled while a scenario runs
+RSS_SAMPLE_INTERVAL = 0.05
+
+# =============================================================================
+# FAKE OLLAMA SERVER
+# =============================================================================
+@dataclass
+class FakeServerConfig:
+    model_name: str = construct_ai.MODEL_NAME
+    context_length: int = 131072
+    # Fixed delay before the first token, on top of the simulated prefill
+    ttft: float = 0.05
+    # Prompt tokens evaluated per second; 0 makes prefill instant
+    prefill_tokens_per_sec: float = 20000.0
+    # Generated tokens per second and per request; 0 streams without delay
+    tokens_per_sec: float = 500.0
+    response_tokens: int = 200
+    # Requests served at once (OLLAMA_NUM_PARALLEL) and how many more may wait
+    # before the server answers 503 (OLLAMA_MAX_QUEUE)
+    parallel: int = 1
+    max_queue: int = 512
+    # Probability that a request fails with a 503 before streaming, or with an
+    # error line halfway through the stream
+    failure_rate: float = 0.0
+    stream_failure_rate: float = 0.0
+    seed: int = 0
+
+@dataclass
+class ServerCounters:
+    requests: int = 0
+    completed: int = 0
+    injected_failures: int = 0
+    rejected: int = 0
+    prompt_tokens: int = 0
+    evaluated_prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+def common_prefix_length(a: str, b: str) -> int:
+    """Length of the common prefix of a and b, by binary search over slices"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class FakeOllamaServer:
+    """
+    Minimal stand-in for the Ollama HTTP API. Each of the `parallel` slots
+    remembers the last prompt it evaluated, and a new request is given the slot
+    sharing the longest prefix with it, so prompt_eval_count reflects prefix
+    reuse the way a real server's KV cache would.
+    """
+
+    def __init__(self, config: FakeServerConfig):
+        self.config = config
+        self.counters = ServerCounters()
+        self._lock = threading.Lock()
+        self._random = random.Random(config.seed)
+        self._slots = threading.BoundedSemaphore(max(1, config.parallel))
+        self._slot_prompts: List[str] = []
+        self._in_flight = 0
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_port}"
+
+    def start(self) -> "FakeOllamaServer":
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="fake-ollama", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def take_counters(self) -> ServerCounters:
+        """Returns the counters collected since the last call and resets them"""
+        with self._lock:
+            counters, self.counters = self.counters, ServerCounters()
+            return counters
+
+    def _chance(self, probability: float) -> bool:
+        if probability <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < probability
+
+    def _reuse_prefix(self, prompt: str) -> int:
+        """Assigns prompt to the slot with the longest shared prefix and returns that length"""
+        with self._lock:
+            best_index, best_length = None, 0
+            for index, previous in enumerate(self._slot_prompts):
+                length = common_prefix_length(previous, prompt)
+                if best_index is None or length > best_length:
+                    best_index, best_length = index, length
+            if best_index is None or (best_length == 0 and len(self._slot_prompts) < self.config.parallel):
+                self._slot_prompts.append(prompt)
+            else:
+                self._slot_prompts[best_index] = prompt
+            return best_length
+
+    @staticmethod
+    def _reply_head(messages: List[Dict[str, Any]]) -> str:
+        """
+        Opening lines of a reply. A slotted section update gets one
+        === SECTION === marker for each section sent with the chunk; every other
+        reply starts with a three-section outline, so structure passes give the
+        slotted strategy sections to fill.
+        """
+        system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+        user = (messages[-1].get("content") or "") if messages else ""
+        if "=== SECTION II ===" in system:
+            keys = re.findall(r"^=== SECTION ([IVXLC]+) ===$", user, re.MULTILINE) or ["I"]
+            return "".join(f"=== SECTION {key} ===\nSection summary\n" for key in keys)
+        return "I. Introduction\nII. Findings\nIII. Conclusions\n"
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length) or b"{}") if length else {}
+
+        if method == "GET" and handler.path == "/api/tags":
+            self._send_json(handler, 200, {"models": [{"name": self.config.model_name}]})
+        elif method == "POST" and handler.path == "/api/show":
+            family = self.config.model_name.split(":")[0]
+            self._send_json(handler, 200, {"model_info": {f"{family}.context_length": self.config.context_length}})
+        elif method == "POST" and handler.path == "/api/generate":
+            # Only the empty load request used to keep the model warm
+            self._send_json(handler, 200, {"model": body.get("model", self.config.model_name),
+                                           "response": "", "done": True, "done_reason": "load"})
+        elif method == "POST" and handler.path == "/api/chat":
+            self._handle_chat(handler, body)
+        else:
+            self._send_json(handler, 404, {"error": f"unknown endpoint {method} {handler.path}"})
+
+    def _send_json(self, handler: BaseHTTPRequestHandler, status: int, payload: Dict[str, Any]):
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _write_chunk(self, handler: BaseHTTPRequestHandler, payload: Dict[str, Any]):
+        line = json.dumps(payload).encode() + b"\n"
+        handler.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        handler.wfile.flush()
+
+    def _handle_chat(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any]):
+        config = self.config
+        with self._lock:
+            self.counters.requests += 1
+            if self._in_flight >= config.parallel + config.max_queue:
+                self.counters.rejected += 1
+                rejected = True
+            else:
+                self._in_flight += 1
+                rejected = False
+        if rejected:
+            self._send_json(handler, 503, {"error": "server busy, please try again"})
+            return
+        try:
+            if self._chance(config.failure_rate):
+                with self._lock:
+                    self.counters.injected_failures += 1
+                self._send_json(handler, 503, {"error": "injected failure"})
+                return
+            with self._slots:
+                self._stream_chat(handler, body)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _stream_chat(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any]):
+        config = self.config
+        started = time.monotonic()
+        prompt = "".join(f"{m.get('role')}:{m.get('content') or ''}\n" for m in body.get("messages", []))
+        prompt_tokens = construct_ai.count_tokens(prompt)
+        reused_tokens = construct_ai.count_tokens(prompt[:self._reuse_prefix(prompt)])
+        evaluated_tokens = max(1, prompt_tokens - reused_tokens)
+
+        prefill_seconds = evaluated_tokens / config.prefill_tokens_per_sec if config.prefill_tokens_per_sec > 0 else 0.0
+        time.sleep(config.ttft + prefill_seconds)
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        head = self._reply_head(body.get("messages", []))
+        fail_midway = self._chance(config.stream_failure_rate)
+        tokens = max(1, config.response_tokens)
+        delay = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0.0
+        generation_started = time.monotonic()
+        for i in range(tokens):
+            if fail_midway and i == tokens // 2:
+                with self._lock:
+                    self.counters.injected_failures += 1
+                self._write_chunk(handler, {"error": "injected failure during generation"})
+                handler.wfile.write(b"0\r\n\r\n")
+                return
+            if i == 0:
+                content = head
+            else:
+                content = "detail " if i % 12 else "detail.\n"
+            self._write_chunk(handler, {"model": config.model_name, "message": {"role": "assistant", "content": content}, "done": False})
+            if delay:
+                time.sleep(delay)
+
+        eval_seconds = time.monotonic() - generation_started
+        self._write_chunk(handler, {
+            "model": config.model_name,
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int((time.monotonic() - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": evaluated_tokens,
+            "prompt_eval_duration": int(prefill_seconds * 1e9),
+            "eval_count": tokens,
+            "eval_duration": int(eval_seconds * 1e9),
+        })
+        handler.wfile.write(b"0\r\n\r\n")
+        with self._lock:
+            self.counters.completed += 1
+            self.counters.prompt_tokens += prompt_tokens
+            self.counters.evaluated_prompt_tokens += evaluated_tokens
+            self.counters.completion_tokens += tokens
+
+class FakeServerGroup:
+    """
+    Several stand-in servers with the same settings, used as BASE_URL plus
+    OLLAMA_ENDPOINTS. Counters are summed over the group; per_server_requests
+    shows how the endpoint pool spread the load.
+    """
+
+    def __init__(self, config: FakeServerConfig, count: int):
+        self.servers = [FakeOllamaServer(replace(config, seed=config.seed + i)) for i in range(max(1, count))]
+        self.config = config
+        self.per_server_requests = [0] * len(self.servers)
+
+    @property
+    def base_url(self) -> str:
+        return self.servers[0].base_url
+
+    @property
+    def base_urls(self) -> List[str]:
+        return [server.base_url for server in self.servers]
+
+    def start(self) -> "FakeServerGroup":
+        for server in self.servers:
+            server.start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+    def take_counters(self) -> ServerCounters:
+        total = ServerCounters()
+        for i, server in enumerate(self.servers):
+            counters = server.take_counters()
+            self.per_server_requests[i] += counters.requests
+            for name, value in asdict(counters).items():
+                setattr(total, name, getattr(total, name) + value)
+        return total
+
+# =============================================================================
+# MEASUREMENT HELPERS
+# =============================================================================
+def current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def lifetime_peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class PeakRSSSampler:
+    """Samples the process RSS in the background and keeps the maximum seen"""
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss_bytes() or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes() or 0)
+
+    def __enter__(self) -> "PeakRSSSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes() or 0)
+        if not self.peak:
+            # No /proc: fall back to the lifetime peak
+            self.peak = lifetime_peak_rss_bytes() or 0
+
+class ExtractionTimer:
+    """Wraps construct_ai.read_file_content to add up the time spent reading sources"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self._lock = threading.Lock()
+        self._original: Optional[Callable] = None
+
+    def __enter__(self) -> "ExtractionTimer":
+        self._original = original = construct_ai.read_file_content
+
+        def timed_read_file_content(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.seconds += time.perf_counter() - started
+                    self.files += 1
+
+        construct_ai.read_file_content = timed_read_file_content
+        return self
+
+    def __exit__(self, *exc):
+        construct_ai.read_file_content = self._original
+
+@dataclass
+class ScenarioResult:
+    name: str
+    documents: int
+    succeeded: int
+    failed: int
+    elapsed_seconds: float
+    docs_per_hour: float
+    llm_calls: int
+    llm_calls_per_doc: float
+    prompt_tokens_sent: int
+    evaluated_prompt_tokens: int
+    completion_tokens: int
+    injected_failures: int
+    rejected_requests: int
+    extraction_seconds: float
+    peak_rss_mb: float
+    details: Dict[str, Any] = field(default_factory=dict)
+
+def build_result(name: str, documents: int, succeeded: int, elapsed: float, counters: ServerCounters,
+                 extraction_seconds: float, peak_rss: int, details: Optional[Dict[str, Any]] = None) -> ScenarioResult:
+    return ScenarioResult(
+        name=name,
+        documents=documents,
+        succeeded=succeeded,
+        failed=documents - succeeded,
+        elapsed_seconds=round(elapsed, 3),
+        docs_per_hour=round(succeeded / elapsed * 3600, 1) if elapsed > 0 else 0.0,
+        llm_calls=counters.completed,
+        llm_calls_per_doc=round(counters.completed / documents, 2) if documents else 0.0,
+        prompt_tokens_sent=counters.prompt_tokens,
+        evaluated_prompt_tokens=counters.evaluated_prompt_tokens,
+        completion_tokens=counters.completion_tokens,
+        injected_failures=counters.injected_failures,
+        rejected_requests=counters.rejected,
+        extraction_seconds=round(extraction_seconds, 3),
+        peak_rss_mb=round(peak_rss / 1e6, 1),
+        details=details or {},
+    )
+
+# =============================================================================
+# DOCUMENTS
+# =============================================================================
+_WORDS = ("model data risk policy system analysis market value process result review evidence "
+          "capital fairness agent return measure standard report method outcome strategy").split()
+
+def generate_synthetic_document(approx_tokens: int, seed: int) -> str:
+    """Generates a document with numbered sections and paragraphs of plain sentences"""
+    rng = random.Random(seed)
+    target_chars = approx_tokens * 4
+    parts: List[str] = []
+    size = 0
+    section = 0
+    while size < target_chars:
+        section += 1
+        heading = f"\n{section}. {rng.choice(_WORDS).title()} and {rng.choice(_WORDS)}\n\n"
+        parts.append(heading)
+        size += len(heading)
+        for _ in range(rng.randint(3, 8)):
+            sentences = []
+            for _ in range(rng.randint(3, 7)):
+                words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 20))]
+                sentences.append(" ".join(words).capitalize() + f" in {rng.randint(1990, 2025)}.")
+            paragraph = " ".join(sentences) + "\n\n"
+            parts.append(paragraph)
+            size += len(paragraph)
+    return "".join(parts)
+
+def write_synthetic_documents(directory: str, sizes: List[int], seed: int) -> List[str]:
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, tokens in enumerate(sizes):
+        path = os.path.join(directory, f"synthetic_{i:02d}_{tokens}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(generate_synthetic_document(tokens, seed + i))
+        paths.append(path)
+    return paths
+
+def copy_bundled_documents(workdir: str) -> List[str]:
+    copied = []
+    for folder in BUNDLED_FOLDERS:
+        source = os.path.join(SCRIPT_DIR, folder)
+        if not os.path.isdir(source):
+            print(f"Warning: bundled folder not found, skipping: {source}")
+            continue
+        shutil.copytree(source, os.path.join(workdir, folder))
+        copied.append(folder)
+    return copied
+
+def list_pdfs(workdir: str, folders: List[str]) -> List[str]:
+    pdfs = []
+    for folder in folders:
+        for name in sorted(os.listdir(os.path.join(workdir, folder))):
+            if name.lower().endswith(".pdf"):
+                pdfs.append(os.path.join(folder, name))
+    return pdfs
+
+# =============================================================================
+# SCENARIOS
+# =============================================================================
+def run_extraction_scenario(server: FakeServerGroup, pdfs: List[str]) -> ScenarioResult:
+    """Times PDF text extraction alone: cold (no text cache) and warm (cache hit)"""
+    per_file = []
+    text_cache_enabled = construct_ai.TEXT_CACHE_ENABLED
+    with PeakRSSSampler() as rss:
+        started = time.perf_counter()
+        for path in pdfs:
+            construct_ai.TEXT_CACHE_ENABLED = False
+            t0 = time.perf_counter()
+            text = construct_ai.read_file_content(path, "pdf")
+            cold = time.perf_counter() - t0
+
+            construct_ai.TEXT_CACHE_ENABLED = True
+            content_hash = construct_ai.hash_file(path)
+            construct_ai.read_file_content(path, "pdf", content_hash=content_hash)
+            t0 = time.perf_counter()
+            construct_ai.read_file_content(path, "pdf", content_hash=content_hash)
+            warm = time.perf_counter() - t0
+            per_file.append({"path": path, "chars": len(text), "tokens": construct_ai.count_tokens(text),
+                             "cold_seconds": round(cold, 4), "warm_seconds": round(warm, 4)})
+        elapsed = time.perf_counter() - started
+    construct_ai.TEXT_CACHE_ENABLED = text_cache_enabled
+    cold_total = sum(f["cold_seconds"] for f in per_file)
+    details = {
+        "cold_seconds": round(cold_total, 3),
+        "warm_seconds": round(sum(f["warm_seconds"] for f in per_file), 3),
+        "total_chars": sum(f["chars"] for f in per_file),
+        "files": per_file,
+    }
+    return build_result("extraction", len(pdfs), len(pdfs), elapsed, server.take_counters(), cold_total, rss.peak, details)
+
+def run_summarize_scenario(server: FakeServerGroup, texts: List[str], doc_concurrency: int) -> ScenarioResult:
+    """Calls summarize_document directly on in-memory texts (no discovery, reading or writing)"""
+    construct_ai.prefill_stats = construct_ai.PrefillStats()
+
+    def summarize(text: str) -> bool:
+        try:
+            construct_ai.summarize_document(text)
+            return True
+        except Exception as e:
+            print(f"Warning: summarize_document failed: {e}")
+            return False
+
+    with PeakRSSSampler() as rss:
+        started = time.perf_counter()
+        outcomes = construct_ai.map_in_parallel(summarize, texts, max_workers=doc_concurrency)
+        elapsed = time.perf_counter() - started
+    details = {"document_tokens": [construct_ai.count_tokens(t) for t in texts],
+               "prefill_report": construct_ai.prefill_stats.report()}
+    return build_result("summarize", len(texts), sum(outcomes), elapsed, server.take_counters(), 0.0, rss.peak, details)
+
+def run_pipeline_scenario(server: FakeServerGroup, name: str, folders: List[str]) -> ScenarioResult:
+    """Runs process_discovered_files over the given folders of the working directory"""
+    construct_ai.FOLDERS_TO_PROCESS = folders
+    construct_ai.prefill_stats = construct_ai.PrefillStats()
+    with PeakRSSSampler() as rss, ExtractionTimer() as extraction:
+        started = time.perf_counter()
+        results = construct_ai.process_discovered_files()
+        elapsed = time.perf_counter() - started
+    details = {
+        "files": [{"path": r.file_path, "status": r.status, "seconds": round(r.elapsed_seconds, 3)} for r in results],
+        "prefill_report": construct_ai.prefill_stats.report(),
+    }
+    succeeded = sum(1 for r in results if r.status == "success")
+    return build_result(name, len(results), succeeded, elapsed, server.take_counters(), extraction.seconds, rss.peak, details)
+
+# =============================================================================
+# REPORTING
+# =============================================================================
+HEADLINE_METRICS = ["docs_per_hour", "llm_calls_per_doc", "prompt_tokens_sent", "evaluated_prompt_tokens",
+                    "extraction_seconds", "peak_rss_mb", "elapsed_seconds"]
+
+def print_results(results: List[ScenarioResult]):
+    print(f"\n{'='*96}")
+    print("BENCHMARK RESULTS")
+    print(f"{'='*96}")
+    print(f"{'scenario':12}{'docs':>6}{'ok':>5}{'docs/h':>10}{'calls/doc':>11}{'prompt tok':>12}"
+          f"{'evaluated':>12}{'extract s':>11}{'peak MB':>9}{'time s':>9}")
+    for r in results:
+        print(f"{r.name:12}{r.documents:>6}{r.succeeded:>5}{r.docs_per_hour:>10.1f}{r.llm_calls_per_doc:>11.2f}"
+              f"{r.prompt_tokens_sent:>12}{r.evaluated_prompt_tokens:>12}{r.extraction_seconds:>11.2f}"
+              f"{r.peak_rss_mb:>9.1f}{r.elapsed_seconds:>9.1f}")
+    print(f"{'='*96}")
+
+def print_comparison(results: List[ScenarioResult], baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {s["name"]: s for s in json.load(f).get("scenarios", [])}
+    print(f"\nCompared with {baseline_path}:")
+    for r in results:
+        old = baseline.get(r.name)
+        if not old:
+            print(f"  {r.name}: not in baseline")
+            continue
+        changes = []
+        for metric in HEADLINE_METRICS:
+            before, after = old.get(metric), getattr(r, metric)
+            if before:
+                changes.append(f"{metric} {before} -> {after} ({(after - before) / before * 100:+.1f}%)")
+        print(f"  {r.name}: " + "; ".join(changes))
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def pipeline_settings() -> Dict[str, Any]:
+    names = ["MODEL_NAME", "SUMMARY_STRATEGY", "MAX_CONCURRENT_DOCUMENTS", "MAX_CONCURRENT_LLM_REQUESTS",
+             "ADAPTIVE_CONCURRENCY", "ADAPTIVE_TTFT_TARGET_SECONDS",
+             "LLM_CACHE_ENABLED", "TEXT_CACHE_ENABLED", "DEDUP_ENABLED", "CHECKPOINTS_ENABLED", "PDF_EXTRACTION_WORKERS", "OLLAMA_MAX_RETRIES",
+             "OLLAMA_ENDPOINTS",
+             "OLLAMA_BACKOFF_BASE", "NUM_CTX_BUCKETS", "STRUCTURE_DIRECT_MAX_TOKENS", "VERY_LONG_DOC_THRESHOLD"]
+    settings = {name: getattr(construct_ai, name) for name in names if hasattr(construct_ai, name)}
+    settings["tokenizer"] = construct_ai.get_tokenizer().name
+    return settings
+
+# =============================================================================
+# MAIN
+# =============================================================================
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark construct_ai.py against a local stand-in Ollama server.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS,
+                        help="scenarios to run (default: all)")
+    server = parser.add_argument_group("stand-in server")
+    server.add_argument("--ttft", type=float, default=FakeServerConfig.ttft,
+                        help="fixed seconds before the first token")
+    server.add_argument("--prefill-tokens-per-sec", type=float, default=FakeServerConfig.prefill_tokens_per_sec,
+                        help="prompt evaluation speed; 0 for instant")
+    server.add_argument("--tokens-per-sec", type=float, default=FakeServerConfig.tokens_per_sec,
+                        help="generation speed per request; 0 for no delay")
+    server.add_argument("--response-tokens", type=int, default=FakeServerConfig.response_tokens,
+                        help="tokens generated per response")
+    server.add_argument("--server-parallel", type=int, default=FakeServerConfig.parallel,
+                        help="requests the server handles at once (OLLAMA_NUM_PARALLEL)")
+    server.add_argument("--server-max-queue", type=int, default=FakeServerConfig.max_queue,
+                        help="waiting requests before the server answers 503")
+    server.add_argument("--servers", type=int, default=1,
+                        help="stand-in servers to run; all but the first become OLLAMA_ENDPOINTS")
+    server.add_argument("--failure-rate", type=float, default=0.0,
+                        help="probability of a 503 before streaming")
+    server.add_argument("--stream-failure-rate", type=float, default=0.0,
+                        help="probability of an error halfway through a stream")
+    pipeline = parser.add_argument_group("pipeline")
+    pipeline.add_argument("--doc-concurrency", type=int, default=construct_ai.MAX_CONCURRENT_DOCUMENTS,
+                          help="MAX_CONCURRENT_DOCUMENTS for the run")
+    pipeline.add_argument("--llm-concurrency", type=int, default=construct_ai.MAX_CONCURRENT_LLM_REQUESTS,
+                          help="MAX_CONCURRENT_LLM_REQUESTS for the run")
+    pipeline.add_argument("--adaptive", action="store_true",
+                          help="tune LLM concurrency at run time (ADAPTIVE_CONCURRENCY), up to --llm-concurrency")
+    pipeline.add_argument("--strategy", default=construct_ai.SUMMARY_STRATEGY,
+                          choices=["auto", "slotted", "incremental", "tree"], help="SUMMARY_STRATEGY for the run")
+    pipeline.add_argument("--backoff-base", type=float, default=construct_ai.OLLAMA_BACKOFF_BASE,
+                          help="OLLAMA_BACKOFF_BASE for the run")
+    pipeline.add_argument("--use-llm-cache", action="store_true",
+                          help="keep the LLM response cache on (off by default so every call reaches the server)")
+    pipeline.add_argument("--use-text-cache", action="store_true",
+                          help="keep the extracted text cache on (off by default so every PDF is parsed)")
+    pipeline.add_argument("--use-dedup", action="store_true",
+                          help="keep near-duplicate detection on (off by default; scenarios share documents)")
+    parser.add_argument("--synthetic-tokens", type=int, nargs="+", default=SYNTHETIC_DOC_TOKENS,
+                        help="approximate token counts of the generated documents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmark_results/benchmark-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--keep-workdir", action="store_true", help="do not delete the temporary working directory")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    return parser.parse_args(argv)
+
+def configure_pipeline(args: argparse.Namespace, server: FakeServerGroup, workdir: str):
+    construct_ai.BASE_URL = server.base_url
+    construct_ai.OLLAMA_ENDPOINTS = server.base_urls[1:]
+    construct_ai.MODEL_NAME = server.config.model_name
+    construct_ai.CACHE_DIR = os.path.join(workdir, ".construct_ai_cache")
+    construct_ai.MAX_CONCURRENT_DOCUMENTS = args.doc_concurrency
+    construct_ai.MAX_CONCURRENT_LLM_REQUESTS = args.llm_concurrency
+    construct_ai.ADAPTIVE_CONCURRENCY = args.adaptive
+    construct_ai.SUMMARY_STRATEGY = args.strategy
+    construct_ai.OLLAMA_BACKOFF_BASE = args.backoff_base
+    construct_ai.LLM_CACHE_ENABLED = args.use_llm_cache
+    construct_ai.TEXT_CACHE_ENABLED = args.use_text_cache
+    # Several scenarios summarize the same documents; reusing earlier summaries
+    # would hide the cost of the later runs
+    construct_ai.DEDUP_ENABLED = args.use_dedup
+    # Resuming from a checkpoint would hide the work being measured
+    construct_ai.CHECKPOINTS_ENABLED = False
+    # One pass per document: a job-level retry would wait out JOB_RETRY_BASE_SECONDS
+    # (HTTP-level retries still apply)
+    construct_ai.JOB_MAX_ATTEMPTS = 1
+
+def run_benchmark(args: argparse.Namespace) -> Tuple[Dict[str, Any], List[ScenarioResult]]:
+    server = FakeServerGroup(FakeServerConfig(
+        ttft=args.ttft,
+        prefill_tokens_per_sec=args.prefill_tokens_per_sec,
+        tokens_per_sec=args.tokens_per_sec,
+        response_tokens=args.response_tokens,
+        parallel=args.server_parallel,
+        max_queue=args.server_max_queue,
+        failure_rate=args.failure_rate,
+        stream_failure_rate=args.stream_failure_rate,
+        seed=args.seed,
+    ), args.servers).start()
+
+    workdir = tempfile.mkdtemp(prefix="construct_ai_bench_")
+    original_cwd = os.getcwd()
+    log_path = os.path.join(workdir, "pipeline.log")
+    results: List[ScenarioResult] = []
+    try:
+        os.chdir(workdir)
+        configure_pipeline(args, server, workdir)
+        bundled = copy_bundled_documents(workdir) if {"extraction", "bundled"} & set(args.scenarios) else []
+        synthetic_paths = write_synthetic_documents(os.path.join(workdir, "synthetic"), args.synthetic_tokens, args.seed)
+
+        with open(log_path, "w", encoding="utf-8") as log:
+            quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log)
+            for scenario in args.scenarios:
+                print(f"Running scenario: {scenario}...")
+                with quiet:
+                    if scenario == "extraction":
+                        result = run_extraction_scenario(server, list_pdfs(workdir, bundled))
+                    elif scenario == "summarize":
+                        texts = [construct_ai.read_text_file(p) for p in synthetic_paths]
+                        result = run_summarize_scenario(server, texts, args.doc_concurrency)
+                    elif scenario == "synthetic":
+                        result = run_pipeline_scenario(server, "synthetic", ["synthetic"])
+                    else:
+                        result = run_pipeline_scenario(server, "bundled", bundled)
+                results.append(result)
+                print(f"  {result.succeeded}/{result.documents} document(s) in {result.elapsed_seconds:.1f}s")
+    finally:
+        os.chdir(original_cwd)
+        server.stop()
+        if args.keep_workdir:
+            print(f"Working directory kept at: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "server": asdict(server.config),
+        "servers": len(server.servers),
+        "requests_per_server": server.per_server_requests,
+        "pipeline": pipeline_settings(),
+        "lifetime_peak_rss_mb": round((lifetime_peak_rss_bytes() or 0) / 1e6, 1),
+        "scenarios": [asdict(r) for r in results],
+    }, results
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report, results = run_benchmark(args)
+    print_results(results)
+    if report["servers"] > 1:
+        print(f"Requests per server: {report['requests_per_server']}")
+
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to: {output}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == "__main__":
+    main()
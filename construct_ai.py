@@ -13,20 +13,53 @@ FOLDERS_TO_PROCESS = [
 # =============================================================================
 BASE_URL = "http://127.0.0.1:11434"
 MODEL_NAME = "gemma3:12b-it-qat"
+# More Ollama servers to share the work with BASE_URL, e.g. ["http://10.0.0.2:11434"].
+# Each needs MODEL_NAME pulled. Raise MAX_CONCURRENT_LLM_REQUESTS to their combined parallelism.
+OLLAMA_ENDPOINTS = []
 
 # =============================================================================
 # IMPORTS
 # =============================================================================
 import os
 import re
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+import weakref
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+from bisect import bisect_left
+from urllib.parse import urlsplit
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import json
+import gzip
+import math
+import heapq
+import hashlib
+import difflib
+import argparse
+import sqlite3
+import random
+import socket
 import requests
+from requests.adapters import HTTPAdapter
 import glob
 import PyPDF2
-from typing import List, Optional, Dict, Any, Union
+from collections import OrderedDict, Counter
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, suppress
+from typing import List, Optional, Dict, Any, Union, Sequence, Iterable, Iterator, Tuple, Callable, Generator, FrozenSet
 from dataclasses import dataclass
+from abc import ABC, abstractmethod
 
 # --- Google API Imports ---
 # Make sure to install the required libraries:
@@ -50,6 +83,9 @@ class SummaryConfig:
     use_incremental: bool
     chunk_size: int
     overlap_size: int
+    # "single", "incremental" (running summary), "slotted" (one summary per
+    # outline section) or "tree" (map-reduce)
+    strategy: str = "incremental"
 
 def build_structure_prompt(config: SummaryConfig) -> str:
     base_instruction = """You are a document structure analyst. Your job is to carefully read the document and extract its organizational structure, key themes, and logical flow.
@@ -256,13 +292,16 @@ Analyze the following document and extract its structure according to all requir
 
 """
 
+def build_previous_summary_section(previous_summary: str) -> str:
+    return f"PREVIOUS CONTENT ALREADY SUMMARIZED:\n{previous_summary}\n\nIMPORTANT: Build upon this previous summary by adding new information from the current text section. Do not repeat information already covered."
+
 def build_summary_prompt(config: SummaryConfig, structure: str = "", previous_summary: str = "") -> str:
     
     context_section = ""
     if structure:
         context_section += f"\n\nDOCUMENT STRUCTURE TO FOLLOW:\n{structure}"
     if previous_summary:
-        context_section += f"\n\nPREVIOUS CONTENT ALREADY SUMMARIZED:\n{previous_summary}\n\nIMPORTANT: Build upon this previous summary by adding new information from the current text section. Do not repeat information already covered."
+        context_section += f"\n\n{build_previous_summary_section(previous_summary)}"
 
     if config.document_type == "short":
         return f"""You are a professional document summarizer. Create a comprehensive, detailed summary that captures ALL essential information, examples, data, and insights from the document.
@@ -569,6 +608,138 @@ Analyze and summarize the following document according to all requirements above
 
 """
 
+def build_chunk_summary_prompt(config: SummaryConfig, structure: str) -> str:
+    """
+    Prompt for the map step of the tree strategy: one chunk, summarized on its
+    own. The part number goes in the user message so this stays identical for
+    every chunk of a document.
+    """
+    context_section = ""
+    if structure:
+        context_section = f"\n\nDOCUMENT STRUCTURE (for orientation only):\n{structure}"
+
+    return f"""You are a professional document summarizer working on one section of a much larger document. The user message says which part of the document the section is; other parts are summarized separately and merged later.
+
+CRITICAL REQUIREMENTS:
+1. Summarize ONLY the text provided below - do not invent content from other parts
+2. PRESERVE SPECIFICITY: Keep all numbers, dates, names, technical terms, quotes and examples
+3. Use the document structure to name the sections this text belongs to
+4. Organize the summary under those section headings, in the order they appear
+5. Do not write an introduction or conclusion for the whole document
+
+QUALITY REQUIREMENTS:
+- Be detailed: this partial summary is the only record of this text that later steps will see
+- Use clear, professional language with appropriate technical detail{context_section}
+
+=== TEXT TO SUMMARIZE ===
+Summarize the following section according to all requirements above:
+
+"""
+
+def build_partial_structure_prompt(config: SummaryConfig) -> str:
+    """Prompt for outlining one group of chunks when the document is too large for a single structure pass"""
+    return f"""You are a document structure analyst. You are reading one part of a long document (the user message says which); the other parts are outlined separately and merged later.
+
+CRITICAL INSTRUCTIONS:
+1. Outline ONLY the text provided below
+2. Identify the sections and subsections that appear in this part, in order
+3. Note key themes, arguments, and supporting evidence
+4. Use Roman numerals for main sections, capital letters for subsections and bullet points for details
+5. If the part starts or ends in the middle of a section, still list that section
+
+Keep the outline concise: up to {config.max_sections} main sections for this part.
+
+=== DOCUMENT PART TO ANALYZE ===
+Extract the structure of the following part according to all requirements above:
+
+"""
+
+def build_merge_prompt(config: SummaryConfig, structure: str) -> str:
+    """Prompt for the intermediate reduce steps of the tree strategy"""
+    context_section = ""
+    if structure:
+        context_section = f"\n\nDOCUMENT STRUCTURE TO FOLLOW:\n{structure}"
+
+    return f"""You are a professional document summarizer. You are given several partial summaries of consecutive parts of one document, in document order. Merge them into a single summary of those parts.
+
+CRITICAL REQUIREMENTS:
+1. Keep every specific detail: numbers, dates, names, technical terms, quotes and examples
+2. Combine content that belongs to the same section instead of repeating headings
+3. Remove only true duplication caused by overlapping parts
+4. Keep the order of the document structure
+5. Do not add content that is not in the partial summaries{context_section}
+
+=== PARTIAL SUMMARIES TO MERGE ===
+Merge the following partial summaries according to all requirements above:
+
+"""
+
+def build_revision_prompt(config: SummaryConfig) -> str:
+    """
+    Prompt for updating the summary of an earlier version of a document with
+    the passages removed from it and the passages that are new or changed
+    """
+    return f"""You are a professional document summarizer. A document you have already summarized has been revised. You are given the summary of the earlier version, passages of the earlier version that were removed or rewritten in the revised version, and passages that are new or changed in the revised version. Either kind of passage may be missing.
+
+CRITICAL REQUIREMENTS:
+1. Return the complete updated summary of the revised document
+2. Remove or correct statements that are based only on the removed passages
+3. Add new information from the new or changed passages in the section where it belongs
+4. Where a new or changed passage contradicts or updates the earlier summary, replace the outdated statement
+5. Keep everything else from the earlier summary, including its structure and wording
+6. PRESERVE SPECIFICITY: Keep all numbers, dates, names, technical terms, quotes and examples
+
+The summary should remain {config.summary_length} and {config.detail_level}.
+
+=== EARLIER SUMMARY AND CHANGED PASSAGES ===
+Update the summary according to all requirements above:
+
+"""
+
+def build_slot_update_prompt(config: SummaryConfig, structure: str) -> str:
+    """
+    System prompt for the slotted strategy. It is the same for every chunk of a
+    document; the current section summaries and the chunk go in the user message.
+    """
+    return f"""You are a professional document summarizer maintaining a {config.detail_level} summary of a long document, one summary per main section of its outline. The document is read in consecutive parts. With each part you receive the current summaries of the sections that part most likely covers.
+
+CRITICAL REQUIREMENTS:
+1. Decide which main sections of the outline below the new text belongs to (usually one or two)
+2. For each of those sections, return its complete updated summary: the current summary, if one was given, extended with the new information
+3. PRESERVE SPECIFICITY: Keep all numbers, dates, names, technical terms, quotes and examples
+4. Do not repeat information that is already in the current summaries
+5. Do not return sections the new text does not cover
+
+OUTPUT FORMAT:
+Start every section with a marker line holding its Roman numeral from the outline, followed by the summary:
+=== SECTION II ===
+Updated summary of section II...
+=== SECTION III ===
+Updated summary of section III...
+Return only marker lines and summaries, with no introduction or closing remarks.
+
+DOCUMENT STRUCTURE:
+{structure}"""
+
+def build_answer_prompt(structure: str) -> str:
+    """
+    System prompt for answering a question from retrieved excerpts. It depends
+    only on the document, so follow-up questions reuse the cached prefix; the
+    excerpts and the question go in the user message.
+    """
+    context_section = ""
+    if structure:
+        context_section = f"\n\nDOCUMENT STRUCTURE (for orientation only):\n{structure}"
+
+    return f"""You are a research assistant answering questions about one long document. You are not given the whole document, only the excerpts most relevant to the question, in document order and numbered.
+
+CRITICAL REQUIREMENTS:
+1. Answer ONLY from the excerpts - do not invent content from other parts of the document
+2. Cite the excerpts your answer relies on by number, e.g. [Excerpt 2]
+3. If the excerpts do not contain the answer, say so plainly and say what they do cover
+4. PRESERVE SPECIFICITY: Give numbers, dates, names and technical terms exactly as written
+5. Answer the question directly first, then add only the context needed to support it{context_section}"""
+
 # =============================================================================
 # SCRIPT CONFIGURATION
 # =============================================================================
@@ -576,10 +747,249 @@ Analyze and summarize the following document according to all requirements above
 SHORT_DOC_THRESHOLD = 10000
 MEDIUM_DOC_THRESHOLD = 15000
 LONG_DOC_THRESHOLD = 20000
+# Documents above this size use the tree (map-reduce) strategy when
+# SUMMARY_STRATEGY is "auto"; shorter ones use the incremental strategy
+VERY_LONG_DOC_THRESHOLD = 60000
+
+# Running summaries above this many tokens are compressed before the next chunk
+SUMMARY_COMPRESSION_THRESHOLD = 8000
+
+# TOKENIZER
+# Path to a local tokenizer.json (or a directory containing one) matching
+# MODEL_NAME. When None, TOKENIZER_SEARCH_DIRS are searched for a folder named
+# after the model (e.g. "tokenizers/gemma3-12b-it-qat" or "tokenizers/gemma3").
+# Without the `tokenizers` package or a matching file, 1 token ~ 4 characters.
+TOKENIZER_PATH = None
+TOKENIZER_SEARCH_DIRS = ["tokenizers", os.path.join(os.path.expanduser("~"), ".cache", "construct_ai", "tokenizers")]
+# Number of token counts remembered for repeated strings
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# PDF EXTRACTION
+# Worker processes that extract page ranges of large PDFs in parallel
+PDF_EXTRACTION_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# PDFs with fewer pages than this are extracted in-process
+PDF_PARALLEL_MIN_PAGES = 16
+PDF_PAGES_PER_TASK = 8
+
+# CHUNKING
+# Fraction at the end of each chunk searched for a heading, paragraph or
+# sentence break to cut at instead of the exact token position
+CHUNK_BOUNDARY_WINDOW = 0.2
+
+# STRUCTURE PASS
+# Documents longer than STRUCTURE_DIRECT_MAX_TOKENS are outlined in groups of
+# STRUCTURE_GROUP_TOKENS (in parallel) and the partial outlines merged, so no
+# structure prompt ever carries the whole document.
+STRUCTURE_DIRECT_MAX_TOKENS = 24000
+STRUCTURE_GROUP_TOKENS = 16000
+# Token budget for the partial outlines merged in a single call
+STRUCTURE_MERGE_INPUT_BUDGET = 16000
+
+# SUMMARY STRATEGY
+# "auto" picks by document length (incremental, or tree above
+# VERY_LONG_DOC_THRESHOLD), "incremental" always chains chunks through a single
+# running summary, "tree" always summarizes chunks independently and merges.
+# "slotted" (experimental, opt-in) keeps one summary per section of the
+# extracted outline and updates only the sections each chunk touches; the final
+# summary is those sections concatenated.
+SUMMARY_STRATEGY = "auto"
+# Token budget for the partial summaries merged in a single reduce call
+TREE_REDUCE_INPUT_BUDGET = 24000
+# Slotted strategy: at most this many section summaries are sent with a chunk,
+# and a section summary longer than SLOTTED_SECTION_MAX_TOKENS is condensed on
+# its own, so the cost of a call does not grow with the document
+SLOTTED_SECTIONS_PER_CALL = 3
+SLOTTED_SECTION_MAX_TOKENS = 1500
+# Share of a section's outline keywords that must appear in a chunk for the
+# section to be sent with it
+SLOTTED_MATCH_THRESHOLD = 0.3
+
+# NEAR-DUPLICATE DETECTION
+# Documents are fingerprinted with MinHash over word shingles and split into
+# content-defined blocks. The fingerprints and block texts are kept in an index
+# under CACHE_DIR with the summaries made from them. Only an identical text
+# reuses a summary as is. A document at least NEAR_DUPLICATE_THRESHOLD similar
+# (estimated Jaccard) to one already summarized has the earlier summary revised
+# with the blocks that were added, changed or removed, as long as no more than
+# NEAR_DUPLICATE_MAX_CHANGED of them were. Tree strategy chunks whose text was
+# summarized before with the same outline and settings reuse that chunk summary.
+DEDUP_ENABLED = True
+NEAR_DUPLICATE_THRESHOLD = 0.7
+NEAR_DUPLICATE_MAX_CHANGED = 0.5
+# Chunk summaries kept for reuse; the least recently used are evicted
+CHUNK_SUMMARY_MAX_ENTRIES = 20000
+# Average size of the blocks compared between two versions of a document
+DEDUP_BLOCK_TOKENS = 400
+SHINGLE_WORDS = 5
+MINHASH_PERMUTATIONS = 64
+# Signatures are split into bands for the candidate lookup; two documents are
+# compared when at least one band matches
+MINHASH_BANDS = 16
+
+# QUESTION ANSWERING (--ask)
+# A question about one document is answered in a single LLM call from the
+# QA_TOP_K chunks that match it best (BM25) plus the document's outline. The
+# chunk index and outline are built the first time the document is asked about
+# and kept in the cache directory.
+QA_CHUNK_TOKENS = 800
+QA_CHUNK_OVERLAP = 80
+QA_TOP_K = 6
+# Least recently used question indexes are removed once they take more than this
+QA_INDEX_MAX_BYTES = 256 * 1024 * 1024
+# BM25 term-frequency saturation and chunk-length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
 
 # DIRECTORIES
 AI_SUMMARIES_DIR = "ai summaries"
 
+# SUMMARY SANITIZATION
+# Summaries are written with everything except letters, digits, whitespace and
+# . , ! ? removed. Bump SANITIZER_VERSION after changing the pattern so
+# `--clean-summaries` re-cleans files recorded as clean by an older version.
+SANITIZER_VERSION = "1"
+# Worker processes used by `--clean-summaries`
+CLEAN_SUMMARIES_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# SUMMARY SEARCH (--search)
+# Every summary written is added to a positional inverted index in the cache
+# directory. Queries rank summaries with BM25; "quoted phrases" must match.
+SEARCH_RESULTS = 10
+# Words of context shown around the first match
+SEARCH_SNIPPET_WORDS = 30
+
+# WATCH MODE (--watch)
+# A file is queued once its size and mtime have not changed for this long, so
+# documents still being copied or downloaded are not read half-written
+WATCH_DEBOUNCE_SECONDS = 10.0
+# How often folders are rescanned when inotify is unavailable
+WATCH_POLL_INTERVAL = 5.0
+# Full rescan as a safety net for missed events (also used after an inotify overflow)
+WATCH_RESCAN_INTERVAL = 600.0
+# While idle, the model is reloaded this often so it never expires from memory;
+# keep it below OLLAMA_KEEP_ALIVE
+WATCH_KEEP_WARM_INTERVAL = 600.0
+
+# JOB QUEUE
+# Discovered documents go through a durable queue in the cache directory.
+# A failed document is retried after JOB_RETRY_BASE_SECONDS * 2^(attempt-1)
+# (capped, with jitter) and parked as failed after JOB_MAX_ATTEMPTS; it is only
+# queued again once the source changes or with --retry-failed
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 30.0
+JOB_RETRY_MAX_SECONDS = 1800.0
+# A running job is handed to another worker if its process stops renewing the
+# lease for this long (crash, kill -9, power loss)
+JOB_LEASE_SECONDS = 120.0
+# Worker processes that drain the queue in a normal run (--workers overrides);
+# each one processes up to MAX_CONCURRENT_DOCUMENTS documents at a time
+JOB_WORKER_PROCESSES = 1
+
+# CONCURRENCY
+# Number of documents processed at the same time. 1 keeps the original
+# one-file-after-another behaviour.
+MAX_CONCURRENT_DOCUMENTS = 1
+# Global cap on simultaneous get_llm_response calls across all documents.
+# Set this to the server's OLLAMA_NUM_PARALLEL.
+MAX_CONCURRENT_LLM_REQUESTS = 1
+
+# ADAPTIVE CONCURRENCY
+# Tune the number of simultaneous LLM requests at run time (AIMD) between 1 and
+# MAX_CONCURRENT_LLM_REQUESTS, which becomes the ceiling. After every window of
+# completed requests the limit grows by one if the slots were all in use,
+# output tokens/sec improved and time-to-first-token stayed under the target;
+# it is multiplied by ADAPTIVE_DECREASE_FACTOR when latency exceeds the target
+# or requests fail
+ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_INITIAL_LIMIT = 1
+# Target for the 90th percentile time-to-first-token (includes server queueing and prefill)
+ADAPTIVE_TTFT_TARGET_SECONDS = 20.0
+ADAPTIVE_DECREASE_FACTOR = 0.5
+# A higher limit is kept only if it raises throughput by at least this fraction,
+# and given up if throughput drops by more than it
+ADAPTIVE_MIN_GAIN = 0.05
+# Completed requests per decision; at least ADAPTIVE_WINDOW_ROUNDS times the
+# current limit so each window spans several rounds of requests
+ADAPTIVE_WINDOW_REQUESTS = 8
+ADAPTIVE_WINDOW_ROUNDS = 3
+# Windows spent holding at a limit before probing one step higher again
+ADAPTIVE_PROBE_WINDOWS = 10
+
+# HTTP CLIENT
+# Seconds to wait for a connection, and for each streamed line (prefill of a
+# long prompt happens before the first line, so keep the read timeout generous)
+OLLAMA_CONNECT_TIMEOUT = 10
+OLLAMA_READ_TIMEOUT = 900
+# Connection errors, timeouts, dropped streams and 5xx responses are retried
+# with exponential backoff (base * 2^attempt, capped, with full jitter)
+OLLAMA_MAX_RETRIES = 4
+OLLAMA_BACKOFF_BASE = 1.0
+OLLAMA_BACKOFF_MAX = 30.0
+
+# Ask the server to keep the model (and its prompt cache) loaded this long
+# between requests
+OLLAMA_KEEP_ALIVE = "30m"
+# Idle keep-alive connections the async client keeps per server and event loop
+ASYNC_MAX_IDLE_CONNECTIONS = 8
+
+# ENDPOINT POOL (BASE_URL plus OLLAMA_ENDPOINTS)
+# Seconds between /api/tags health checks of every endpoint
+ENDPOINT_HEALTH_INTERVAL = 30.0
+# Consecutive failed requests after which an endpoint is ejected from routing.
+# It is probed again after ENDPOINT_EJECT_SECONDS, doubling (up to the max)
+# while it keeps failing
+ENDPOINT_FAILURE_THRESHOLD = 2
+ENDPOINT_EJECT_SECONDS = 15.0
+ENDPOINT_EJECT_MAX_SECONDS = 300.0
+# Requests of a document stay on the endpoint that served it before (its prompt
+# cache holds the document's prefix) unless that endpoint has more than this
+# many requests in flight beyond the least busy one
+ENDPOINT_STICKY_SLACK = 1
+
+# CONTEXT WINDOW
+# num_ctx is sized per request from the prompt length plus an output budget,
+# rounded up to one of these buckets so the server rarely has to reload the
+# model, and capped at the model's context length reported by /api/show.
+NUM_CTX_BUCKETS = [16384, 32768, 65536, 131072]
+# Tokens reserved for the model's answer
+NUM_CTX_OUTPUT_BUDGET = 8192
+# Headroom for the gap between our token estimate and the model's tokenizer
+NUM_CTX_SAFETY_MARGIN = 1.1
+# Used when /api/show does not report a context length
+DEFAULT_MODEL_CONTEXT = 128000
+
+# CACHING
+# Working directory for caches and other state kept between runs
+CACHE_DIR = ".construct_ai_cache"
+# Recorded in the source manifest with every summary. Bump it after changing
+# the prompts so existing summaries are treated as out of date.
+PROMPT_VERSION = "1"
+# Persistent cache of LLM responses keyed by a hash of (model, options, messages).
+# Set to False to always query the server.
+LLM_CACHE_ENABLED = True
+# Least recently used responses are evicted once the cache exceeds this size
+LLM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Extracted PDF text is kept compressed under CACHE_DIR/text, keyed by the
+# source's content hash and EXTRACTOR_VERSION, so later runs skip re-parsing.
+# Bump EXTRACTOR_VERSION when the extraction code changes.
+TEXT_CACHE_ENABLED = True
+TEXT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+EXTRACTOR_VERSION = "pypdf2-1"
+# Save structure and running summary after every step so an interrupted
+# document resumes from its last completed chunk
+CHECKPOINTS_ENABLED = True
+
+# INSTRUMENTATION
+# Record per-stage timings and token counts (also enabled by --trace). Spans
+# are appended to TRACE_FILE as JSON lines and totals are written to
+# METRICS_FILE in the Prometheus text format at the end of a run. Both default
+# to files under CACHE_DIR.
+TRACE_ENABLED = False
+TRACE_FILE = None
+METRICS_FILE = None
+# Upper bounds (seconds) of the stage duration histogram buckets
+TRACE_DURATION_BUCKETS = [0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 1800]
+
 # GOOGLE API CONFIGURATION
 SCOPES = [
     'https://www.googleapis.com/auth/documents',       # To read and write content inside docs
@@ -682,66 +1092,1866 @@ def read_gdoc_file(file_path: str, service: Any) -> str:
     except Exception as e:
         raise Exception(f"Error reading .gdoc file: {e}")
 
+# =============================================================================
+# CONCURRENCY HELPERS
+# =============================================================================
+
+class LLMSlot:
+    """One held slot of the ConcurrencyLimiter; record() reports how the request went"""
+
+    def __init__(self, limiter: Optional["ConcurrencyLimiter"] = None):
+        self.limiter = limiter
+        self.ttft_seconds: Optional[float] = None
+        self.output_tokens = 0
+        # Transient failures (retried or not) seen while the slot was held
+        self.errors = 0
+
+    def record(self, ttft_seconds: Optional[float], output_tokens: int):
+        self.ttft_seconds = ttft_seconds
+        self.output_tokens = output_tokens
+
+class ConcurrencyLimiter:
+    """
+    Bounds in-flight LLM requests. With a fixed limit it behaves like a
+    semaphore. With adaptive=True the limit follows AIMD: after each window of
+    completed requests, slow first tokens or failures cut it multiplicatively.
+    Otherwise it grows by one when all slots were in use and throughput
+    improved on the last measurement at the lower limit. The current limit and
+    every decision are exported as metrics.
+    """
+
+    DECISIONS = ("increase", "decrease", "hold")
+
+    def __init__(self, max_limit: int, adaptive: bool = False, initial_limit: Optional[int] = None):
+        self.max_limit = max(1, max_limit)
+        self.adaptive = adaptive
+        self.limit = min(self.max_limit, max(1, initial_limit or 1)) if adaptive else self.max_limit
+        self.in_flight = 0
+        self.decisions = {decision: 0 for decision in self.DECISIONS}
+        self.last_ttft_p90: Optional[float] = None
+        self.last_throughput: Optional[float] = None
+        self._condition = threading.Condition()
+        self._throughput_at: Dict[int, float] = {}
+        # Lowest limit that recently brought no throughput gain; only probed again after a while
+        self._no_gain_limit: Optional[int] = None
+        self._holds = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_started = time.perf_counter()
+        self._window_ttfts: List[float] = []
+        self._window_tokens = 0
+        self._window_completed = 0
+        self._window_errors = 0
+        self._window_saturated = False
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._window_saturated = True
+
+    def pause(self, delay: float):
+        """Sleeps out a retry backoff with a held slot given back, then waits to take it again"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+        try:
+            time.sleep(delay)
+        finally:
+            try:
+                self._acquire()
+            except BaseException:
+                # slot() still gives the slot back on the way out
+                with self._condition:
+                    self.in_flight += 1
+                raise
+
+    @contextmanager
+    def slot(self) -> Iterator[LLMSlot]:
+        self._acquire()
+        slot = LLMSlot(self)
+        token = _current_llm_slot.set(slot)
+        failed = False
+        try:
+            yield slot
+        except requests.RequestException:
+            failed = True
+            raise
+        finally:
+            _current_llm_slot.reset(token)
+            decision = None
+            with self._condition:
+                self.in_flight -= 1
+                if self.adaptive:
+                    decision = self._observe(slot, failed)
+                self._condition.notify_all()
+            # Logged outside the lock so waiting threads are not held up by the I/O
+            if decision is not None:
+                self._log_decision(decision)
+
+    def _observe(self, slot: LLMSlot, failed: bool) -> Optional[Dict[str, Any]]:
+        """Called with the condition held; returns the decision when a window closed"""
+        self._window_completed += 1
+        self._window_errors += max(slot.errors, int(failed))
+        if not failed:
+            self._window_tokens += slot.output_tokens
+            if slot.ttft_seconds is not None:
+                self._window_ttfts.append(slot.ttft_seconds)
+        if self._window_completed >= max(ADAPTIVE_WINDOW_REQUESTS, ADAPTIVE_WINDOW_ROUNDS * self.limit):
+            return self._decide()
+        return None
+
+    def _decide(self) -> Dict[str, Any]:
+        elapsed = max(time.perf_counter() - self._window_started, 1e-6)
+        throughput = self._window_tokens / elapsed
+        ttfts = sorted(self._window_ttfts)
+        ttft_p90 = ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.9))] if ttfts else None
+        old_limit = self.limit
+        if self._window_saturated:
+            # Only windows that used every slot say something about this limit
+            earlier = self._throughput_at.get(old_limit)
+            self._throughput_at[old_limit] = throughput if earlier is None else (earlier + throughput) / 2
+        lower = self._throughput_at.get(old_limit - 1)
+
+        if self._window_errors or (ttft_p90 is not None and ttft_p90 > ADAPTIVE_TTFT_TARGET_SECONDS):
+            decision = "decrease"
+            reason = f"{self._window_errors} failed or retried request(s)" if self._window_errors else "slow first token"
+            self.limit = max(1, int(self.limit * ADAPTIVE_DECREASE_FACTOR))
+            # Measurements at higher limits are stale once the server slows down
+            self._throughput_at = {limit: value for limit, value in self._throughput_at.items() if limit <= self.limit}
+            self._no_gain_limit = None
+        elif not self._window_saturated:
+            decision, reason = "hold", "limit not reached"
+        elif lower is not None and throughput < lower * (1 + ADAPTIVE_MIN_GAIN):
+            decision, reason = "decrease", "no throughput gain over the lower limit"
+            self._no_gain_limit = self.limit
+            self.limit -= 1
+        elif self.limit >= self.max_limit:
+            decision, reason = "hold", "at maximum"
+        elif self.limit + 1 == self._no_gain_limit and self._holds < ADAPTIVE_PROBE_WINDOWS:
+            decision, reason = "hold", "no gain above this limit"
+        else:
+            decision = "increase"
+            reason = "probing" if self.limit + 1 == self._no_gain_limit else "throughput improved"
+            self.limit += 1
+
+        self._holds = self._holds + 1 if decision == "hold" else 0
+        self.decisions[decision] += 1
+        self.last_ttft_p90 = ttft_p90
+        self.last_throughput = throughput
+        self._reset_window()
+        return {"decision": decision, "reason": reason, "old_limit": old_limit, "limit": self.limit,
+                "ttft_p90_seconds": ttft_p90, "tokens_per_sec": round(throughput, 2)}
+
+    @staticmethod
+    def _log_decision(decision: Dict[str, Any]):
+        if decision["limit"] != decision["old_limit"]:
+            ttft_p90 = decision["ttft_p90_seconds"]
+            ttft_text = f"{ttft_p90:.1f}s" if ttft_p90 is not None else "n/a"
+            print(f"LLM concurrency {decision['old_limit']} -> {decision['limit']} ({decision['reason']}; "
+                  f"p90 time-to-first-token {ttft_text}, {decision['tokens_per_sec']:.1f} tokens/s)")
+        trace_event("concurrency_decision", **decision)
+
+    def render_metrics(self) -> str:
+        with self._condition:
+            lines = [
+                "# HELP construct_ai_llm_concurrency_limit Current limit on simultaneous LLM requests.",
+                "# TYPE construct_ai_llm_concurrency_limit gauge",
+                f"construct_ai_llm_concurrency_limit {self.limit}",
+                "# TYPE construct_ai_llm_concurrency_max gauge",
+                f"construct_ai_llm_concurrency_max {self.max_limit}",
+                "# TYPE construct_ai_llm_in_flight gauge",
+                f"construct_ai_llm_in_flight {self.in_flight}",
+            ]
+            if self.adaptive:
+                lines.append("# HELP construct_ai_llm_concurrency_decisions_total Adaptive limiter decisions.")
+                lines.append("# TYPE construct_ai_llm_concurrency_decisions_total counter")
+                for decision, count in self.decisions.items():
+                    lines.append(f'construct_ai_llm_concurrency_decisions_total{{decision="{decision}"}} {count}')
+                if self.last_ttft_p90 is not None:
+                    lines.append("# TYPE construct_ai_llm_window_ttft_p90_seconds gauge")
+                    lines.append(f"construct_ai_llm_window_ttft_p90_seconds {self.last_ttft_p90:.6f}")
+                if self.last_throughput is not None:
+                    lines.append("# TYPE construct_ai_llm_window_tokens_per_second gauge")
+                    lines.append(f"construct_ai_llm_window_tokens_per_second {self.last_throughput:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> str:
+        with self._condition:
+            if not self.adaptive:
+                return f"LLM concurrency: fixed at {self.limit}."
+            return (f"LLM concurrency: limit {self.limit} of {self.max_limit}; "
+                    + ", ".join(f"{count} {decision}" for decision, count in self.decisions.items())
+                    + " decision(s).")
+
+# Slot held by the current thread's LLM request, so retried failures reach the limiter
+_current_llm_slot: "contextvars.ContextVar[Optional[LLMSlot]]" = contextvars.ContextVar("construct_ai_llm_slot", default=None)
+
+def note_llm_error():
+    """Counts a transient request failure against the adaptive limiter"""
+    slot = _current_llm_slot.get()
+    if slot is not None:
+        slot.errors += 1
+
+def llm_backoff(delay: float):
+    """
+    Waits before a retry. A slot held by this thread is released meanwhile,
+    so one failing request does not keep other documents from the server.
+    """
+    slot = _current_llm_slot.get()
+    if slot is None or slot.limiter is None:
+        time.sleep(delay)
+    else:
+        slot.limiter.pause(delay)
+
+# Semaphore held by the current task's async LLM request, released while it backs off
+_current_llm_semaphore: "contextvars.ContextVar[Optional[asyncio.Semaphore]]" = contextvars.ContextVar(
+    "construct_ai_llm_semaphore", default=None)
+
+async def llm_backoff_async(delay: float):
+    """Async counterpart of llm_backoff for the semaphore passed to get_llm_response_async"""
+    semaphore = _current_llm_semaphore.get()
+    if semaphore is None:
+        await asyncio.sleep(delay)
+        return
+    semaphore.release()
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        # Shielded so that a cancelled task still leaves the count balanced for its async with
+        await asyncio.shield(semaphore.acquire())
+
+_llm_slots: Optional[ConcurrencyLimiter] = None
+_shared_state_lock = threading.Lock()
+
+def get_llm_slots() -> ConcurrencyLimiter:
+    """Returns the process-wide limiter that bounds in-flight LLM requests"""
+    global _llm_slots
+    with _shared_state_lock:
+        if _llm_slots is None:
+            _llm_slots = ConcurrencyLimiter(MAX_CONCURRENT_LLM_REQUESTS, ADAPTIVE_CONCURRENCY, ADAPTIVE_INITIAL_LIMIT)
+        return _llm_slots
+
+def map_in_parallel(func, items: List[Any], max_workers: Optional[int] = None) -> List[Any]:
+    """
+    Applies func to every item on a thread pool and returns the results in input
+    order. Worker threads inherit the caller's DocumentLogRouter tag so their
+    output stays attributed to the right document.
+    """
+    workers = max_workers or MAX_CONCURRENT_LLM_REQUESTS
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    router = sys.stdout if isinstance(sys.stdout, DocumentLogRouter) else None
+    tag = router.get_tag() if router else None
+    parent_span = _current_span.get()
+    routing_key = _routing_key.get()
+
+    def run(item):
+        if router:
+            router.set_tag(tag)
+        _current_span.set(parent_span)
+        _routing_key.set(routing_key)
+        try:
+            return func(item)
+        finally:
+            _current_span.set(None)
+            _routing_key.set(None)
+            if router:
+                router.set_tag(None)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix="llm") as executor:
+        return list(executor.map(run, items))
+
+# Document the current thread or asyncio task is summarizing, for sticky endpoint routing
+_routing_key: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("construct_ai_routing_key", default=None)
+
+# Tag of the document the current thread or asyncio task is working on
+_log_tag: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("construct_ai_log_tag", default=None)
+
+class DocumentLogRouter:
+    """
+    Stand-in for sys.stdout while several documents are processed at once.
+    Every complete line printed from a worker thread or asyncio task is
+    prefixed with the tag of the document it is working on, so interleaved
+    output stays attributable. Untagged output is written through unchanged.
+    """
+
+    def __init__(self, stream: Any):
+        self._stream = stream
+        self._pending: Dict[Tuple[int, str], str] = {}
+        self._lock = threading.Lock()
+
+    def set_tag(self, tag: Optional[str]):
+        self.flush_pending()
+        _log_tag.set(tag)
+
+    def get_tag(self) -> Optional[str]:
+        return _log_tag.get()
+
+    def write(self, data: str) -> int:
+        tag = self.get_tag()
+        if tag is None:
+            with self._lock:
+                return self._stream.write(data)
+
+        key = (threading.get_ident(), tag)
+        with self._lock:
+            *lines, rest = (self._pending.pop(key, "") + data).split("\n")
+            if rest:
+                self._pending[key] = rest
+            if lines:
+                self._stream.write("".join(f"[{tag}] {line}\n" for line in lines))
+        return len(data)
+
+    def flush_pending(self):
+        tag = self.get_tag()
+        if tag is None:
+            return
+        with self._lock:
+            rest = self._pending.pop((threading.get_ident(), tag), None)
+            if rest:
+                self._stream.write(f"[{tag}] {rest}\n")
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+# =============================================================================
+# INSTRUMENTATION
+# =============================================================================
+
+@dataclass
+class SpanContext:
+    span_id: int
+    document: Optional[str]
+
+# Innermost span of the current thread or asyncio task; new spans become its children
+_current_span: "contextvars.ContextVar[Optional[SpanContext]]" = contextvars.ContextVar("construct_ai_span", default=None)
+
+class _NullSpan:
+    """Returned by trace_span() while tracing is off, so instrumented code costs next to nothing"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    """
+    A timed pipeline stage. Measurements known only once the work is done are
+    added with set(). Usable across yields in the step generators: the parent
+    span is restored with a plain set() rather than a context token.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, document: Optional[str], attrs: Dict[str, Any]):
+        self._tracer = tracer
+        self.name = name
+        self.document = document
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self._parent = _current_span.get()
+        if self.document is None and self._parent is not None:
+            self.document = self._parent.document
+        self.span_id = self._tracer.next_span_id()
+        _current_span.set(SpanContext(self.span_id, self.document))
+        self._wall_start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        _current_span.set(self._parent)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self._tracer.record({
+            "ts": round(self._wall_start, 6),
+            "span": self.name,
+            "duration_seconds": round(duration, 6),
+            "document": self.document,
+            "span_id": self.span_id,
+            "parent_id": self._parent.span_id if self._parent else None,
+            "thread": threading.current_thread().name,
+            **self.attrs,
+        })
+        return False
+
+class Tracer:
+    """
+    Collects finished spans: each one is appended to the JSONL trace file and
+    folded into per-stage totals that write_metrics() dumps in the Prometheus
+    text format. Numeric attributes listed in SUMMED_ATTRIBUTES are totalled
+    per stage; attributes ending in _seconds are exported as summaries.
+    """
+
+    SUMMED_ATTRIBUTES = (
+        "chars", "bytes", "cached", "text_cache_hit", "prompt_tokens", "evaluated_prompt_tokens",
+        "output_tokens", "tokens_before", "tokens_after", "wait_seconds", "ttft_seconds",
+        "prompt_eval_seconds", "generation_seconds", "load_seconds",
+    )
+
+    def __init__(self, trace_path: str, buckets: Sequence[float]):
+        self.trace_path = trace_path
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._file = None
+        self._durations: Dict[str, List[float]] = {}
+        self._bucket_counts: Dict[str, List[int]] = {}
+        self._errors: Dict[str, int] = {}
+        self._totals: Dict[Tuple[str, str], List[float]] = {}
+
+    def next_span_id(self) -> int:
+        with self._lock:
+            self._last_id += 1
+            return self._last_id
+
+    def record(self, span: Dict[str, Any]):
+        name, duration = span["span"], span["duration_seconds"]
+        line = json.dumps({"run": self.run_id, **span}, default=str)
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.trace_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.trace_path, "a", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+            totals = self._durations.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+            counts = self._bucket_counts.setdefault(name, [0] * len(self.buckets))
+            for i in range(bisect_left(self.buckets, duration), len(self.buckets)):
+                counts[i] += 1
+            if "error" in span:
+                self._errors[name] = self._errors.get(name, 0) + 1
+            for attr in self.SUMMED_ATTRIBUTES:
+                value = span.get(attr)
+                if isinstance(value, (int, float)):
+                    total = self._totals.setdefault((name, attr), [0, 0.0])
+                    total[0] += 1
+                    total[1] += value
+
+    def event(self, name: str, **attrs: Any):
+        """Records a point-in-time event as a zero-length span under the current one"""
+        parent = _current_span.get()
+        self.record({
+            "ts": round(time.time(), 6),
+            "span": name,
+            "duration_seconds": 0.0,
+            "document": parent.document if parent else None,
+            "span_id": self.next_span_id(),
+            "parent_id": parent.span_id if parent else None,
+            "thread": threading.current_thread().name,
+            **attrs,
+        })
+
+    def render_metrics(self) -> str:
+        """Renders the totals collected so far in the Prometheus text exposition format"""
+        def label(stage: str, **extra: str) -> str:
+            pairs = [f'stage="{stage}"'] + [f'{key}="{value}"' for key, value in extra.items()]
+            return "{" + ",".join(pairs) + "}"
+
+        lines = [
+            "# HELP construct_ai_stage_duration_seconds Wall time spent per pipeline stage.",
+            "# TYPE construct_ai_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self._durations):
+                count, total = self._durations[stage]
+                for bound, bucket_count in zip(self.buckets, self._bucket_counts[stage]):
+                    lines.append(f"construct_ai_stage_duration_seconds_bucket{label(stage, le=f'{bound:g}')} {bucket_count}")
+                lines.append(f"construct_ai_stage_duration_seconds_bucket{label(stage, le='+Inf')} {count}")
+                lines.append(f"construct_ai_stage_duration_seconds_sum{label(stage)} {total:.6f}")
+                lines.append(f"construct_ai_stage_duration_seconds_count{label(stage)} {count}")
+
+            lines.append("# HELP construct_ai_stage_errors_total Stages that ended with an exception.")
+            lines.append("# TYPE construct_ai_stage_errors_total counter")
+            for stage in sorted(self._errors):
+                lines.append(f"construct_ai_stage_errors_total{label(stage)} {self._errors[stage]}")
+
+            for attr in self.SUMMED_ATTRIBUTES:
+                stages = sorted(stage for stage, name in self._totals if name == attr)
+                if not stages:
+                    continue
+                if attr.endswith("_seconds"):
+                    lines.append(f"# TYPE construct_ai_{attr} summary")
+                    for stage in stages:
+                        count, total = self._totals[(stage, attr)]
+                        lines.append(f"construct_ai_{attr}_sum{label(stage)} {total:.6f}")
+                        lines.append(f"construct_ai_{attr}_count{label(stage)} {count}")
+                else:
+                    lines.append(f"# TYPE construct_ai_{attr}_total counter")
+                    for stage in stages:
+                        lines.append(f"construct_ai_{attr}_total{label(stage)} {self._totals[(stage, attr)][1]:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path: str, extra: str = ""):
+        write_text_atomic(path, self.render_metrics() + extra)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+_tracer: Optional[Tracer] = None
+
+def get_tracer() -> Tracer:
+    global _tracer
+    with _shared_state_lock:
+        if _tracer is None:
+            _tracer = Tracer(TRACE_FILE or os.path.join(CACHE_DIR, "trace.jsonl"), TRACE_DURATION_BUCKETS)
+        return _tracer
+
+def trace_span(name: str, document: Optional[str] = None, **attrs: Any) -> Union[Span, _NullSpan]:
+    """
+    Times the enclosed block as one pipeline stage when TRACE_ENABLED is set:
+        with trace_span("read_file", file_type=file_type) as span:
+            ...
+            span.set(chars=len(text))
+    """
+    if not TRACE_ENABLED:
+        return _NULL_SPAN
+    return Span(get_tracer(), name, document, attrs)
+
+def trace_event(name: str, **attrs: Any):
+    """Records a point-in-time event (see Tracer.event) when TRACE_ENABLED is set"""
+    if TRACE_ENABLED:
+        get_tracer().event(name, **attrs)
+
+def write_trace_metrics() -> Optional[str]:
+    """Writes the Prometheus metrics dump for this run and returns its path, if tracing is on"""
+    if not TRACE_ENABLED:
+        return None
+    path = METRICS_FILE or os.path.join(CACHE_DIR, "metrics.prom")
+    tracer = get_tracer()
+    tracer.write_metrics(path, get_llm_slots().render_metrics())
+    return path
+
+# =============================================================================
+# PERSISTENT CACHES
+# =============================================================================
+
+def write_text_atomic(path: str, content: Union[str, Iterable[str]], compress: bool = False):
+    """
+    Writes content (a string, or pieces written one at a time) to a temporary
+    file next to path, gzip-compressed if asked, then renames it into place
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    pieces = [content] if isinstance(content, str) else content
+    try:
+        with open(tmp_path, 'wb') as file:
+            if compress:
+                with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=6) as stream:
+                    for piece in pieces:
+                        stream.write(piece.encode('utf-8'))
+            else:
+                for piece in pieces:
+                    file.write(piece.encode('utf-8'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def open_sqlite(path: str) -> sqlite3.Connection:
+    """Opens a SQLite database configured for access from several processes"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=60000")
+    return conn
+
+class SQLiteStore:
+    """Base for the on-disk stores: one connection per thread, schema applied on open"""
+
+    SCHEMA: List[str] = []
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = open_sqlite(self.path)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write_transaction(self) -> Iterator[sqlite3.Connection]:
+        """Immediate (write-locked) transaction, committed on success and rolled back on error"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+class LLMResponseCache(SQLiteStore):
+    """
+    Content-addressed on-disk cache for get_llm_response results.
+
+    Entries are keyed by a SHA-256 of the model name, sampling options and
+    messages, so only byte-identical requests hit. The database runs in WAL mode
+    and writers take an immediate lock, which makes it safe to share between
+    several processes. Once the stored responses exceed max_bytes the least
+    recently used ones are evicted.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)",
+    ]
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._counter_lock = threading.Lock()
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(model: Optional[str], options: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        material = json.dumps(
+            {"model": model, "options": options, "messages": messages},
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connection()
+        row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        with self._counter_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, model: Optional[str], response: str):
+        conn = self._connection()
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now)
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                for old_key, old_size in conn.execute(
+                    "SELECT key, size FROM responses WHERE key != ? ORDER BY last_access ASC", (key,)
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= old_size
+                    evicted += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if evicted:
+            with self._counter_lock:
+                self.evictions += evicted
+
+    def clear(self):
+        self._connection().execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, int]:
+        entries, total = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+        }
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """Returns the shared response cache, or None when caching is switched off"""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _shared_state_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache(os.path.join(CACHE_DIR, "llm_responses.sqlite3"), LLM_CACHE_MAX_BYTES)
+        return _llm_cache
+
+class DocumentCheckpoint:
+    """
+    Summarization progress for one document, stored as JSON under
+    CACHE_DIR/checkpoints. The file name is derived from the document text and
+    model, so an edited document or a different model starts fresh. Every update
+    is written atomically, which keeps the last completed step even if the
+    process is killed mid-write.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.state: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    self.state = json.load(file)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Warning: ignoring unreadable checkpoint {path}: {e}")
+                self.state = {}
+
+    @classmethod
+    def for_text(cls, text: str) -> "DocumentCheckpoint":
+        if not CHECKPOINTS_ENABLED:
+            return cls(None)
+        digest = hashlib.sha256(f"{MODEL_NAME}\0{text}".encode('utf-8')).hexdigest()
+        return cls(os.path.join(CACHE_DIR, "checkpoints", f"{digest}.json"))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.state.get(key, default)
+
+    def update(self, **fields: Any):
+        with self._lock:
+            self.state.update(fields)
+            if self.path:
+                write_text_atomic(self.path, json.dumps(self.state, ensure_ascii=False))
+
+    def reset_progress(self, plan: Dict[str, Any]):
+        """Drops chunk progress recorded under a different chunking plan"""
+        if self.state.get("plan") != plan:
+            structure = self.state.get("structure")
+            self.state = {"plan": plan}
+            if structure is not None:
+                self.state["structure"] = structure
+
+    def delete(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's contents, read in blocks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileCache:
+    """
+    Gzip-compressed files under one directory, used least recently used first:
+    hits refresh a file's mtime, and the oldest files are removed once the
+    directory grows past max_bytes. The size is counted as files are written,
+    so the directory is only scanned on the first write and when the count
+    crosses the limit (which also picks up files other processes wrote).
+    """
+
+    SUFFIX = ".gz"
+    DESCRIPTION = "cache entry"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    def _load(self, path: str, parse: Callable[[str], Any]) -> Optional[Any]:
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                value = parse(file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            print(f"Warning: discarding unreadable {self.DESCRIPTION} {path}: {e}")
+            # Another worker may have discarded it already
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            return None
+        with suppress(FileNotFoundError):
+            os.utime(path)
+        return value
+
+    def _store(self, path: str, content: Union[str, Iterable[str]]):
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        write_text_atomic(path, content, compress=True)
+        try:
+            written = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += written - replaced
+            if self._total_bytes > self.max_bytes:
+                self._enforce_limit()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(self.SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _enforce_limit(self):
+        """Called with the lock held"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._total_bytes = total
+
+    def clear(self) -> int:
+        """Removes every cached file and returns how many were deleted"""
+        removed = 0
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    continue
+            self._total_bytes = None
+        return removed
+
+class ExtractedTextCache(FileCache):
+    """
+    Sidecar files holding extracted document text, named after the source's
+    content hash and the extractor version
+    """
+
+    SUFFIX = ".txt.gz"
+    DESCRIPTION = "text cache entry"
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash[:2], f"{content_hash}-{EXTRACTOR_VERSION}.txt.gz")
+
+    def get(self, content_hash: str) -> Optional[str]:
+        return self._load(self._path(content_hash), str)
+
+    def put(self, content_hash: str, text: str):
+        self._store(self._path(content_hash), text)
+
+_text_cache: Optional[ExtractedTextCache] = None
+
+def get_text_cache() -> Optional[ExtractedTextCache]:
+    global _text_cache
+    if not TEXT_CACHE_ENABLED:
+        return None
+    with _shared_state_lock:
+        if _text_cache is None:
+            _text_cache = ExtractedTextCache(os.path.join(CACHE_DIR, "text"), TEXT_CACHE_MAX_BYTES)
+        return _text_cache
+
+def clear_text_cache():
+    """Deletes all cached extracted text"""
+    removed = ExtractedTextCache(os.path.join(CACHE_DIR, "text"), TEXT_CACHE_MAX_BYTES).clear()
+    print(f"Removed {removed} cached text file(s) from {os.path.join(CACHE_DIR, 'text')}.")
+
+@dataclass
+class ManifestEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    content_hash: Optional[str]
+    model: Optional[str]
+    prompt_version: Optional[str]
+    summary_path: Optional[str]
+
+class SourceManifest(SQLiteStore):
+    """
+    Records every summarized source with its size, mtime, content hash and the
+    model and prompt version used, so discovery can diff a directory scan
+    against it instead of probing for summary files one by one.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            content_hash TEXT,
+            model TEXT,
+            prompt_version TEXT,
+            summary_path TEXT,
+            updated_at REAL NOT NULL
+        )""",
+    ]
+
+    def load(self) -> Dict[str, ManifestEntry]:
+        rows = self._connection().execute(
+            "SELECT path, size, mtime_ns, content_hash, model, prompt_version, summary_path FROM sources"
+        )
+        return {row[0]: ManifestEntry(*row) for row in rows}
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        row = self._connection().execute(
+            "SELECT path, size, mtime_ns, content_hash, model, prompt_version, summary_path FROM sources WHERE path = ?",
+            (path,)
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def upsert_many(self, entries: List[ManifestEntry]):
+        if not entries:
+            return
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sources (path, size, mtime_ns, content_hash, model, prompt_version, summary_path, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(e.path, e.size, e.mtime_ns, e.content_hash, e.model, e.prompt_version, e.summary_path, now) for e in entries]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove_many(self, paths: List[str]):
+        if paths:
+            conn = self._connection()
+            conn.executemany("DELETE FROM sources WHERE path = ?", [(p,) for p in paths])
+
+    def record(self, source_path: str, summary_path: str, content_hash: Optional[str] = None,
+               stat: Optional[os.stat_result] = None):
+        """
+        Marks source_path as summarized with the current model and prompt
+        version. Pass the stat taken before content_hash was computed (and the
+        file read), so an edit made while it was being summarized shows up as
+        a change on the next scan instead of being recorded as summarized.
+        """
+        if stat is None or content_hash is None:
+            stat = os.stat(source_path)
+            content_hash = hash_file(source_path)
+        self.upsert_many([ManifestEntry(
+            os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns,
+            content_hash, MODEL_NAME, PROMPT_VERSION, summary_path
+        )])
+
+_source_manifest: Optional[SourceManifest] = None
+
+def get_source_manifest() -> SourceManifest:
+    global _source_manifest
+    with _shared_state_lock:
+        if _source_manifest is None:
+            _source_manifest = SourceManifest(os.path.join(CACHE_DIR, "manifest.sqlite3"))
+        return _source_manifest
+
+# =============================================================================
+# OLLAMA CLIENT
+# =============================================================================
+
+class RetryableServerError(requests.RequestException):
+    """A 5xx/429 response or a transient error reported inside the response stream"""
+
+# Errors reported inside a response stream that retrying cannot fix
+_PERMANENT_STREAM_ERRORS = ("not found", "invalid", "unsupported", "does not support", "is required", "unknown")
+
+def stream_error(message: str) -> requests.RequestException:
+    """The exception for an error line in a chat stream: retryable unless the request itself is at fault"""
+    text = f"server error during stream: {message}"
+    if any(marker in str(message).lower() for marker in _PERMANENT_STREAM_ERRORS):
+        return requests.HTTPError(text)
+    return RetryableServerError(text)
+
+class ChatStream:
+    """Collects the newline-delimited JSON lines of a streamed /api/chat response"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.parts: List[str] = []
+        self.stats: Dict[str, Any] = {}
+
+    def feed(self, line: bytes):
+        if not line.strip():
+            return
+        try:
+            json_line = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        if "error" in json_line:
+            raise stream_error(json_line["error"])
+        content = json_line.get("message", {}).get("content")
+        if content:
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self.started
+            self.parts.append(content)
+        if json_line.get("done"):
+            self.stats = json_line
+
+    def result(self) -> "ChatResult":
+        return ChatResult("".join(self.parts), self.stats, self.ttft, time.perf_counter() - self.started)
+
+def retry_backoff(attempt: int) -> float:
+    """Delay before retry attempt+1 of a server request: exponential backoff with full jitter"""
+    return random.uniform(0, min(OLLAMA_BACKOFF_MAX, OLLAMA_BACKOFF_BASE * (2 ** attempt)))
+
+_RETRYABLE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    RetryableServerError,
+)
+
+@dataclass
+class ChatResult:
+    content: str
+    # Final statistics reported by the server (prompt_eval_count, eval_count, durations in ns)
+    stats: Dict[str, Any]
+    # Measured by the client for the attempt that succeeded
+    ttft_seconds: Optional[float] = None
+    elapsed_seconds: float = 0.0
+
+    def trace_attributes(self) -> Dict[str, Any]:
+        """Token counts and timings for the llm_call span, preferring the server's own figures"""
+        stats = self.stats
+        attrs: Dict[str, Any] = {"ttft_seconds": self.ttft_seconds}
+        if "eval_count" in stats:
+            attrs["output_tokens"] = stats["eval_count"]
+            attrs["generation_seconds"] = stats.get("eval_duration", 0) / 1e9
+        else:
+            attrs["output_tokens"] = count_tokens(self.content)
+            attrs["generation_seconds"] = self.elapsed_seconds - (self.ttft_seconds or 0.0)
+        if "prompt_eval_count" in stats:
+            attrs["evaluated_prompt_tokens"] = stats["prompt_eval_count"]
+            attrs["prompt_eval_seconds"] = stats.get("prompt_eval_duration", 0) / 1e9
+        if "load_duration" in stats:
+            attrs["load_seconds"] = stats["load_duration"] / 1e9
+        if attrs["generation_seconds"] > 0:
+            attrs["tokens_per_sec"] = round(attrs["output_tokens"] / attrs["generation_seconds"], 2)
+        return attrs
+
+class OllamaClient:
+    """
+    HTTP client for one Ollama endpoint. Holds a pooled requests.Session so
+    connections are reused across calls and threads, applies connect/read
+    timeouts, and retries transient failures with exponential backoff and
+    jitter. A streamed chat that fails midway is restarted from the beginning.
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 10):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+
+    def _with_retries(self, description: str, operation, max_retries: Optional[int] = None):
+        max_retries = OLLAMA_MAX_RETRIES if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            try:
+                return operation()
+            except _RETRYABLE_ERRORS as e:
+                note_llm_error()
+                if attempt >= max_retries:
+                    raise
+                delay = retry_backoff(attempt)
+                print(f"Warning: {description} failed ({e}); retry {attempt+1}/{max_retries} in {delay:.1f}s")
+                llm_backoff(delay)
+
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        if response.status_code >= 500 or response.status_code == 429:
+            body = response.text[:200]
+            response.close()
+            raise RetryableServerError(f"{response.status_code} from {path}: {body}")
+        response.raise_for_status()
+        return response
+
+    def get_json(self, path: str) -> Dict[str, Any]:
+        return self._with_retries(f"GET {path}", lambda: self._send("GET", path).json())
+
+    def post_json(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self._with_retries(f"POST {path}", lambda: self._send("POST", path, json=payload).json())
+
+    def list_models(self) -> List[str]:
+        return [model['name'] for model in self.get_json("/api/tags").get('models', [])]
+
+    def warm_up(self, model_name: str) -> Dict[str, Any]:
+        """Loads the model (an empty /api/generate request) and resets its keep_alive timer"""
+        return self.post_json("/api/generate", {"model": model_name, "keep_alive": OLLAMA_KEEP_ALIVE, "stream": False})
+
+    def _stream_chat_once(self, payload: Dict[str, Any]) -> ChatResult:
+        stream = ChatStream()
+        with self._send("POST", "/api/chat", json=payload, stream=True) as response:
+            for line in response.iter_lines(chunk_size=8192):
+                stream.feed(line)
+        return stream.result()
+
+    def probe(self, model_name: Optional[str]) -> Optional[str]:
+        """One health check without retries: returns None if healthy, else the problem"""
+        try:
+            with self.session.get(f"{self.base_url}/api/tags", timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_CONNECT_TIMEOUT)) as response:
+                response.raise_for_status()
+                models = [model['name'] for model in response.json().get('models', [])]
+        except requests.ConnectionError:
+            return "unreachable"
+        except (requests.RequestException, ValueError) as e:
+            return str(e)
+        if model_name and model_name not in models:
+            return f"model {model_name} not available"
+        return None
+
+    def chat(self, payload: Dict[str, Any], max_retries: Optional[int] = None) -> ChatResult:
+        """Sends a streaming /api/chat request and returns the full response text and server stats"""
+        return self._with_retries("chat request", lambda: self._stream_chat_once(payload), max_retries)
+
+_ollama_clients: Dict[str, OllamaClient] = {}
+
+def get_ollama_client(base_url: str) -> OllamaClient:
+    """Returns the shared client for base_url, creating it on first use"""
+    with _shared_state_lock:
+        client = _ollama_clients.get(base_url)
+        if client is None:
+            pool_size = max(10, MAX_CONCURRENT_LLM_REQUESTS * 2)
+            client = _ollama_clients[base_url] = OllamaClient(base_url, pool_size=pool_size)
+        return client
+
+class AsyncOllamaClient:
+    """
+    Asyncio counterpart of OllamaClient for /api/chat, built on asyncio streams
+    so it needs no extra dependency. Use get_async_ollama_client() to share one
+    client per server: connections are kept alive and reused (per event loop,
+    up to ASYNC_MAX_IDLE_CONNECTIONS idle). Cancelling the awaiting task closes
+    the socket, which makes the server stop generating. Timeouts and retries
+    follow the same settings as the blocking client.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip('/')
+        parts = urlsplit(self.base_url)
+        self._host = parts.hostname or "127.0.0.1"
+        self._use_ssl = parts.scheme == "https"
+        self._port = parts.port or (443 if self._use_ssl else 80)
+        self._path_prefix = parts.path.rstrip('/')
+        # Streams belong to the event loop that opened them, so idle connections are kept per loop
+        self._idle: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]]" = weakref.WeakKeyDictionary()
+        self._idle_lock = threading.Lock()
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """An idle keep-alive connection if there is one, else a new connection; the flag tells which"""
+        loop = asyncio.get_running_loop()
+        with self._idle_lock:
+            idle = self._idle.get(loop, [])
+            while idle:
+                reader, writer = idle.pop()
+                if not writer.is_closing() and not reader.at_eof():
+                    return reader, writer, True
+                writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self._host, self._port, ssl=self._use_ssl or None),
+            OLLAMA_CONNECT_TIMEOUT
+        )
+        return reader, writer, False
+
+    def _keep_idle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        with self._idle_lock:
+            idle = self._idle.setdefault(asyncio.get_running_loop(), [])
+            if len(idle) < ASYNC_MAX_IDLE_CONNECTIONS:
+                idle.append((reader, writer))
+                return
+        writer.close()
+
+    @staticmethod
+    async def _close(writer: asyncio.StreamWriter):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def aclose(self):
+        """Closes the idle connections held for the running event loop"""
+        with self._idle_lock:
+            idle = self._idle.pop(asyncio.get_running_loop(), [])
+        for _, writer in idle:
+            await self._close(writer)
+
+    async def _read_line(self, reader: asyncio.StreamReader) -> bytes:
+        return await asyncio.wait_for(reader.readline(), OLLAMA_READ_TIMEOUT)
+
+    async def _iter_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]):
+        """Yields raw body bytes, decoding chunked transfer encoding"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._read_line(reader)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    await self._read_line(reader)
+                    return
+                data = await asyncio.wait_for(reader.readexactly(size + 2), OLLAMA_READ_TIMEOUT)
+                yield data[:-2]
+        elif "content-length" in headers:
+            yield await asyncio.wait_for(reader.readexactly(int(headers["content-length"])), OLLAMA_READ_TIMEOUT)
+        else:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), OLLAMA_READ_TIMEOUT)
+                if not data:
+                    return
+                yield data
+
+    async def _stream_chat_once(self, payload: Dict[str, Any]) -> ChatResult:
+        stream = ChatStream()
+        body = json.dumps(payload).encode('utf-8')
+        request = (
+            f"POST {self._path_prefix}/api/chat HTTP/1.1\r\n"
+            f"Host: {self._host}:{self._port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n".encode('ascii') + body
+        )
+        while True:
+            reader, writer, reused = await self._connect()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await self._read_line(reader)
+            except BaseException as e:
+                await self._close(writer)
+                if reused and isinstance(e, (OSError, asyncio.IncompleteReadError)):
+                    continue
+                raise
+            if status_line or not reused:
+                break
+            # The server closed the idle connection in the meantime; use a fresh one
+            await self._close(writer)
+
+        keep_alive = False
+        try:
+            if not status_line:
+                raise ConnectionError("connection closed before response")
+            version, status = status_line.split()[0], int(status_line.split()[1])
+            headers: Dict[str, str] = {}
+            while True:
+                header_line = (await self._read_line(reader)).decode('latin-1').strip()
+                if not header_line:
+                    break
+                name, _, value = header_line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if status >= 400:
+                error_body = b"".join([piece async for piece in self._iter_body(reader, headers)])[:200]
+                message = f"{status} from /api/chat: {error_body.decode('utf-8', 'replace')}"
+                if status >= 500 or status == 429:
+                    raise RetryableServerError(message)
+                raise requests.HTTPError(message)
+
+            buffer = b""
+            async for piece in self._iter_body(reader, headers):
+                buffer += piece
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    stream.feed(line)
+            # The last line need not end with a newline
+            stream.feed(buffer)
+            # The whole body was read, so the connection can carry the next request
+            keep_alive = (version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                          and ("content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"))
+            return stream.result()
+        finally:
+            if keep_alive:
+                self._keep_idle(reader, writer)
+            else:
+                await self._close(writer)
+
+    async def chat(self, payload: Dict[str, Any], max_retries: Optional[int] = None) -> ChatResult:
+        """Sends a streaming /api/chat request and returns the full response text and server stats"""
+        max_retries = OLLAMA_MAX_RETRIES if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            try:
+                return await self._stream_chat_once(payload)
+            except requests.HTTPError:
+                # A RequestException is an OSError, but a rejected request is not worth retrying
+                raise
+            except _ASYNC_RETRYABLE_ERRORS as e:
+                if attempt >= max_retries:
+                    raise
+                delay = retry_backoff(attempt)
+                print(f"Warning: chat request failed ({e!r}); retry {attempt+1}/{max_retries} in {delay:.1f}s")
+                await llm_backoff_async(delay)
+
+_ASYNC_RETRYABLE_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RetryableServerError)
+
+_async_clients: Dict[str, AsyncOllamaClient] = {}
+
+def get_async_ollama_client(base_url: str) -> AsyncOllamaClient:
+    """The shared AsyncOllamaClient for a server, so its connections are reused across calls"""
+    key = base_url.rstrip('/')
+    with _shared_state_lock:
+        client = _async_clients.get(key)
+        if client is None:
+            client = _async_clients[key] = AsyncOllamaClient(key)
+        return client
+
+async def close_async_clients():
+    """Closes the idle connections of every shared async client on the running loop; call before the loop ends"""
+    with _shared_state_lock:
+        clients = list(_async_clients.values())
+    for client in clients:
+        await client.aclose()
+
+# =============================================================================
+# ENDPOINT POOL
+# =============================================================================
+
+@dataclass(eq=False)
+class Endpoint:
+    url: str
+    healthy: bool = True
+    in_flight: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    eject_seconds: float = 0.0
+    requests: int = 0
+    failures: int = 0
+    ejections: int = 0
+    last_error: Optional[str] = None
+
+class EndpointPool:
+    """
+    Spreads LLM requests over BASE_URL and OLLAMA_ENDPOINTS. Each request goes
+    to the healthy endpoint with the fewest requests in flight from this
+    process, except that a document keeps using the endpoint that served its
+    previous request while that one is not much busier, so its prompt prefix
+    stays cached there. Endpoints are ejected after ENDPOINT_FAILURE_THRESHOLD
+    consecutive failures or a failed health check (/api/tags unreachable or
+    without MODEL_NAME), and restored once a later check passes. A failed
+    request is retried on another endpoint straight away when there is one.
+    With a single endpoint, requests go to it directly as before.
+    """
+
+    # Documents remembered for sticky routing
+    MAX_AFFINITIES = 4096
+
+    def __init__(self, urls: List[str], model_name: Optional[str]):
+        self.endpoints = [Endpoint(url.rstrip('/')) for url in urls]
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._affinity: "OrderedDict[str, Endpoint]" = OrderedDict()
+        self._health_thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    # --- health ---
+
+    def _eject(self, endpoint: Endpoint, reason: str):
+        """Called with the lock held"""
+        endpoint.eject_seconds = min(ENDPOINT_EJECT_MAX_SECONDS, max(ENDPOINT_EJECT_SECONDS, endpoint.eject_seconds * 2))
+        endpoint.ejected_until = time.monotonic() + endpoint.eject_seconds
+        endpoint.last_error = reason
+        if endpoint.healthy:
+            endpoint.healthy = False
+            endpoint.ejections += 1
+            print(f"Warning: endpoint {endpoint.url} ejected ({reason}); "
+                  f"checking again in {endpoint.eject_seconds:.0f}s.")
+
+    def check_health(self, only_due: bool = False):
+        """Probes the endpoints (with only_due, just ejected ones whose wait is over)"""
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if only_due and (endpoint.healthy or now < endpoint.ejected_until):
+                continue
+            problem = get_ollama_client(endpoint.url).probe(self.model_name)
+            with self._lock:
+                if problem is not None:
+                    self._eject(endpoint, problem)
+                elif not endpoint.healthy:
+                    # eject_seconds is kept until a request succeeds, so a flapping endpoint backs off further
+                    endpoint.healthy = True
+                    endpoint.consecutive_failures = 0
+                    print(f"Endpoint {endpoint.url} is healthy again.")
+
+    def _health_loop(self):
+        next_full_check = time.monotonic() + ENDPOINT_HEALTH_INTERVAL
+        while True:
+            time.sleep(1.0)
+            full = time.monotonic() >= next_full_check
+            if full:
+                next_full_check = time.monotonic() + ENDPOINT_HEALTH_INTERVAL
+            self.check_health(only_due=not full)
+
+    def start_health_checks(self):
+        with self._lock:
+            if self._health_thread is None and len(self.endpoints) > 1:
+                self._health_thread = threading.Thread(target=self._health_loop, name="endpoint-health", daemon=True)
+                self._health_thread.start()
+
+    # --- routing ---
+
+    def acquire(self, affinity: Optional[str], avoid: Sequence[Endpoint] = ()) -> Endpoint:
+        """Picks an endpoint for one request and counts it as in flight"""
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.healthy and e not in avoid]
+            if not candidates:
+                candidates = [e for e in self.endpoints if e.healthy]
+            if not candidates:
+                # Everything is ejected: try whichever is due to be probed first
+                candidates = [min(self.endpoints, key=lambda e: e.ejected_until)]
+            chosen = min(candidates, key=lambda e: (e.in_flight, e.requests))
+            sticky = self._affinity.get(affinity) if affinity else None
+            if sticky in candidates and sticky.in_flight <= chosen.in_flight + ENDPOINT_STICKY_SLACK:
+                chosen = sticky
+            if affinity:
+                self._affinity[affinity] = chosen
+                self._affinity.move_to_end(affinity)
+                while len(self._affinity) > self.MAX_AFFINITIES:
+                    self._affinity.popitem(last=False)
+            chosen.in_flight += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, endpoint: Endpoint, error: Optional[BaseException] = None):
+        with self._lock:
+            endpoint.in_flight -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.eject_seconds = 0.0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= ENDPOINT_FAILURE_THRESHOLD and len(self.endpoints) > 1:
+                self._eject(endpoint, f"{endpoint.consecutive_failures} failed requests in a row: {error}")
+
+    def _failover_delay(self, tried: List[Endpoint], attempt: int) -> float:
+        """No wait when another healthy endpoint is left to try, else the usual backoff"""
+        with self._lock:
+            untried = any(e.healthy and e not in tried for e in self.endpoints)
+        return 0.0 if untried else retry_backoff(attempt)
+
+    def chat(self, payload: Dict[str, Any], affinity: Optional[str] = None) -> Tuple[ChatResult, str]:
+        """Sends a chat request through the pool; returns the result and the endpoint that served it"""
+        if len(self.endpoints) == 1:
+            url = self.endpoints[0].url
+            return get_ollama_client(url).chat(payload), url
+        self.start_health_checks()
+        tried: List[Endpoint] = []
+        for attempt in range(OLLAMA_MAX_RETRIES + 1):
+            endpoint = self.acquire(affinity, tried)
+            try:
+                result = get_ollama_client(endpoint.url).chat(payload, max_retries=0)
+            except _RETRYABLE_ERRORS as e:
+                self.release(endpoint, e)
+                tried.append(endpoint)
+                if attempt >= OLLAMA_MAX_RETRIES:
+                    raise
+                delay = self._failover_delay(tried, attempt)
+                print(f"Warning: chat request to {endpoint.url} failed ({e}); "
+                      f"retry {attempt+1}/{OLLAMA_MAX_RETRIES} in {delay:.1f}s")
+                llm_backoff(delay)
+                continue
+            except BaseException:
+                self.release(endpoint)
+                raise
+            self.release(endpoint)
+            return result, endpoint.url
+
+    async def chat_async(self, payload: Dict[str, Any], affinity: Optional[str] = None) -> Tuple[ChatResult, str]:
+        """Async counterpart of chat"""
+        if len(self.endpoints) == 1:
+            url = self.endpoints[0].url
+            return await get_async_ollama_client(url).chat(payload), url
+        self.start_health_checks()
+        tried: List[Endpoint] = []
+        for attempt in range(OLLAMA_MAX_RETRIES + 1):
+            endpoint = self.acquire(affinity, tried)
+            try:
+                result = await get_async_ollama_client(endpoint.url).chat(payload, max_retries=0)
+            except requests.HTTPError:
+                self.release(endpoint)
+                raise
+            except _ASYNC_RETRYABLE_ERRORS as e:
+                self.release(endpoint, e)
+                tried.append(endpoint)
+                if attempt >= OLLAMA_MAX_RETRIES:
+                    raise
+                delay = self._failover_delay(tried, attempt)
+                print(f"Warning: chat request to {endpoint.url} failed ({e!r}); "
+                      f"retry {attempt+1}/{OLLAMA_MAX_RETRIES} in {delay:.1f}s")
+                await llm_backoff_async(delay)
+                continue
+            except BaseException:
+                self.release(endpoint)
+                raise
+            self.release(endpoint)
+            return result, endpoint.url
+
+    def warm_up(self):
+        """Keeps the model loaded on every healthy endpoint"""
+        for endpoint in self.endpoints:
+            if endpoint.healthy:
+                try:
+                    get_ollama_client(endpoint.url).warm_up(self.model_name)
+                except requests.RequestException as e:
+                    print(f"Warning: could not keep the model loaded on {endpoint.url}: {e}")
+
+    def report(self) -> str:
+        with self._lock:
+            lines = ["Endpoints:"]
+            for e in self.endpoints:
+                state = "healthy" if e.healthy else f"ejected ({e.last_error})"
+                lines.append(f"  {e.url}: {e.requests} request(s), {e.failures} failure(s), "
+                             f"{e.ejections} ejection(s), {state}")
+            return "\n".join(lines)
+
+_endpoint_pool: Optional[EndpointPool] = None
+
+def get_endpoint_pool() -> EndpointPool:
+    """The pool of BASE_URL plus OLLAMA_ENDPOINTS, created on first use"""
+    global _endpoint_pool
+    with _shared_state_lock:
+        if _endpoint_pool is None:
+            urls = list(OrderedDict.fromkeys(url.rstrip('/') for url in [BASE_URL] + list(OLLAMA_ENDPOINTS)))
+            _endpoint_pool = EndpointPool(urls, MODEL_NAME)
+        return _endpoint_pool
+
+def routes_through_pool(base_url: str) -> bool:
+    """Requests addressed to BASE_URL are spread over the endpoint pool"""
+    return base_url.rstrip('/') == BASE_URL.rstrip('/')
+
 # =============================================================================
 # CORE SUMMARIZATION FUNCTIONS
 # =============================================================================
 
 def get_available_models(base_url: str) -> List[str]:
     try:
-        response = requests.get(f"{base_url}/api/tags")
-        response.raise_for_status()
-        data = response.json()
-        return [model['name'] for model in data.get('models', [])]
+        return get_ollama_client(base_url).list_models()
     except requests.RequestException as e:
         print(f"Error getting models: {e}")
         return []
 
-def get_llm_response(base_url: str, model_name: Optional[str], prompt: str, images: Optional[List[str]] = None) -> str:
-    payload = {
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt, "images": images}
-        ],
+_model_context_limits: Dict[Tuple[str, Optional[str]], int] = {}
+
+def get_model_context_limit(base_url: str, model_name: Optional[str]) -> int:
+    """Maximum context length of the model as reported by /api/show, cached per server and model"""
+    key = (base_url, model_name)
+    if key in _model_context_limits:
+        return _model_context_limits[key]
+
+    limit = DEFAULT_MODEL_CONTEXT
+    try:
+        info = get_ollama_client(base_url).post_json("/api/show", {"model": model_name, "name": model_name})
+        lengths = [value for name, value in info.get("model_info", {}).items()
+                   if name.endswith(".context_length") and isinstance(value, int)]
+        if lengths:
+            limit = lengths[0]
+        else:
+            print(f"Warning: /api/show did not report a context length for {model_name}; assuming {limit}.")
+    except requests.RequestException as e:
+        print(f"Warning: could not query model details for {model_name} ({e}); assuming context length {limit}.")
+
+    _model_context_limits[key] = limit
+    return limit
+
+def choose_num_ctx(prompt_tokens: int, max_context: int, output_budget: int = NUM_CTX_OUTPUT_BUDGET) -> int:
+    """Smallest bucket that fits the prompt plus output budget, never above max_context"""
+    needed = int(prompt_tokens * NUM_CTX_SAFETY_MARGIN) + output_budget
+    for bucket in sorted(NUM_CTX_BUCKETS):
+        if bucket >= needed:
+            return min(bucket, max_context)
+    if needed > max_context:
+        print(f"Warning: request needs ~{needed} tokens but the model context is {max_context}; the prompt may be truncated.")
+    return max_context
+
+class PrefillStats:
+    """
+    Compares the prompt tokens we send with the tokens the server actually had
+    to evaluate (prompt_eval_count). Ollama skips the prefix it still has in its
+    cache, so the difference, priced at the observed prefill rate, estimates
+    the prefill time saved by the stable prompt layout. The difference is only
+    reported with a real tokenizer: with the character heuristic it would be
+    mostly estimation error.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.evaluated_tokens = 0
+        self.prefill_seconds = 0.0
+
+    def record(self, prompt_tokens: int, stats: Dict[str, Any]):
+        if "prompt_eval_count" not in stats:
+            return
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.evaluated_tokens += stats.get("prompt_eval_count", 0)
+            self.prefill_seconds += stats.get("prompt_eval_duration", 0) / 1e9
+
+    def report(self) -> str:
+        with self._lock:
+            if not self.requests:
+                return "Prefill: no server statistics recorded."
+            if isinstance(get_tokenizer(), HeuristicTokenizer):
+                return (f"Prefill: {self.requests} request(s), {self.evaluated_tokens} prompt tokens evaluated "
+                        f"in {self.prefill_seconds:.1f}s. Prefix-cache reuse is not reported because prompt "
+                        f"tokens are only approximated; set TOKENIZER_PATH to measure it.")
+            reused = max(0, self.prompt_tokens - self.evaluated_tokens)
+            per_token = self.prefill_seconds / self.evaluated_tokens if self.evaluated_tokens else 0.0
+            return (f"Prefill: {self.requests} request(s), {self.prompt_tokens} prompt tokens sent, "
+                    f"{self.evaluated_tokens} evaluated in {self.prefill_seconds:.1f}s; "
+                    f"~{reused} served from the server's prefix cache, saving ~{reused * per_token:.1f}s of prefill.")
+
+prefill_stats = PrefillStats()
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+def build_chat_payload(base_url: str, model_name: Optional[str], prompt: str, images: Optional[List[str]] = None,
+                       output_budget: int = NUM_CTX_OUTPUT_BUDGET, system_prompt: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Builds the /api/chat request. Static instructions belong in system_prompt
+    and the parts that change between calls in prompt, so consecutive requests
+    share the longest possible prefix for the server's prompt cache.
+    """
+    messages = [
+        {"role": "system", "content": system_prompt or DEFAULT_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt, "images": images}
+    ]
+    prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    num_ctx = choose_num_ctx(prompt_tokens, get_model_context_limit(base_url, model_name), output_budget)
+    return {
+        "messages": messages,
         "model": model_name,
         "options": {
-            "num_ctx": 128000,
+            "num_ctx": num_ctx,
             "temperature": 1.0,
             "top_k": 64,
             "top_p": 0.95,
             "min_p": 0.0
         },
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "stream": True
     }
 
-    response = requests.post(f"{base_url}/api/chat", json=payload)
-    response.raise_for_status()
-
-    full_response = ""
-    for line in response.iter_lines():
-        if line:
+def _payload_prompt_tokens(payload: Dict[str, Any]) -> int:
+    return sum(count_tokens(message["content"]) for message in payload["messages"])
+
+def get_llm_response(base_url: str, model_name: Optional[str], prompt: str, images: Optional[List[str]] = None, use_cache: bool = True,
+                     output_budget: int = NUM_CTX_OUTPUT_BUDGET, system_prompt: Optional[str] = None) -> str:
+    payload = build_chat_payload(base_url, model_name, prompt, images, output_budget, system_prompt)
+    prompt_tokens = _payload_prompt_tokens(payload)
+
+    with trace_span("llm_call", prompt_tokens=prompt_tokens, num_ctx=payload["options"]["num_ctx"]) as span:
+        cache = get_llm_cache() if use_cache else None
+        if cache:
+            cache_key = LLMResponseCache.make_key(model_name, payload["options"], payload["messages"])
+            cached = cache.get(cache_key)
+            span.set(cached=cached is not None)
+            if cached is not None:
+                return cached
+
+        waiting = time.perf_counter()
+        with get_llm_slots().slot() as slot:
+            span.set(wait_seconds=time.perf_counter() - waiting)
+            if routes_through_pool(base_url):
+                result, endpoint = get_endpoint_pool().chat(payload, _routing_key.get())
+                span.set(endpoint=endpoint)
+            else:
+                result = get_ollama_client(base_url).chat(payload)
+            slot.record(result.ttft_seconds, result.stats.get("eval_count") or count_tokens(result.content))
+        prefill_stats.record(prompt_tokens, result.stats)
+        span.set(**result.trace_attributes())
+        full_response = result.content
+
+        if cache and full_response:
+            cache.put(cache_key, model_name, full_response)
+
+        return full_response
+
+async def get_llm_response_async(base_url: str, model_name: Optional[str], prompt: str, images: Optional[List[str]] = None,
+                                 use_cache: bool = True, semaphore: Optional[asyncio.Semaphore] = None,
+                                 output_budget: int = NUM_CTX_OUTPUT_BUDGET, system_prompt: Optional[str] = None) -> str:
+    """Async counterpart of get_llm_response; semaphore bounds concurrent backend requests"""
+    if (base_url, model_name) not in _model_context_limits:
+        await asyncio.to_thread(get_model_context_limit, base_url, model_name)
+    payload = build_chat_payload(base_url, model_name, prompt, images, output_budget, system_prompt)
+    prompt_tokens = _payload_prompt_tokens(payload)
+
+    with trace_span("llm_call", prompt_tokens=prompt_tokens, num_ctx=payload["options"]["num_ctx"]) as span:
+        cache = get_llm_cache() if use_cache else None
+        if cache:
+            cache_key = LLMResponseCache.make_key(model_name, payload["options"], payload["messages"])
+            cached = await asyncio.to_thread(cache.get, cache_key)
+            span.set(cached=cached is not None)
+            if cached is not None:
+                return cached
+
+        async def send() -> ChatResult:
+            if not routes_through_pool(base_url):
+                return await get_async_ollama_client(base_url).chat(payload)
+            result, endpoint = await get_endpoint_pool().chat_async(payload, _routing_key.get())
+            span.set(endpoint=endpoint)
+            return result
+
+        if semaphore is None:
+            result = await send()
+        else:
+            waiting = time.perf_counter()
+            async with semaphore:
+                span.set(wait_seconds=time.perf_counter() - waiting)
+                token = _current_llm_semaphore.set(semaphore)
+                try:
+                    result = await send()
+                finally:
+                    _current_llm_semaphore.reset(token)
+        prefill_stats.record(prompt_tokens, result.stats)
+        span.set(**result.trace_attributes())
+        full_response = result.content
+
+        if cache and full_response:
+            await asyncio.to_thread(cache.put, cache_key, model_name, full_response)
+
+        return full_response
+
+def _extract_pdf_page_range(file_path: str, first_page: int, last_page: int) -> List[Tuple[str, Optional[str]]]:
+    """Extracts pages [first_page, last_page) of a PDF as (text, error) pairs; runs in a worker process"""
+    pages = []
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page_num in range(first_page, last_page):
             try:
-                json_line = json.loads(line.decode('utf-8'))
-                if "message" in json_line and "content" in json_line["message"]:
-                    content = json_line["message"]["content"]
-                    if content: 
-                        full_response += content
-            except json.JSONDecodeError: 
-                continue
+                pages.append((pdf_reader.pages[page_num].extract_text() or "", None))
+            except Exception as e:
+                pages.append(("", str(e)))
+    return pages
+
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """Shared process pool for PDF page extraction, started on first use"""
+    global _pdf_executor
+    with _shared_state_lock:
+        if _pdf_executor is None:
+            # "spawn" avoids forking while document and HTTP threads hold locks
+            _pdf_executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_executor
+
+def _discard_pdf_executor(executor: ProcessPoolExecutor):
+    """Drops a broken pool so the next PDF starts a fresh one"""
+    global _pdf_executor
+    with _shared_state_lock:
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_pdf_pages(file_path: str) -> Iterator[str]:
+    """
+    Yields the text of each PDF page in order. Large PDFs are split into page
+    ranges extracted in parallel worker processes, and pages are yielded as soon
+    as their range is done. The summarization pipeline does not consume pages
+    incrementally yet (see read_pdf_file). A range whose worker fails is
+    retried in-process; a page that still fails is reported and yields an
+    empty string instead of failing the document.
+    """
+    with open(file_path, 'rb') as file:
+        num_pages = len(PyPDF2.PdfReader(file).pages)
+
+    step = num_pages if PDF_EXTRACTION_WORKERS <= 1 or num_pages < PDF_PARALLEL_MIN_PAGES else PDF_PAGES_PER_TASK
+    ranges = [(first, min(first + step, num_pages)) for first in range(0, num_pages, max(1, step))]
 
-    return full_response
+    futures = []
+    if len(ranges) > 1:
+        executor = get_pdf_executor()
+        try:
+            futures = [executor.submit(_extract_pdf_page_range, file_path, first, last) for first, last in ranges]
+        except Exception as e:
+            print(f"Warning: parallel PDF extraction unavailable ({e}); extracting in-process.")
+            _discard_pdf_executor(executor)
+            futures = []
+
+    for index, (first, last) in enumerate(ranges):
+        try:
+            if futures:
+                pages = futures[index].result()
+            else:
+                pages = _extract_pdf_page_range(file_path, first, last)
+        except Exception as e:
+            if futures:
+                print(f"Warning: worker failed on pages {first+1}-{last} of {os.path.basename(file_path)} ({e}); retrying in-process.")
+                if isinstance(e, BrokenProcessPool):
+                    _discard_pdf_executor(executor)
+            try:
+                pages = _extract_pdf_page_range(file_path, first, last)
+            except Exception as retry_error:
+                print(f"Warning: could not extract pages {first+1}-{last} of {os.path.basename(file_path)}: {retry_error}")
+                pages = [("", str(retry_error))] * (last - first)
+        for offset, (text, error) in enumerate(pages):
+            if error:
+                print(f"Warning: could not extract page {first+offset+1} of {os.path.basename(file_path)}: {error}")
+            yield text
 
 def read_pdf_file(file_path: str) -> str:
-    """Read text content from a PDF file"""
+    """
+    Read text content from a PDF file. All pages are extracted before this
+    returns: strategy selection, the structure pass, deduplication and
+    checkpoints all work on the whole text, so chunking cannot start before
+    the PDF is fully parsed.
+    """
     try:
-        text_content = ""
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text_content += page.extract_text() + "\n"
-            
-        return text_content.strip()
+        return "\n".join(iter_pdf_pages(file_path)).strip()
     except Exception as e:
         raise Exception(f"Error reading PDF file: {e}")
 
@@ -753,23 +2963,141 @@ def read_text_file(file_path: str) -> str:
     except Exception as e:
         raise Exception(f"Error reading text file: {e}")
 
-def read_file_content(file_path: str, file_type: str, docs_service: Optional[Any] = None) -> str:
-    """Read content from file based on file type"""
+def read_file_content(file_path: str, file_type: str, docs_service: Optional[Any] = None, content_hash: Optional[str] = None) -> str:
+    """
+    Read content from file based on file type. Extracted PDF text is served
+    from the text cache when the source's content hash has been seen before.
+    """
     file_type_lower = file_type.lower()
-    if file_type_lower == 'pdf':
-        return read_pdf_file(file_path)
-    elif file_type_lower == 'txt':
-        return read_text_file(file_path)
-    elif file_type_lower == 'gdoc':
-        if not docs_service:
-            raise Exception("Google Docs service is not available for reading .gdoc files.")
-        return read_gdoc_file(file_path, docs_service)
-    else:
-        raise Exception(f"Unsupported file type: {file_type}")
+    with trace_span("read_file", file_type=file_type_lower) as span:
+        if file_type_lower == 'pdf':
+            cache = get_text_cache()
+            if not cache:
+                text = read_pdf_file(file_path)
+            else:
+                content_hash = content_hash or hash_file(file_path)
+                text = cache.get(content_hash)
+                span.set(text_cache_hit=text is not None)
+                if text is None:
+                    text = read_pdf_file(file_path)
+                    cache.put(content_hash, text)
+                else:
+                    print(f"Loaded extracted text from cache ({len(text)} characters).")
+        elif file_type_lower == 'txt':
+            text = read_text_file(file_path)
+        elif file_type_lower == 'gdoc':
+            if not docs_service:
+                raise Exception("Google Docs service is not available for reading .gdoc files.")
+            text = read_gdoc_file(file_path, docs_service)
+        else:
+            raise Exception(f"Unsupported file type: {file_type}")
+        span.set(chars=len(text))
+        return text
 
-def count_tokens(text: str) -> int:
+class Tokenizer(ABC):
+    """Counts tokens and maps token positions back to character offsets"""
+
+    name = "base"
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        ...
+
+    @abstractmethod
+    def offsets(self, text: str) -> Sequence[int]:
+        """Character offset at which each token of text starts"""
+
+class HeuristicTokenizer(Tokenizer):
     # Simple token approximation: 1 token ≈ 4 characters
-    return len(text) // 4
+    name = "heuristic (4 chars/token)"
+
+    def count(self, text: str) -> int:
+        # Rounded up, so it equals len(offsets(text)) and chunk_text agrees with count_tokens
+        return -(-len(text) // 4)
+
+    def offsets(self, text: str) -> Sequence[int]:
+        return range(0, len(text), 4)
+
+class HuggingFaceTokenizer(Tokenizer):
+    """Wraps a tokenizer.json loaded with the `tokenizers` package"""
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer as _HFTokenizer
+        self._tokenizer = _HFTokenizer.from_file(path)
+        self.name = path
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def offsets(self, text: str) -> Sequence[int]:
+        return [start for start, _ in self._tokenizer.encode(text, add_special_tokens=False).offsets]
+
+def find_tokenizer_file(model_name: Optional[str]) -> Optional[str]:
+    """Locates a tokenizer.json for the model in TOKENIZER_PATH or TOKENIZER_SEARCH_DIRS"""
+    candidates = []
+    if TOKENIZER_PATH:
+        candidates.append(TOKENIZER_PATH)
+    elif model_name:
+        full_name = model_name.replace(':', '-').replace('/', '-')
+        family = model_name.split(':')[0].split('/')[-1]
+        for directory in TOKENIZER_SEARCH_DIRS:
+            for name in dict.fromkeys([full_name, family]):
+                candidates.append(os.path.join(directory, name))
+                candidates.append(os.path.join(directory, f"{name}.json"))
+
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            candidate = os.path.join(candidate, "tokenizer.json")
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+_tokenizer: Optional[Tokenizer] = None
+
+def get_tokenizer() -> Tokenizer:
+    """Loads the tokenizer for MODEL_NAME once, falling back to the character heuristic"""
+    global _tokenizer
+    # Messages are printed after the shared lock is released, as every cache getter waits on it
+    messages: List[str] = []
+    with _shared_state_lock:
+        if _tokenizer is None:
+            path = find_tokenizer_file(MODEL_NAME)
+            if path:
+                try:
+                    _tokenizer = HuggingFaceTokenizer(path)
+                except ImportError:
+                    messages.append("Warning: the 'tokenizers' package is not installed; using approximate token counts.")
+                except Exception as e:
+                    messages.append(f"Warning: could not load tokenizer from {path}: {e}. Using approximate token counts.")
+            if _tokenizer is None:
+                _tokenizer = HeuristicTokenizer()
+            messages.append(f"Tokenizer: {_tokenizer.name}")
+        tokenizer = _tokenizer
+    for message in messages:
+        print(message)
+    return tokenizer
+
+_token_count_cache: "OrderedDict[Any, int]" = OrderedDict()
+_token_count_cache_lock = threading.Lock()
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if isinstance(tokenizer, HeuristicTokenizer):
+        return tokenizer.count(text)
+
+    # Long strings are keyed by a digest so the cache does not pin whole documents
+    key: Any = text if len(text) <= 4096 else (len(text), hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+    with _token_count_cache_lock:
+        if key in _token_count_cache:
+            _token_count_cache.move_to_end(key)
+            return _token_count_cache[key]
+
+    count = tokenizer.count(text)
+    with _token_count_cache_lock:
+        _token_count_cache[key] = count
+        if len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return count
 
 def get_strategy_config(token_count: int) -> SummaryConfig:
     if token_count <= SHORT_DOC_THRESHOLD:
@@ -781,7 +3109,8 @@ def get_strategy_config(token_count: int) -> SummaryConfig:
             needs_structure=False,
             use_incremental=False,
             chunk_size=token_count,
-            overlap_size=0
+            overlap_size=0,
+            strategy="single"
         )
     elif token_count <= MEDIUM_DOC_THRESHOLD:
         return SummaryConfig(
@@ -792,9 +3121,14 @@ def get_strategy_config(token_count: int) -> SummaryConfig:
             needs_structure=True,
             use_incremental=True,
             chunk_size=8000,
-            overlap_size=1000
+            overlap_size=100,
+            strategy=SUMMARY_STRATEGY if SUMMARY_STRATEGY in ("tree", "slotted") else "incremental"
         )
     else:
+        if SUMMARY_STRATEGY == "auto":
+            strategy = "tree" if token_count > VERY_LONG_DOC_THRESHOLD else "incremental"
+        else:
+            strategy = SUMMARY_STRATEGY
         return SummaryConfig(
             document_type="long",
             detail_level="hierarchical",
@@ -803,18 +3137,147 @@ def get_strategy_config(token_count: int) -> SummaryConfig:
             needs_structure=True,
             use_incremental=True,
             chunk_size=10000,
-            overlap_size=1500
+            overlap_size=150,
+            strategy=strategy
         )
 
-def extract_structure(text: str, config: SummaryConfig) -> str:
+# The summarization passes below are written once, as generators that yield the
+# LLM requests they need (a list of requests may run concurrently) and receive
+# the responses. run_llm_steps() drives them with blocking calls and
+# run_llm_steps_async() drives the same generators on an event loop.
+
+@dataclass
+class LLMRequest:
+    # Variable part of the request, sent last as the user message
+    prompt: str
+    # Called with the response as soon as this particular request completes
+    on_result: Optional[Callable[[str], None]] = None
+    # Static instructions shared by related calls, sent first as the system message
+    system_prompt: Optional[str] = None
+
+LLMSteps = Generator[Union[LLMRequest, List[LLMRequest]], Any, Any]
+
+def _complete_request(request: LLMRequest) -> str:
+    result = get_llm_response(BASE_URL, MODEL_NAME, request.prompt, system_prompt=request.system_prompt)
+    if request.on_result:
+        request.on_result(result)
+    return result
+
+def run_llm_steps(steps: LLMSteps) -> Any:
+    """Runs a pipeline generator to completion with blocking LLM calls"""
+    result = None
+    while True:
+        try:
+            request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(request, list):
+            result = map_in_parallel(_complete_request, request)
+        else:
+            result = _complete_request(request)
+
+async def _complete_request_async(request: LLMRequest, semaphore: Optional[asyncio.Semaphore]) -> str:
+    result = await get_llm_response_async(BASE_URL, MODEL_NAME, request.prompt, semaphore=semaphore,
+                                          system_prompt=request.system_prompt)
+    if request.on_result:
+        # Callbacks write checkpoints and indexes; keep that off the event loop
+        await asyncio.to_thread(request.on_result, result)
+    return result
+
+def _advance_steps(steps: LLMSteps, value: Any) -> Tuple[bool, Any]:
+    """Sends value into a pipeline generator; returns (finished, next request or return value)"""
+    try:
+        return False, steps.send(value)
+    except StopIteration as stop:
+        return True, stop.value
+
+async def run_llm_steps_async(steps: LLMSteps, semaphore: Optional[asyncio.Semaphore] = None) -> Any:
+    """
+    Runs a pipeline generator on the event loop; batched requests run
+    concurrently. The generator's own code (checkpoint writes, cache and index
+    lookups, token counting) runs in a worker thread so it never blocks the
+    loop. It always runs in the same copied context, and its requests start
+    from that context, so trace spans opened across a yield stay consistent.
+    """
+    context = contextvars.copy_context()
+    result = None
+    finished = False
+    try:
+        while True:
+            finished, request = await asyncio.to_thread(context.run, _advance_steps, steps, result)
+            if finished:
+                return request
+            if isinstance(request, list):
+                tasks = [context.run(asyncio.ensure_future, _complete_request_async(r, semaphore)) for r in request]
+                try:
+                    result = list(await asyncio.gather(*tasks))
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+            else:
+                result = await context.run(asyncio.ensure_future, _complete_request_async(request, semaphore))
+    finally:
+        if not finished:
+            # Run the generator's cleanup (open spans) in its own context
+            context.run(steps.close)
+
+def hierarchical_merge_steps(items: List[str], input_budget: int, make_request: Callable[[List[str], bool], LLMRequest],
+                             label: str) -> LLMSteps:
+    """
+    Merges items level by level until one remains. Every call gets as many
+    consecutive items as fit in input_budget tokens and the calls of one level
+    run concurrently, so the number of rounds grows with log(len(items)).
+    make_request(group, final) builds the merge request; final is True for the
+    last call.
+    """
+    level = 1
+    while True:
+        largest = max(count_tokens(item) for item in items)
+        fan_in = max(2, input_budget // max(1, largest))
+        final = len(items) <= fan_in
+        groups = [items[i:i + fan_in] for i in range(0, len(items), fan_in)]
+        print(f"{label} level {level}: merging {len(items)} parts in {len(groups)} group(s) (fan-in {fan_in})...")
+        items = yield [make_request(group, final) for group in groups]
+        if final:
+            return items[0]
+        level += 1
+
+def build_structure_merge_request(outlines: List[str], config: SummaryConfig, final: bool) -> LLMRequest:
+    """Request that merges partial outlines into one outline in the build_structure_prompt format"""
+    joined = "\n\n".join(f"--- OUTLINE OF PART {i+1} ---\n{outline}" for i, outline in enumerate(outlines))
+    scope = "the whole document" if final else "these consecutive parts of the document"
+    return LLMRequest(
+        f"The document is given as outlines of its consecutive parts. "
+        f"Merge them into a single outline of {scope}, combining sections that continue across parts:\n{joined}",
+        system_prompt=build_structure_prompt(config)
+    )
+
+def structure_steps(text: str, config: SummaryConfig) -> LLMSteps:
     if not config.needs_structure:
         return ""
     
-    structure_prompt = build_structure_prompt(config)
-    full_prompt = f"{structure_prompt}\n\nDocument to analyze:\n{text}"
-    
-    print(f"Extracting document structure...")
-    structure = get_llm_response(BASE_URL, MODEL_NAME, full_prompt)
+    if count_tokens(text) <= STRUCTURE_DIRECT_MAX_TOKENS:
+        structure_prompt = build_structure_prompt(config)
+        
+        print(f"Extracting document structure...")
+        structure = yield LLMRequest(f"Document to analyze:\n{text}", system_prompt=structure_prompt)
+    else:
+        # Too large for one prompt: outline groups in parallel, then merge the outlines
+        groups = chunk_text(text, STRUCTURE_GROUP_TOKENS, 0)
+        print(f"Extracting document structure from {len(groups)} parts...")
+        partial_prompt = build_partial_structure_prompt(config)
+        outlines = yield [
+            LLMRequest(f"This is part {i + 1} of {len(groups)}.\n\nDocument part to analyze:\n{group.text}",
+                       system_prompt=partial_prompt)
+            for i, group in enumerate(groups)
+        ]
+        structure = yield from hierarchical_merge_steps(
+            outlines, STRUCTURE_MERGE_INPUT_BUDGET,
+            lambda group, final: build_structure_merge_request(group, config, final),
+            "Structure merge"
+        )
     
     print(f"\n{'='*60}")
     print("DOCUMENT STRUCTURE EXTRACTED:")
@@ -824,55 +3287,144 @@ def extract_structure(text: str, config: SummaryConfig) -> str:
     
     return structure
 
-def chunk_text(text: str, chunk_size: int, overlap_size: int) -> List[str]:
-    if chunk_size >= len(text):
-        return [text]
+def extract_structure(text: str, config: SummaryConfig) -> str:
+    return run_llm_steps(structure_steps(text, config))
+
+async def extract_structure_async(text: str, config: SummaryConfig, semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    return await run_llm_steps_async(structure_steps(text, config), semaphore)
+
+@dataclass
+class TextChunk:
+    text: str
+    start: int  # character offset of the chunk in the source text
+    end: int
+
+# Break patterns in order of preference. Each match ends where a chunk may start.
+_HEADING_BREAK = re.compile(
+    r'\n(?=[ \t]*(?:'
+    r'(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)[ \t]+[A-Z][^\n]{0,80}'  # "2.1 Method", "IV. Results", "B. Data"
+    r'|[A-Z][A-Z0-9 ,:&/\-]{3,60}'                                        # "EXECUTIVE SUMMARY"
+    r'|(?:Abstract|Introduction|Background|Related Work|Methods?|Methodology|Results|Discussion'
+    r'|Conclusions?|References|Acknowledge?ments?|Appendix)\b[^\n]{0,60}'
+    r')\n)'
+)
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*')
+_SENTENCE_BREAK = re.compile(r'[.!?]["\')\]]*\s+(?=["(\[]?[A-Z0-9])')
+_WORD_BREAK = re.compile(r'\s+')
+_BREAK_PATTERNS = (_HEADING_BREAK, _PARAGRAPH_BREAK, _SENTENCE_BREAK, _WORD_BREAK)
+
+def find_chunk_boundary(text: str, lo: int, hi: int) -> int:
+    """
+    Returns the best position in (lo, hi] to end a chunk: the last heading start,
+    else the last paragraph break, sentence end or whitespace, else hi itself.
+    Only the window is scanned, so chunking stays linear in the text length.
+    """
+    lookahead_end = min(len(text), hi + 100)
+    for pattern in _BREAK_PATTERNS:
+        best = -1
+        for match in pattern.finditer(text, lo, lookahead_end):
+            if match.end() > hi:
+                break
+            best = match.end()
+        if best > lo:
+            return best
+    return hi
+
+def find_overlap_start(text: str, lo: int, hi: int) -> int:
+    """First sentence or paragraph start in [lo, hi), or hi when there is none"""
+    for pattern in (_PARAGRAPH_BREAK, _SENTENCE_BREAK):
+        match = pattern.search(text, lo, hi)
+        if match and match.end() < hi:
+            return match.end()
+    return hi
+
+def chunk_text(text: str, chunk_size: int, overlap_size: int) -> List[TextChunk]:
+    """
+    Splits text into chunks of at most chunk_size tokens. Each cut is snapped
+    back to a heading, blank line or sentence end near the token limit, and the
+    next chunk repeats at most overlap_size tokens of whole sentences.
+    """
+    offsets = get_tokenizer().offsets(text)
+    total_tokens = len(offsets)
+    text_length = len(text)
+    if chunk_size >= total_tokens:
+        return [TextChunk(text, 0, text_length)]
     
     chunks = []
     start = 0
     
-    while start < len(text):
-        end = start + chunk_size
-        if end > len(text):
-            end = len(text)
-        
-        chunk = text[start:end]
-        chunks.append(chunk)
-        
-        if end >= len(text):
+    while start < text_length:
+        start_token = bisect_left(offsets, start)
+        target_token = start_token + chunk_size
+        if target_token >= total_tokens:
+            chunks.append(TextChunk(text[start:], start, text_length))
             break
-            
-        start = end - overlap_size
+
+        target = offsets[target_token]
+        window_start = max(start, target - int((target - start) * CHUNK_BOUNDARY_WINDOW))
+        end = find_chunk_boundary(text, window_start, target)
+        chunks.append(TextChunk(text[start:end], start, end))
+
+        next_start = end
+        if overlap_size > 0 and not _HEADING_BREAK.match(text, end - 1):
+            end_token = bisect_left(offsets, end)
+            overlap_token = max(end_token - overlap_size, start_token + 1)
+            next_start = find_overlap_start(text, offsets[overlap_token], end)
+        start = next_start if next_start > start else end
     
     return chunks
 
-def create_summary(text: str, structure: str, config: SummaryConfig) -> str:
+def summary_steps(text: str, structure: str, config: SummaryConfig, checkpoint: Optional[DocumentCheckpoint] = None) -> LLMSteps:
+    if checkpoint is None:
+        checkpoint = DocumentCheckpoint(None)
+
     if not config.use_incremental:
         # Simple summarization for short documents
         summary_prompt = build_summary_prompt(config, structure)
-        full_prompt = f"{summary_prompt}\n\nDocument to summarize:\n{text}"
-        return get_llm_response(BASE_URL, MODEL_NAME, full_prompt)
-    
-    # Convert token-based sizes to character-based sizes for chunking
-    char_chunk_size = config.chunk_size * 4
-    char_overlap_size = config.overlap_size * 4
+        return (yield LLMRequest(f"Document to summarize:\n{text}", system_prompt=summary_prompt))
     
-    # Incremental summarization for longer documents
-    chunks = chunk_text(text, char_chunk_size, char_overlap_size)
-    running_summary = ""
+    checkpoint.reset_progress({
+        "strategy": config.strategy,
+        "chunk_size": config.chunk_size,
+        "overlap_size": config.overlap_size,
+        "tokenizer": get_tokenizer().name,
+        "chunker": "boundary",
+    })
+
+    if config.strategy == "tree":
+        return (yield from tree_summary_steps(text, structure, config, checkpoint))
+
+    if config.strategy == "slotted":
+        sections = parse_outline_sections(structure)
+        if len(sections) >= 2:
+            return (yield from slotted_summary_steps(text, structure, sections, config, checkpoint))
+        print("Warning: could not find sections in the document structure; using incremental summarization.")
+
+    # Incremental summarization for longer documents. The instructions and
+    # structure form a system prompt that is identical for every chunk, so the
+    # server can reuse its cached prefix; the running summary and chunk go last.
+    summary_prompt = build_summary_prompt(config, structure)
+    chunks = chunk_text(text, config.chunk_size, config.overlap_size)
+    start_chunk = checkpoint.get("next_chunk", 0)
+    running_summary = checkpoint.get("running_summary", "")
+    if start_chunk:
+        print(f"Resuming from checkpoint after chunk {start_chunk}/{len(chunks)}")
     
     for i, chunk in enumerate(chunks):
+        if i < start_chunk:
+            continue
+
         print(f"Processing chunk {i+1}/{len(chunks)}...")
         
-        summary_prompt = build_summary_prompt(config, structure, running_summary)
-        full_prompt = f"{summary_prompt}\n\nText to process:\n{chunk}"
+        full_prompt = f"Text to process:\n{chunk.text}"
         
         if running_summary:
+            full_prompt = f"{build_previous_summary_section(running_summary)}\n\n{full_prompt}"
             full_prompt += f"\n\nPlease update and expand the previous summary with information from this new text section."
         else:
             full_prompt += f"\n\nThis is the first section. Create an initial summary."
         
-        chunk_result = get_llm_response(BASE_URL, MODEL_NAME, full_prompt)
+        chunk_result = yield LLMRequest(full_prompt, system_prompt=summary_prompt)
         
         print(f"\n{'-'*50}")
         print(f"CHUNK {i+1} SUMMARY RESULT:")
@@ -883,37 +3435,772 @@ def create_summary(text: str, structure: str, config: SummaryConfig) -> str:
         running_summary = chunk_result
         
         # Compress summary if it's getting too long
-        if count_tokens(running_summary) > 8000:
+        if count_tokens(running_summary) > SUMMARY_COMPRESSION_THRESHOLD:
             print("Compressing summary (too long)...")
-            compress_prompt = f"Compress this summary to focus on the most essential information while preserving key details:\n\n{running_summary}"
-            running_summary = get_llm_response(BASE_URL, MODEL_NAME, compress_prompt)
+            with trace_span("compression", tokens_before=count_tokens(running_summary)) as span:
+                running_summary = yield LLMRequest(
+                    running_summary,
+                    system_prompt="Compress this summary to focus on the most essential information while preserving key details:"
+                )
+                span.set(tokens_after=count_tokens(running_summary))
             
             print(f"\n{'-'*50}")
             print("COMPRESSED SUMMARY:")
             print(f"{'-'*50}")
             print(running_summary)
             print(f"{'-'*50}\n")
+
+        checkpoint.update(next_chunk=i + 1, running_summary=running_summary)
     
     return running_summary
 
-def summarize_document(text: str) -> str:
+def create_summary(text: str, structure: str, config: SummaryConfig, checkpoint: Optional[DocumentCheckpoint] = None) -> str:
+    return run_llm_steps(summary_steps(text, structure, config, checkpoint))
+
+async def create_summary_async(text: str, structure: str, config: SummaryConfig, checkpoint: Optional[DocumentCheckpoint] = None,
+                               semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    return await run_llm_steps_async(summary_steps(text, structure, config, checkpoint), semaphore)
+
+def build_merge_request(partials: List[str], structure: str, config: SummaryConfig, final: bool) -> LLMRequest:
+    """Request that merges consecutive partial summaries in one LLM call"""
+    joined = "\n\n".join(f"--- PART {i+1} ---\n{partial}" for i, partial in enumerate(partials))
+    if final:
+        return LLMRequest(f"The document is given as partial summaries of its consecutive parts:\n{joined}",
+                          system_prompt=build_summary_prompt(config, structure))
+    return LLMRequest(joined, system_prompt=build_merge_prompt(config, structure))
+
+def tree_summary_steps(text: str, structure: str, config: SummaryConfig, checkpoint: Optional[DocumentCheckpoint] = None) -> LLMSteps:
+    """
+    Map-reduce summarization: every chunk is summarized independently and in
+    parallel with the structure as shared context, then the partial summaries
+    are merged level by level. Each reduce call takes as many partials as fit in
+    TREE_REDUCE_INPUT_BUDGET, so the number of sequential rounds grows with
+    log(chunks) instead of linearly.
+    """
+    if checkpoint is None:
+        checkpoint = DocumentCheckpoint(None)
+
+    chunks = chunk_text(text, config.chunk_size, config.overlap_size)
+    total = len(chunks)
+    done: Dict[str, str] = dict(checkpoint.get("partials", {}))
+    if done:
+        print(f"Resuming from checkpoint: {len(done)}/{total} chunks already summarized")
+
+    chunk_prompt = build_chunk_summary_prompt(config, structure)
+    index = get_duplicate_index()
+    chunk_hashes = [text_digest(chunk.text) for chunk in chunks] if index else []
+    # Partials depend on the outline and length settings in the prompt, not just the chunk
+    prompt_hash = text_digest(chunk_prompt)
+    if index:
+        reused = 0
+        for i, chunk_hash in enumerate(chunk_hashes):
+            if str(i) not in done:
+                summary = index.find_chunk(chunk_hash, prompt_hash)
+                if summary is not None:
+                    done[str(i)] = summary
+                    reused += 1
+        if reused:
+            print(f"Reusing summaries of {reused} previously summarized chunk(s)")
+            dedup_stats.record_chunks(reused)
+            checkpoint.update(partials=dict(done))
+    print(f"Tree strategy: summarizing {total - len(done)} chunks in parallel...")
+
+    def record_chunk(i: int):
+        def on_result(result: str):
+            print(f"Chunk {i+1}/{total} summarized ({count_tokens(result)} tokens)")
+            done[str(i)] = result
+            checkpoint.update(partials=dict(done))
+            if index and result:
+                index.record_chunk(chunk_hashes[i], prompt_hash, result)
+        return on_result
+
+    pending = [
+        (i, LLMRequest(f"This is part {i + 1} of {total}.\n\nText to process:\n{chunk.text}",
+                       on_result=record_chunk(i), system_prompt=chunk_prompt))
+        for i, chunk in enumerate(chunks) if str(i) not in done
+    ]
+    if pending:
+        yield [request for _, request in pending]
+    partials = [done[str(i)] for i in range(total)]
+
+    summary = yield from hierarchical_merge_steps(
+        partials, TREE_REDUCE_INPUT_BUDGET,
+        lambda group, final: build_merge_request(group, structure, config, final),
+        "Reduce"
+    )
+    print(f"\n{'-'*50}")
+    print("TREE SUMMARY RESULT:")
+    print(f"{'-'*50}")
+    print(summary)
+    print(f"{'-'*50}\n")
+    return summary
+
+def create_tree_summary(text: str, structure: str, config: SummaryConfig, checkpoint: Optional[DocumentCheckpoint] = None) -> str:
+    return run_llm_steps(tree_summary_steps(text, structure, config, checkpoint))
+
+@dataclass
+class OutlineSection:
+    key: str  # Roman numeral as written in the outline
+    title: str
+    # Words from the title and the outline lines under it, used to match chunks
+    keywords: FrozenSet[str]
+
+_OUTLINE_MAIN_SECTION = re.compile(r'^(?:[#*]+[ \t]*)?([IVXLC]+)\.[ \t]+(.+?)[ \t*#]*$')
+_SLOT_MARKER = re.compile(r'^[ \t]*=+[ \t]*SECTION[ \t]+([IVXLC]+)\b[^\n]*$', re.MULTILINE)
+_KEYWORD = re.compile(r'[a-z][a-z0-9-]{3,}')
+_KEYWORD_STOPWORDS = frozenset(
+    "with from that this these those their there which about into over under between section sections "
+    "subsection overview introduction conclusion summary main part parts other detail details point points key".split()
+)
+
+def roman_to_int(numeral: str) -> int:
+    values = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100}
+    total = 0
+    for i, char in enumerate(numeral):
+        value = values[char]
+        if i + 1 < len(numeral) and values[numeral[i + 1]] > value:
+            total -= value
+        else:
+            total += value
+    return total
+
+def _keywords(text: str) -> set:
+    return {word for word in _KEYWORD.findall(text.lower()) if word not in _KEYWORD_STOPWORDS}
+
+def parse_outline_sections(structure: str) -> List[OutlineSection]:
+    """
+    Finds the main sections (I., II., III., ...) of an outline produced by the
+    structure pass. Only unindented lines continuing the numbering count, so
+    subsections lettered "C." or "V." are not mistaken for main sections.
+    """
+    found: List[Tuple[str, str, List[str]]] = []
+    for line in structure.splitlines():
+        match = _OUTLINE_MAIN_SECTION.match(line)
+        if match and roman_to_int(match.group(1)) == len(found) + 1:
+            found.append((match.group(1), match.group(2).strip(), []))
+        elif found:
+            found[-1][2].append(line)
+    return [
+        OutlineSection(key, title, frozenset(_keywords(title) | _keywords("\n".join(body))))
+        for key, title, body in found
+    ]
+
+def select_slot_sections(sections: List[OutlineSection], text: str, last_index: Optional[int]) -> List[int]:
+    """
+    Picks the sections whose summaries are sent with a chunk: the section the
+    previous chunk ended in and the one after it (documents are read in order),
+    plus the best keyword matches, up to SLOTTED_SECTIONS_PER_CALL.
+    """
+    words = _keywords(text)
+    scores = [len(section.keywords & words) / len(section.keywords) if section.keywords else 0.0
+              for section in sections]
+    if last_index is None:
+        chosen = [0]
+    else:
+        chosen = [last_index] + ([last_index + 1] if last_index + 1 < len(sections) else [])
+    for index in sorted(range(len(sections)), key=lambda i: scores[i], reverse=True):
+        if len(chosen) >= SLOTTED_SECTIONS_PER_CALL or scores[index] < SLOTTED_MATCH_THRESHOLD:
+            break
+        if index not in chosen:
+            chosen.append(index)
+    return sorted(chosen[:SLOTTED_SECTIONS_PER_CALL])
+
+def parse_slot_updates(response: str) -> List[Tuple[str, str]]:
+    """Splits a slot update response into (section key, summary) pairs, in order"""
+    markers = list(_SLOT_MARKER.finditer(response))
+    updates = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(response)
+        body = response[marker.end():end].strip()
+        if body:
+            updates.append((marker.group(1), body))
+    return updates
+
+def assemble_slotted_summary(sections: List[OutlineSection], slots: Dict[str, str]) -> str:
+    return "\n\n".join(
+        f"{section.key}. {section.title}\n{slots[section.key].strip()}"
+        for section in sections if slots.get(section.key, "").strip()
+    )
+
+def slotted_summary_steps(text: str, structure: str, sections: List[OutlineSection], config: SummaryConfig,
+                          checkpoint: Optional[DocumentCheckpoint] = None) -> LLMSteps:
+    """
+    Section-slotted summarization. Instead of one running summary that is sent
+    back and rewritten with every chunk, a summary is kept per main section of
+    the outline. Each chunk call receives only the summaries of the sections it
+    is likely to touch and returns updates for the sections it covers; a slot
+    that grows past SLOTTED_SECTION_MAX_TOKENS is condensed on its own. The
+    final summary is assembled from the slots in outline order.
+    """
+    if checkpoint is None:
+        checkpoint = DocumentCheckpoint(None)
+
+    keys = {section.key: index for index, section in enumerate(sections)}
+    system_prompt = build_slot_update_prompt(config, structure)
+    chunks = chunk_text(text, config.chunk_size, config.overlap_size)
+    start_chunk = checkpoint.get("next_chunk", 0)
+    slots: Dict[str, str] = dict(checkpoint.get("slots", {}))
+    last_index = checkpoint.get("last_section")
+    if start_chunk:
+        print(f"Resuming from checkpoint after chunk {start_chunk}/{len(chunks)}")
+    print(f"Slotted strategy: {len(sections)} sections, {len(chunks)} chunks")
+
+    for i, chunk in enumerate(chunks):
+        if i < start_chunk:
+            continue
+
+        shown = select_slot_sections(sections, chunk.text, last_index)
+        print(f"Processing chunk {i+1}/{len(chunks)} (sections {', '.join(sections[j].key for j in shown)})...")
+        current = "\n".join(
+            f"=== SECTION {sections[j].key} ===\n{slots.get(sections[j].key) or '(nothing yet)'}" for j in shown
+        )
+        response = yield LLMRequest(
+            f"CURRENT SECTION SUMMARIES:\n{current}\n\n"
+            f"This is part {i + 1} of {len(chunks)}.\n\nText to process:\n{chunk.text}\n\n"
+            f"Return updated summaries for the sections this text covers.",
+            system_prompt=system_prompt
+        )
+
+        updates = [(key, body) for key, body in parse_slot_updates(response) if key in keys]
+        if not updates and response.strip():
+            # The model ignored the format: keep the text rather than lose it
+            updates = [(sections[shown[0]].key, response.strip())]
+        shown_keys = {sections[j].key for j in shown}
+        for key, body in updates:
+            if key in shown_keys or not slots.get(key):
+                slots[key] = body
+            else:
+                slots[key] = f"{slots[key]}\n{body}"
+        if updates:
+            last_index = max(keys[key] for key, _ in updates)
+        print(f"Updated sections: {', '.join(key for key, _ in updates) or 'none'}")
+
+        oversized = [key for key, _ in updates if count_tokens(slots[key]) > SLOTTED_SECTION_MAX_TOKENS]
+        if oversized:
+            print(f"Condensing section summaries: {', '.join(oversized)}")
+            with trace_span("compression", tokens_before=sum(count_tokens(slots[key]) for key in oversized)) as span:
+                condensed = yield [
+                    LLMRequest(
+                        slots[key],
+                        system_prompt=f"Condense this summary of section {key}. {sections[keys[key]].title} of a document "
+                                      f"to about {SLOTTED_SECTION_MAX_TOKENS // 2} tokens, keeping all specific details "
+                                      f"(numbers, dates, names, technical terms):"
+                    )
+                    for key in oversized
+                ]
+                slots.update(zip(oversized, condensed))
+                span.set(tokens_after=sum(count_tokens(slots[key]) for key in oversized))
+
+        checkpoint.update(next_chunk=i + 1, slots=slots, last_section=last_index)
+
+    summary = assemble_slotted_summary(sections, slots)
+    print(f"\n{'-'*50}")
+    print("SLOTTED SUMMARY RESULT:")
+    print(f"{'-'*50}")
+    print(summary)
+    print(f"{'-'*50}\n")
+    return summary
+
+# =============================================================================
+# NEAR-DUPLICATE DETECTION
+# =============================================================================
+
+_WORD_PATTERN = re.compile(r'\w+')
+_SHINGLE_MULTIPLIER = np.uint64(1099511628211)
+_minhash_rng = np.random.default_rng(0x5EED)
+_MINHASH_A = _minhash_rng.integers(1, 2**63, size=MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_MINHASH_B = _minhash_rng.integers(0, 2**63, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def _stable_hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+def text_digest(text: str) -> str:
+    """Exact identity of a text, used wherever a summary is reused without revision"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def shingle_hashes(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """Distinct 64-bit hashes of the lowercased word n-grams of text"""
+    words = _WORD_PATTERN.findall(text.lower())
+    if not words:
+        return np.zeros(0, dtype=np.uint64)
+    vocabulary: Dict[str, int] = {}
+    codes = np.fromiter((vocabulary.setdefault(word, len(vocabulary)) for word in words), dtype=np.int64, count=len(words))
+    word_hashes = np.fromiter((_stable_hash64(word.encode('utf-8')) for word in vocabulary), dtype=np.uint64,
+                              count=len(vocabulary))[codes]
+    size = min(size, len(word_hashes))
+    count = len(word_hashes) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for offset in range(size):
+            hashes = hashes * _SHINGLE_MULTIPLIER + word_hashes[offset:offset + count]
+    return np.unique(hashes)
+
+def minhash_signature(shingles: np.ndarray, batch: int = 8192) -> np.ndarray:
+    """MinHash signature using multiply-add permutations of the 64-bit shingle hashes"""
+    signature = np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for start in range(0, len(shingles), batch):
+            values = shingles[None, start:start + batch] * _MINHASH_A[:, None] + _MINHASH_B[:, None]
+            np.minimum(signature, values.min(axis=1), out=signature)
+    return signature
+
+def minhash_bands(signature: np.ndarray) -> List[int]:
+    """One signed 64-bit key per band, for the SQLite lookup table"""
+    rows = len(signature) // MINHASH_BANDS
+    return [
+        _stable_hash64(bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes()) - 2**63
+        for band in range(MINHASH_BANDS)
+    ]
+
+def minhash_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return float(np.mean(a == b))
+
+_BLOCK_CUT = re.compile(r'(?<=[.!?])["\')\]]*\s+|\n[ \t]*\n\s*')
+
+def content_defined_blocks(text: str, target_tokens: int = DEDUP_BLOCK_TOKENS) -> List[TextChunk]:
+    """
+    Splits text into blocks of about target_tokens whose boundaries depend only
+    on nearby content: a block ends after a sentence whose hash hits a fixed
+    modulus. Inserting or deleting text in one place therefore changes only the
+    blocks around it, unlike fixed-size chunks which all shift.
+    """
+    target_chars = target_tokens * 4
+    modulus = max(2, target_chars // 150)
+    blocks: List[TextChunk] = []
+    start = 0
+    for match in _BLOCK_CUT.finditer(text):
+        end = match.end()
+        size = end - start
+        if size < target_chars // 4:
+            continue
+        sentence_start = text.rfind(" ", start, max(start, match.start() - 80)) + 1
+        sentence = text[max(start, sentence_start):match.start()]
+        if size >= target_chars * 4 or _stable_hash64(sentence.encode('utf-8')) % modulus == 0:
+            blocks.append(TextChunk(text[start:end], start, end))
+            start = end
+    if start < len(text):
+        blocks.append(TextChunk(text[start:], start, len(text)))
+    return blocks
+
+@dataclass
+class DocumentFingerprint:
+    doc_id: str  # text_digest of the whole text
+    signature: np.ndarray
+    blocks: List[TextChunk]
+    block_hashes: List[str]  # text_digest of every block
+
+    @classmethod
+    def of(cls, text: str) -> "DocumentFingerprint":
+        blocks = content_defined_blocks(text)
+        return cls(
+            text_digest(text),
+            minhash_signature(shingle_hashes(text)),
+            blocks,
+            [text_digest(block.text) for block in blocks],
+        )
+
+@dataclass
+class DuplicateMatch:
+    doc_id: str
+    source: Optional[str]
+    similarity: float
+    summary: str
+    block_hashes: List[str]
+    block_texts: List[str]
+
+class DuplicateIndex(SQLiteStore):
+    """
+    Fingerprints of summarized documents (MinHash signatures, banded for
+    lookup, plus the digest and text of every block) and of tree strategy
+    chunks, with the summaries made from them. Only entries made with the
+    current model and prompt version are returned.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS documents (
+            doc_id TEXT PRIMARY KEY,
+            source TEXT,
+            model TEXT,
+            prompt_version TEXT,
+            signature BLOB NOT NULL,
+            block_hashes TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        # Block texts of the earlier version, shown to the model when blocks were removed.
+        # Documents recorded before this table existed have no row and are never matched.
+        """CREATE TABLE IF NOT EXISTS document_blocks (
+            doc_id TEXT PRIMARY KEY,
+            blocks TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS document_bands (
+            band INTEGER NOT NULL,
+            band_key INTEGER NOT NULL,
+            doc_id TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS document_bands_key ON document_bands (band, band_key)",
+        "CREATE INDEX IF NOT EXISTS document_bands_doc ON document_bands (doc_id)",
+        # Replaced by chunk_partials: their entries cannot be checked against the chunk text and prompt
+        "DROP TABLE IF EXISTS chunks",
+        "DROP TABLE IF EXISTS chunk_summaries",
+        # prompt_hash is the text_digest of the system prompt (outline and length settings)
+        """CREATE TABLE IF NOT EXISTS chunk_partials (
+            text_hash TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            used_at REAL NOT NULL,
+            UNIQUE (text_hash, prompt_hash, model, prompt_version)
+        )""",
+        "CREATE INDEX IF NOT EXISTS chunk_partials_used ON chunk_partials (used_at)",
+    ]
+
+    def find_exact(self, doc_id: str) -> Optional[DuplicateMatch]:
+        """Returns the document recorded with exactly this text, if any"""
+        row = self._connection().execute(
+            "SELECT source, summary FROM documents WHERE doc_id = ? AND model = ? AND prompt_version = ?",
+            (doc_id, MODEL_NAME, PROMPT_VERSION)
+        ).fetchone()
+        return DuplicateMatch(doc_id, row[0], 1.0, row[1], [], []) if row else None
+
+    def find_document(self, fingerprint: DocumentFingerprint) -> Optional[DuplicateMatch]:
+        """Returns the most similar summarized document sharing at least one signature band"""
+        bands = minhash_bands(fingerprint.signature)
+        conn = self._connection()
+        candidates = {
+            row[0] for band, key in enumerate(bands)
+            for row in conn.execute("SELECT doc_id FROM document_bands WHERE band = ? AND band_key = ?", (band, key))
+        }
+        best: Optional[DuplicateMatch] = None
+        for doc_id in candidates:
+            row = conn.execute(
+                "SELECT d.source, d.signature, d.block_hashes, d.summary, b.blocks "
+                "FROM documents d JOIN document_blocks b ON b.doc_id = d.doc_id "
+                "WHERE d.doc_id = ? AND d.model = ? AND d.prompt_version = ?",
+                (doc_id, MODEL_NAME, PROMPT_VERSION)
+            ).fetchone()
+            if row is None:
+                continue
+            signature = np.frombuffer(row[1], dtype=np.uint64)
+            if len(signature) != len(fingerprint.signature):
+                continue
+            similarity = minhash_similarity(signature, fingerprint.signature)
+            if best is None or similarity > best.similarity:
+                best = DuplicateMatch(doc_id, row[0], similarity, row[3], json.loads(row[2]), json.loads(row[4]))
+        return best
+
+    def record_document(self, fingerprint: DocumentFingerprint, source: Optional[str], summary: str):
+        with self._write_transaction() as conn:
+            conn.execute("DELETE FROM document_bands WHERE doc_id = ?", (fingerprint.doc_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_id, source, model, prompt_version, signature, "
+                "block_hashes, summary, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint.doc_id, source, MODEL_NAME, PROMPT_VERSION, fingerprint.signature.tobytes(),
+                 json.dumps(fingerprint.block_hashes), summary, time.time())
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO document_blocks (doc_id, blocks) VALUES (?, ?)",
+                (fingerprint.doc_id, json.dumps([block.text for block in fingerprint.blocks], ensure_ascii=False))
+            )
+            conn.executemany(
+                "INSERT INTO document_bands (band, band_key, doc_id) VALUES (?, ?, ?)",
+                [(band, key, fingerprint.doc_id) for band, key in enumerate(minhash_bands(fingerprint.signature))]
+            )
+
+    def find_chunk(self, text_hash: str, prompt_hash: str) -> Optional[str]:
+        """
+        Returns the summary recorded for a chunk with exactly this text,
+        summarized with exactly this system prompt (both see text_digest)
+        """
+        conn = self._connection()
+        key = (text_hash, prompt_hash, MODEL_NAME, PROMPT_VERSION)
+        where = "text_hash = ? AND prompt_hash = ? AND model = ? AND prompt_version = ?"
+        row = conn.execute(f"SELECT summary FROM chunk_partials WHERE {where}", key).fetchone()
+        if row is None:
+            return None
+        conn.execute(f"UPDATE chunk_partials SET used_at = ? WHERE {where}", (time.time(), *key))
+        return row[0]
+
+    def record_chunk(self, text_hash: str, prompt_hash: str, summary: str):
+        """Stores a chunk summary and evicts the least recently used beyond CHUNK_SUMMARY_MAX_ENTRIES"""
+        with self._write_transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chunk_partials (text_hash, prompt_hash, model, prompt_version, summary, "
+                "used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (text_hash, prompt_hash, MODEL_NAME, PROMPT_VERSION, summary, time.time())
+            )
+            excess = conn.execute("SELECT COUNT(*) FROM chunk_partials").fetchone()[0] - CHUNK_SUMMARY_MAX_ENTRIES
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM chunk_partials WHERE rowid IN "
+                    "(SELECT rowid FROM chunk_partials ORDER BY used_at, rowid LIMIT ?)", (excess,)
+                )
+
+_duplicate_index: Optional[DuplicateIndex] = None
+
+def get_duplicate_index() -> Optional[DuplicateIndex]:
+    """Returns the shared near-duplicate index, or None when DEDUP_ENABLED is off"""
+    global _duplicate_index
+    if not DEDUP_ENABLED:
+        return None
+    with _shared_state_lock:
+        if _duplicate_index is None:
+            _duplicate_index = DuplicateIndex(os.path.join(CACHE_DIR, "duplicates.sqlite3"))
+        return _duplicate_index
+
+class DedupStats:
+    """Counts the LLM work skipped thanks to near-duplicate detection during a run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reused_documents = 0
+        self.revised_documents = 0
+        self.reused_chunks = 0
+        self.calls_avoided = 0
+
+    def record_document(self, revised: bool, calls_avoided: int):
+        with self._lock:
+            if revised:
+                self.revised_documents += 1
+            else:
+                self.reused_documents += 1
+            self.calls_avoided += max(0, calls_avoided)
+
+    def record_chunks(self, count: int):
+        with self._lock:
+            self.reused_chunks += count
+            self.calls_avoided += count
+
+    def report(self) -> str:
+        with self._lock:
+            return (f"Near-duplicates: {self.reused_documents} document summary(ies) reused, "
+                    f"{self.revised_documents} revised, {self.reused_chunks} chunk summary(ies) reused; "
+                    f"~{self.calls_avoided} LLM call(s) avoided.")
+
+dedup_stats = DedupStats()
+
+def estimate_llm_calls(token_count: int, config: SummaryConfig) -> int:
+    """Rough number of LLM calls a full summarization of the document takes"""
+    if not config.use_incremental:
+        return 1
+    if token_count <= STRUCTURE_DIRECT_MAX_TOKENS:
+        structure_calls = 1
+    else:
+        structure_calls = -(-token_count // STRUCTURE_GROUP_TOKENS) + 1
+    chunk_calls = -(-token_count // config.chunk_size)
+    return structure_calls + chunk_calls + (1 if config.strategy == "tree" else 0)
+
+def changed_block_runs(old_hashes: List[str], new_hashes: List[str]) -> List[Tuple[List[int], List[int]]]:
+    """
+    Aligns the blocks of two versions and returns, for every place where they
+    differ, the indexes of the old blocks removed there and of the new blocks
+    added there. Blocks that only moved count as unchanged.
+    """
+    old_set, new_set = set(old_hashes), set(new_hashes)
+    runs = []
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        removed = [i for i in range(i1, i2) if old_hashes[i] not in new_set]
+        added = [j for j in range(j1, j2) if new_hashes[j] not in old_set]
+        if removed or added:
+            runs.append((removed, added))
+    return runs
+
+def split_revision_edit(removed: str, added: str, max_tokens: int) -> List[Tuple[str, str]]:
+    """
+    Splits one edit into (removed, added) pieces of at most max_tokens together.
+    Each side keeps its share of the budget, so the i-th piece of the old text
+    travels with the i-th piece of its replacement.
+    """
+    removed_tokens, added_tokens = count_tokens(removed), count_tokens(added)
+    if removed_tokens + added_tokens <= max_tokens:
+        return [(removed, added)]
+    if not removed_tokens or not added_tokens:
+        removed_size = added_size = max_tokens
+    else:
+        removed_size = min(max_tokens - 1, max(1, -(-max_tokens * removed_tokens // (removed_tokens + added_tokens))))
+        added_size = max_tokens - removed_size
+    removed_pieces = [chunk.text for chunk in chunk_text(removed, removed_size, 0)] if removed else []
+    added_pieces = [chunk.text for chunk in chunk_text(added, added_size, 0)] if added else []
+    pieces = max(len(removed_pieces), len(added_pieces))
+    removed_pieces += [""] * (pieces - len(removed_pieces))
+    added_pieces += [""] * (pieces - len(added_pieces))
+    return list(zip(removed_pieces, added_pieces))
+
+def build_revision_request(summary: str, removed: List[str], added: List[str]) -> str:
+    sections = [f"SUMMARY OF THE EARLIER VERSION:\n{summary}"]
+    if removed:
+        sections.append("PASSAGES REMOVED FROM THE EARLIER VERSION:\n" + "\n[...]\n".join(removed))
+    if added:
+        sections.append("NEW OR CHANGED PASSAGES:\n" + "\n[...]\n".join(added))
+    return "\n\n".join(sections)
+
+def near_duplicate_steps(index: DuplicateIndex, fingerprint: DocumentFingerprint, config: SummaryConfig,
+                         token_count: int) -> LLMSteps:
+    """
+    Returns a summary derived from an earlier summarized document, or None
+    when there is none close enough and the document must be summarized from
+    scratch. Only an identical text reuses the earlier summary as is. For a
+    near-duplicate, blocks of the new text missing from the earlier version are
+    new or changed, and blocks of the earlier version missing from the new text
+    were removed. Each edit gives the model the removed passage together with
+    its replacement to revise the earlier summary. Edits are packed up to
+    config.chunk_size tokens per call, and larger ones are split.
+    """
+    full_cost = estimate_llm_calls(token_count, config)
+    exact = index.find_exact(fingerprint.doc_id)
+    if exact is not None:
+        print(f"Identical to {exact.source or exact.doc_id[:12]}; reusing its summary.")
+        dedup_stats.record_document(False, full_cost)
+        return exact.summary
+
+    if not config.use_incremental:
+        # A fresh summary takes a single call anyway
+        return None
+    match = index.find_document(fingerprint)
+    if match is None or match.similarity < NEAR_DUPLICATE_THRESHOLD:
+        return None
+    runs = changed_block_runs(match.block_hashes, fingerprint.block_hashes)
+    added_blocks = sum(len(added) for _, added in runs)
+    removed_blocks = sum(len(removed) for removed, _ in runs)
+    total_blocks = len(fingerprint.block_hashes) + len(match.block_hashes)
+    if not runs:
+        # Same blocks in a different order; not worth guessing how the summary should change
+        return None
+    if added_blocks + removed_blocks > total_blocks * NEAR_DUPLICATE_MAX_CHANGED:
+        return None
+
+    # Each removed passage travels with its replacement, split where an edit exceeds one chunk
+    new_texts = [block.text for block in fingerprint.blocks]
+    groups: List[List[Tuple[str, str]]] = []
+    group_tokens = 0
+    for removed_indexes, added_indexes in runs:
+        edit_removed = "".join(match.block_texts[i] for i in removed_indexes)
+        edit_added = "".join(new_texts[j] for j in added_indexes)
+        for piece in split_revision_edit(edit_removed, edit_added, config.chunk_size):
+            tokens = count_tokens(piece[0]) + count_tokens(piece[1])
+            if groups and group_tokens + tokens <= config.chunk_size:
+                groups[-1].append(piece)
+                group_tokens += tokens
+            else:
+                groups.append([piece])
+                group_tokens = tokens
+    if len(groups) >= full_cost:
+        return None
+
+    print(f"Near-duplicate of {match.source or match.doc_id[:12]} (similarity {match.similarity:.2f}): "
+          f"{added_blocks} new or changed and {removed_blocks} removed block(s); "
+          f"revising its summary in {len(groups)} call(s).")
+    summary = match.summary
+    revision_prompt = build_revision_prompt(config)
+    for n, group in enumerate(groups):
+        print(f"Revising summary ({n+1}/{len(groups)})...")
+        summary = yield LLMRequest(
+            build_revision_request(summary, [removed for removed, _ in group if removed],
+                                   [added for _, added in group if added]),
+            system_prompt=revision_prompt
+        )
+    dedup_stats.record_document(True, full_cost - len(groups))
+    return summary
+
+def document_steps(text: str, source: Optional[str] = None) -> LLMSteps:
+    """
+    Runs the structure and summary passes. Progress is checkpointed after every
+    step and an existing checkpoint for the same text is resumed; the caller
+    deletes it (DocumentCheckpoint.for_text(text).delete()) once the summary is
+    safely written. A document summarized before reuses that summary, and a
+    near-duplicate of one revises it instead (see DEDUP_ENABLED).
+    """
     print("Analyzing document...")
     
     token_count = count_tokens(text)
     config = get_strategy_config(token_count)
     
     print(f"Document length: {token_count} tokens")
-    print(f"Using {config.document_type} document strategy")
+    print(f"Using {config.document_type} document strategy ({config.strategy} summarization)")
     
+    index = get_duplicate_index()
+    fingerprint = DocumentFingerprint.of(text) if index else None
+    if fingerprint:
+        summary = yield from near_duplicate_steps(index, fingerprint, config, token_count)
+        if summary is not None:
+            index.record_document(fingerprint, source, summary)
+            return summary
+
+    checkpoint = DocumentCheckpoint.for_text(text)
+
     # Structure extraction pass
-    structure = extract_structure(text, config)
+    structure = checkpoint.get("structure")
+    if structure is None:
+        with trace_span("structure", tokens_before=token_count) as span:
+            structure = yield from structure_steps(text, config)
+            span.set(tokens_after=count_tokens(structure))
+        if config.use_incremental:
+            checkpoint.update(structure=structure)
+    else:
+        print("Using document structure from checkpoint.")
     
     # Summary creation pass
     print("Creating summary...")
-    summary = create_summary(text, structure, config)
+    with trace_span("summary", strategy=config.strategy, tokens_before=token_count) as span:
+        summary = yield from summary_steps(text, structure, config, checkpoint)
+        span.set(tokens_after=count_tokens(summary))
+
+    if fingerprint and summary:
+        index.record_document(fingerprint, source, summary)
     
     return summary
 
+def _document_routing_key(text: str, source: Optional[str]) -> str:
+    return source or hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def summarize_document(text: str, source: Optional[str] = None) -> str:
+    token = _routing_key.set(_document_routing_key(text, source))
+    try:
+        return run_llm_steps(document_steps(text, source))
+    finally:
+        _routing_key.reset(token)
+
+async def summarize_document_async(text: str, semaphore: Optional[asyncio.Semaphore] = None, source: Optional[str] = None) -> str:
+    """
+    Async counterpart of summarize_document. Pass the same semaphore to every
+    concurrent call to bound backend requests across documents.
+    """
+    token = _routing_key.set(_document_routing_key(text, source))
+    try:
+        return await run_llm_steps_async(document_steps(text, source), semaphore)
+    finally:
+        _routing_key.reset(token)
+
+async def summarize_documents_async(texts: Dict[str, str], max_concurrent_requests: Optional[int] = None) -> Dict[str, Union[str, BaseException]]:
+    """
+    Summarizes several documents on one event loop, keyed by a display name.
+    Chunk calls from all documents interleave, bounded by one shared semaphore.
+    Output lines are tagged with the document name; a failure is returned as
+    that document's exception instead of cancelling the others.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrent_requests or MAX_CONCURRENT_LLM_REQUESTS))
+    router = sys.stdout if isinstance(sys.stdout, DocumentLogRouter) else DocumentLogRouter(sys.stdout)
+    original_stdout = sys.stdout
+    sys.stdout = router
+
+    async def run(name: str, text: str) -> str:
+        router.set_tag(name)
+        try:
+            return await summarize_document_async(text, semaphore, source=name)
+        finally:
+            router.set_tag(None)
+
+    try:
+        results = await asyncio.gather(*(run(name, text) for name, text in texts.items()), return_exceptions=True)
+    finally:
+        sys.stdout = original_stdout
+    return dict(zip(texts.keys(), results))
+
 def ensure_ai_summaries_dir():
     """Ensure the AI summaries directory exists"""
     if not os.path.exists(AI_SUMMARIES_DIR):
@@ -922,195 +4209,1560 @@ def ensure_ai_summaries_dir():
     else:
         print(f"Using existing directory: {AI_SUMMARIES_DIR}")
 
-def clean_ai_summaries():
+# Characters removed from summaries: anything but letters, digits, whitespace and . , ! ?
+_SUMMARY_DISALLOWED = re.compile(r'[^a-zA-Z0-9.,!?\s]')
+# Summaries are cleaned and written in slices of this many characters
+_SANITIZE_SLICE_CHARS = 1 << 16
+
+def sanitize_summary_pieces(text: str) -> Iterator[str]:
+    """Yields text with the disallowed characters removed, one slice at a time"""
+    for start in range(0, len(text), _SANITIZE_SLICE_CHARS):
+        yield _SUMMARY_DISALLOWED.sub('', text[start:start + _SANITIZE_SLICE_CHARS])
+
+def sanitize_summary(text: str) -> str:
+    return "".join(sanitize_summary_pieces(text))
+
+class CleanSummaryLog(SQLiteStore):
+    """
+    Summary files known to be sanitized, with the size and mtime they had
+    then and the SANITIZER_VERSION used, so a bulk re-clean only reads files
+    that were written by something else or changed since.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS clean_summaries (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sanitizer_version TEXT NOT NULL
+        )""",
+    ]
+
+    def is_clean(self, path: str, stat: os.stat_result) -> bool:
+        row = self._connection().execute(
+            "SELECT size, mtime_ns, sanitizer_version FROM clean_summaries WHERE path = ?", (path,)
+        ).fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns, SANITIZER_VERSION)
+
+    def record_many(self, entries: List[Tuple[str, int, int]]):
+        """Marks (path, size, mtime_ns) entries as clean under the current SANITIZER_VERSION"""
+        if entries:
+            with self._write_transaction() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO clean_summaries (path, size, mtime_ns, sanitizer_version) VALUES (?, ?, ?, ?)",
+                    [(path, size, mtime_ns, SANITIZER_VERSION) for path, size, mtime_ns in entries]
+                )
+
+_clean_summary_log: Optional[CleanSummaryLog] = None
+
+def get_clean_summary_log() -> CleanSummaryLog:
+    global _clean_summary_log
+    with _shared_state_lock:
+        if _clean_summary_log is None:
+            _clean_summary_log = CleanSummaryLog(os.path.join(CACHE_DIR, "summaries.sqlite3"))
+        return _clean_summary_log
+
+def write_summary(summary_path: str, summary: str, source_path: Optional[str] = None):
+    """
+    Sanitizes the summary while writing it atomically, records the file as
+    clean and adds it to the search index
+    """
+    write_text_atomic(summary_path, sanitize_summary_pieces(summary))
+    stat = os.stat(summary_path)
+    get_clean_summary_log().record_many([(os.path.abspath(summary_path), stat.st_size, stat.st_mtime_ns)])
+    try:
+        get_summary_search_index().index_file(summary_path, source_path)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: could not add {summary_path} to the search index: {e}")
+
+def _clean_summary_file(path: str) -> Tuple[str, bool, int, int]:
+    """Sanitizes one summary file in place; runs in a worker process. Returns (path, changed, size, mtime_ns)"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        original = f.read()
+    cleaned = sanitize_summary(original)
+    changed = cleaned != original
+    if changed:
+        write_text_atomic(path, cleaned)
+    stat = os.stat(path)
+    return path, changed, stat.st_size, stat.st_mtime_ns
+
+def clean_ai_summaries(workers: Optional[int] = None):
     """
-    Scans the 'ai summaries' directory, reads each .txt file, removes special characters
-    (keeping letters, numbers, and basic punctuation), and overwrites the file.
+    Bulk re-clean for migrations (`--clean-summaries`): sanitizes every .txt
+    under AI_SUMMARIES_DIR that is not recorded as clean, in parallel worker
+    processes, rewriting changed files atomically. New summaries are already
+    sanitized when they are written, so normal runs do not need this.
     """
     print(f"\n--- Starting AI Summary Cleanup Utility ---")
-    
+
     if not os.path.isdir(AI_SUMMARIES_DIR):
         print(f"Directory '{AI_SUMMARIES_DIR}' not found. Skipping cleanup.")
         print(f"--- AI Summary Cleanup Finished ---\n")
         return
 
-    print(f"Scanning directory: '{AI_SUMMARIES_DIR}' for .txt files to clean.")
-    
-    cleaned_files_count = 0
+    log = get_clean_summary_log()
+    to_clean: List[str] = []
     total_files_scanned = 0
-    
     for root, _, files in os.walk(AI_SUMMARIES_DIR):
         for filename in files:
             if filename.endswith('.txt'):
                 total_files_scanned += 1
-                file_path = os.path.join(root, filename)
-                
-                print(f"  - Processing: {file_path}")
-                try:
-                    original_content = ""
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        original_content = f.read()
-                    
-                    cleaned_content = re.sub(r'[^a-zA-Z0-9.,!?\s]', '', original_content)
-                    
-                    if cleaned_content != original_content:
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            f.write(cleaned_content)
-                        print(f"    -> Content cleaned and file overwritten.")
-                        cleaned_files_count += 1
-                    else:
-                        print(f"    -> No changes needed.")
+                file_path = os.path.abspath(os.path.join(root, filename))
+                if not log.is_clean(file_path, os.stat(file_path)):
+                    to_clean.append(file_path)
+    print(f"Scanned {total_files_scanned} .txt file(s) in '{AI_SUMMARIES_DIR}'; "
+          f"{total_files_scanned - len(to_clean)} already recorded as clean.")
 
+    cleaned_files_count = 0
+    recorded: List[Tuple[str, int, int]] = []
+    workers = max(1, min(workers or CLEAN_SUMMARIES_WORKERS, len(to_clean)))
+    if to_clean:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(_clean_summary_file, path): path for path in to_clean}
+            for future in as_completed(futures):
+                try:
+                    path, changed, size, mtime_ns = future.result()
                 except Exception as e:
-                    print(f"    [ERROR] Could not process file {filename}: {e}")
-    
-    print(f"\nScanned {total_files_scanned} .txt file(s).")
+                    print(f"  [ERROR] Could not process file {futures[future]}: {e}")
+                    continue
+                if changed:
+                    print(f"  - Cleaned: {path}")
+                    cleaned_files_count += 1
+                    get_summary_search_index().index_file(path)
+                recorded.append((path, size, mtime_ns))
+    log.record_many(recorded)
+
     print(f"Cleanup complete. Cleaned and overwrote {cleaned_files_count} file(s).")
     print(f"--- AI Summary Cleanup Finished ---\n")
 
+SUPPORTED_EXTENSIONS = ('.txt', '.pdf', '.gdoc')
+
+def get_summary_path(source_path: str, root_dir: str) -> str:
+    """Path of the *_ai_summary.txt file for a source, mirroring its folder under AI_SUMMARIES_DIR"""
+    base_name = os.path.splitext(os.path.basename(source_path))[0]
+    relative_dir = os.path.relpath(os.path.dirname(source_path), root_dir)
+    abs_summaries_dir = os.path.abspath(AI_SUMMARIES_DIR)
+    target_summary_dir = os.path.join(abs_summaries_dir, relative_dir) if relative_dir != '.' else abs_summaries_dir
+    return os.path.join(target_summary_dir, f"{base_name}_ai_summary.txt")
+
+def get_scan_roots(root_dir: str, target_folders: List[str]) -> List[str]:
+    """Absolute directories to scan: the target folders, or root_dir when none are set"""
+    targets = [f.strip() for f in target_folders if f.strip()] if target_folders else []
+    if not targets:
+        return [os.path.abspath(root_dir)]
+    roots = sorted({os.path.abspath(os.path.join(root_dir, f)) for f in targets})
+    # Drop folders nested inside another target so nothing is scanned twice
+    return [r for r in roots if not any(r != o and r.startswith(o + os.sep) for o in roots)]
+
+def scan_source_files(scan_roots: List[str]) -> Dict[str, os.stat_result]:
+    """
+    Walks the scan roots with os.scandir and returns the stat of every supported
+    file. The summaries and cache directories are pruned rather than walked.
+    """
+    skip_dirs = {os.path.abspath(AI_SUMMARIES_DIR), os.path.abspath(CACHE_DIR)}
+    found: Dict[str, os.stat_result] = {}
+    stack = [root for root in scan_roots if os.path.isdir(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"Warning: cannot scan {directory}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip_dirs:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS) and entry.is_file():
+                        found[entry.path] = entry.stat()
+                except OSError:
+                    continue
+    return found
+
+@dataclass
+class DiscoveryResult:
+    new: List[str]
+    changed: List[str]
+    deleted: List[str]
+    unchanged: int
+
+    @property
+    def to_process(self) -> List[str]:
+        return sorted(self.new + self.changed)
+
+def classify_source(path: str, stat: os.stat_result, entry: Optional[ManifestEntry],
+                    root_dir: str) -> Tuple[str, Optional[ManifestEntry]]:
+    """
+    Returns "new", "changed" or "unchanged" for a scanned source, plus the
+    manifest entry to store when the file turned out unchanged but its record
+    needs updating.
+    """
+    if entry is None:
+        summary_path = get_summary_path(path, root_dir)
+        if os.path.exists(summary_path):
+            # Summary from an earlier run without a manifest: adopt it as-is
+            return "unchanged", ManifestEntry(path, stat.st_size, stat.st_mtime_ns, None,
+                                              MODEL_NAME, PROMPT_VERSION, summary_path)
+        return "new", None
+
+    if entry.model != MODEL_NAME or entry.prompt_version != PROMPT_VERSION:
+        return "changed", None
+    if entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+        return "unchanged", None
+    if entry.content_hash is not None and entry.size == stat.st_size and hash_file(path) == entry.content_hash:
+        entry.mtime_ns = stat.st_mtime_ns
+        return "unchanged", entry
+    return "changed", None
+
+def diff_sources_against_manifest(root_dir: str, target_folders: List[str]) -> DiscoveryResult:
+    """
+    Compares a stat-only scan of the source folders with the manifest.
+    Unchanged size and mtime means unchanged; otherwise the content hash decides,
+    so a touched-but-identical file is not re-summarized. Sources summarized
+    before the manifest existed are adopted the first time they are seen.
+    """
+    manifest = get_source_manifest()
+    known = manifest.load()
+    scan_roots = get_scan_roots(root_dir, target_folders)
+    scanned = scan_source_files(scan_roots)
+
+    new, changed, updates = [], [], []
+    unchanged = 0
+    for path, stat in scanned.items():
+        status, update = classify_source(path, stat, known.get(path), root_dir)
+        if update is not None:
+            updates.append(update)
+        if status == "new":
+            new.append(path)
+        elif status == "changed":
+            changed.append(path)
+        else:
+            unchanged += 1
+
+    deleted = sorted(
+        path for path in known
+        if path not in scanned and any(path.startswith(root + os.sep) for root in scan_roots)
+    )
+    manifest.upsert_many(updates)
+    manifest.remove_many(deleted)
+    return DiscoveryResult(sorted(new), sorted(changed), deleted, unchanged)
+
 def discover_files_to_process(root_dir: str, target_folders: List[str]) -> List[str]:
     """
-    Recursively finds all supported files (txt, pdf, gdoc) that need summarization
-    by checking for the absence of a corresponding summary file.
+    Finds all supported files (txt, pdf, gdoc) that are new or have changed
+    since they were last summarized, using the source manifest.
     """
-    supported_extensions = ('.txt', '.pdf', '.gdoc')
-    files_found = []
-    
-    abs_summaries_dir = os.path.abspath(AI_SUMMARIES_DIR)
-    
-    # Create a list of absolute paths for the target folders for efficient checking
-    abs_target_dirs = []
     if target_folders and any(tf.strip() for tf in target_folders):
-        abs_target_dirs = [os.path.abspath(os.path.join(root_dir, f.strip())) for f in target_folders if f.strip()]
         print(f"Scanning only within specified target folders: {[f.strip() for f in target_folders if f.strip()]}")
     else:
         print("Scanning all subdirectories for processable files...")
 
-    for root, _, files in os.walk(root_dir):
-        abs_root = os.path.abspath(root)
+    result = diff_sources_against_manifest(root_dir, target_folders)
+    print(f"\nDiscovery: {len(result.new)} new, {len(result.changed)} changed, "
+          f"{len(result.deleted)} deleted, {result.unchanged} unchanged source file(s).")
+    for path in result.deleted:
+        print(f"  - Source removed since last run: {path}")
 
-        # 1. Skip the 'ai summaries' directory itself to avoid processing summaries
-        if abs_root.startswith(abs_summaries_dir):
-            continue
+    return result.to_process
+
+@dataclass
+class FileResult:
+    file_path: str
+    status: str  # "success", "failed" or "skipped"
+    message: str
+    elapsed_seconds: float
+
+def process_single_file(file_path: str, docs_service: Optional[Any] = None) -> FileResult:
+    """Reads, summarizes and saves one discovered file, reporting the outcome"""
+    file_type = os.path.splitext(file_path)[1].lstrip('.').lower()
+    with trace_span("document", document=file_path, file_type=file_type) as span:
+        outcome = _process_single_file(file_path, file_type, docs_service)
+        span.set(status=outcome.status)
+        return outcome
+
+def _process_single_file(file_path: str, file_type: str, docs_service: Optional[Any]) -> FileResult:
+    started = time.monotonic()
+    file_name = os.path.basename(file_path)
+
+    def result(status: str, message: str) -> FileResult:
+        return FileResult(file_path, status, message, time.monotonic() - started)
+
+    if file_type == 'gdoc' and not docs_service:
+        print(f"Skipping .gdoc because Google service is unavailable: {file_name}")
+        return result("skipped", "Google Docs service unavailable")
+
+    print(f"\n{'='*50}")
+    print(f"Processing: {file_name} ({file_type.upper()})")
+    print(f"Path: {file_path}")
+    print(f"{'='*50}")
+
+    try:
+        # --- 1. Read file content ---
+        try:
+            # Stat before hashing: a later edit then leaves the manifest entry out of date
+            source_stat = os.stat(file_path)
+            source_hash = hash_file(file_path)
+            content = read_file_content(file_path, file_type, docs_service=docs_service, content_hash=source_hash)
+        except Exception as e:
+            print(f"Error reading file: {e}")
+            return result("failed", f"Error reading file: {e}")
+
+        if not content.strip():
+            print(f"Skipping empty file: {file_name}")
+            return result("skipped", "Empty file")
+
+        # --- 2. Summarize the document ---
+        summary = summarize_document(content, source=file_path)
 
-        # 2. If targets are specified, skip any directories not in the target list
-        if abs_target_dirs:
-            if not any(abs_root.startswith(target_dir) for target_dir in abs_target_dirs):
+        # --- 3. Construct the output path for the summary ---
+        # Mirrors the source's directory (relative to the CWD) inside "ai summaries"
+        summary_path = get_summary_path(file_path, os.getcwd())
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+
+        # --- 4. Save the summary (sanitized as it is written) ---
+        with trace_span("write_summary", bytes=len(summary.encode('utf-8'))):
+            write_summary(summary_path, summary, source_path=file_path)
+        DocumentCheckpoint.for_text(content).delete()
+        get_source_manifest().record(file_path, summary_path, source_hash, source_stat)
+
+        print(f"Summary saved to: {summary_path}")
+        return result("success", summary_path)
+
+    except Exception as e:
+        print(f"An unexpected error occurred while processing {file_name}: {e}")
+        return result("failed", str(e))
+
+def _process_file_tagged(router: DocumentLogRouter, file_path: str, docs_service: Optional[Any]) -> FileResult:
+    router.set_tag(os.path.basename(file_path))
+    try:
+        return process_single_file(file_path, docs_service)
+    finally:
+        router.set_tag(None)
+
+def print_processing_report(results: List[FileResult]):
+    """Prints a per-file success/failure table for the finished run"""
+    print(f"\n{'='*60}")
+    print("PROCESSING REPORT")
+    print(f"{'='*60}")
+    for res in sorted(results, key=lambda r: r.file_path):
+        print(f"[{res.status.upper():7}] {res.elapsed_seconds:8.1f}s  {res.file_path}")
+        if res.status != "success":
+            print(f"{'':20}{res.message}")
+    counts = {status: sum(1 for r in results if r.status == status) for status in ("success", "failed", "skipped")}
+    print(f"{'-'*60}")
+    print(f"Succeeded: {counts['success']}  Failed: {counts['failed']}  Skipped: {counts['skipped']}")
+    print(f"{'='*60}")
+
+# =============================================================================
+# QUESTION ANSWERING
+# =============================================================================
+
+# Bump when the index format or term extraction changes
+_QA_INDEX_VERSION = 1
+_QA_TERM = re.compile(r'[A-Za-z0-9]+')
+_QA_STOPWORDS = frozenset(
+    "a an and are as at be been but by can do does for from had has have how i if in into is it its of on or "
+    "so than that the their then there these they this to was were what when where which who why will with".split()
+)
+
+def qa_terms(text: str) -> List[str]:
+    """Lowercased words of text without stopwords, as indexed and queried by BM25Index"""
+    return [term for term in (match.group(0).lower() for match in _QA_TERM.finditer(text))
+            if term not in _QA_STOPWORDS]
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of one document. Holds one postings list of
+    (chunk number, term frequency) per term and the length of every chunk.
+    """
+
+    def __init__(self, postings: Dict[str, List[Tuple[int, int]]], lengths: List[int]):
+        self.postings = postings
+        self.lengths = lengths
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "BM25Index":
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for number, text in enumerate(texts):
+            terms = qa_terms(text)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings.setdefault(term, []).append((number, frequency))
+        return cls(postings, lengths)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """Best-scoring chunks for query as (chunk number, score), highest first; chunks sharing no term are left out"""
+        scores: Dict[int, float] = {}
+        count = len(self.lengths)
+        for term in set(qa_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
                 continue
-        
-        # 3. Check files in the current valid directory
-        for file_name in files:
-            if file_name.lower().endswith(supported_extensions):
-                files_found.append(os.path.join(root, file_name))
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for number, frequency in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[number] / max(self.average_length, 1e-9))
+                scores[number] = scores.get(number, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
 
-    if not files_found:
-        return []
+    def to_json(self) -> Dict[str, Any]:
+        return {"postings": self.postings, "lengths": self.lengths}
 
-    print(f"\nDiscovered {len(files_found)} total supported files. Checking which ones are new...")
-    files_to_process = []
-    for source_path in files_found:
-        # 4. Check if a summary file already exists for this source file
-        source_dir = os.path.dirname(source_path)
-        source_filename = os.path.basename(source_path)
-        base_name = os.path.splitext(source_filename)[0]
-        summary_filename = f"{base_name}_ai_summary.txt"
-        
-        relative_dir = os.path.relpath(source_dir, root_dir)
-        
-        target_summary_dir = os.path.join(abs_summaries_dir, relative_dir) if relative_dir != '.' else abs_summaries_dir
-        summary_path = os.path.join(target_summary_dir, summary_filename)
-        
-        if not os.path.exists(summary_path):
-            files_to_process.append(source_path)
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "BM25Index":
+        return cls({term: [tuple(p) for p in postings] for term, postings in data["postings"].items()}, data["lengths"])
+
+@dataclass
+class DocumentQAIndex:
+    # (start, end) character offsets of every chunk in the document text
+    spans: List[Tuple[int, int]]
+    bm25: BM25Index
+    structure: str
+
+class QAIndexStore(FileCache):
+    """
+    One gzip-compressed JSON file per document under CACHE_DIR/qa, named after
+    a digest of the text, model, prompt version and chunking settings. Chunk
+    text is not stored; it is sliced from the document by offset.
+    """
+
+    SUFFIX = ".json.gz"
+    DESCRIPTION = "question index"
+
+    def path_for(self, text: str) -> str:
+        digest = hashlib.sha256(
+            f"{_QA_INDEX_VERSION}\0{MODEL_NAME}\0{PROMPT_VERSION}\0{get_tokenizer().name}\0{QA_CHUNK_TOKENS}\0"
+            f"{QA_CHUNK_OVERLAP}\0{text}".encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json.gz")
+
+    def get(self, text: str) -> Optional[DocumentQAIndex]:
+        data = self._load(self.path_for(text), json.loads)
+        if data is None:
+            return None
+        return DocumentQAIndex([tuple(span) for span in data["spans"]], BM25Index.from_json(data["bm25"]), data["structure"])
+
+    def put(self, text: str, index: DocumentQAIndex):
+        data = {"spans": index.spans, "bm25": index.bm25.to_json(), "structure": index.structure}
+        self._store(self.path_for(text), json.JSONEncoder().iterencode(data))
+
+_qa_index_store: Optional[QAIndexStore] = None
+
+def get_qa_index_store() -> QAIndexStore:
+    global _qa_index_store
+    with _shared_state_lock:
+        if _qa_index_store is None:
+            _qa_index_store = QAIndexStore(os.path.join(CACHE_DIR, "qa"), QA_INDEX_MAX_BYTES)
+        return _qa_index_store
+
+def clear_qa_cache():
+    """Deletes all stored question indexes"""
+    removed = QAIndexStore(os.path.join(CACHE_DIR, "qa"), QA_INDEX_MAX_BYTES).clear()
+    print(f"Removed {removed} question index file(s) from {os.path.join(CACHE_DIR, 'qa')}.")
+
+def qa_index_steps(text: str) -> LLMSteps:
+    """
+    Returns the document's question index, building and storing it on first
+    use. Building chunks and indexes the text, and extracts the outline unless
+    an unfinished summarization left one in its checkpoint.
+    """
+    store = get_qa_index_store()
+    index = store.get(text)
+    if index is not None:
+        return index
+
+    token_count = count_tokens(text)
+    print(f"Building question index ({token_count} tokens)...")
+    with trace_span("qa_index", tokens_before=token_count) as span:
+        chunks = chunk_text(text, QA_CHUNK_TOKENS, QA_CHUNK_OVERLAP)
+        bm25 = BM25Index.build([chunk.text for chunk in chunks])
+        span.set(chunks=len(chunks), terms=len(bm25.postings))
+
+    structure = DocumentCheckpoint.for_text(text).get("structure")
+    if structure is None:
+        with trace_span("structure", tokens_before=token_count) as span:
+            structure = yield from structure_steps(text, get_strategy_config(token_count))
+            span.set(tokens_after=count_tokens(structure))
+    else:
+        print("Using document structure from checkpoint.")
+
+    index = DocumentQAIndex([(chunk.start, chunk.end) for chunk in chunks], bm25, structure)
+    store.put(text, index)
+    return index
+
+def answer_steps(text: str, question: str, top_k: Optional[int] = None) -> LLMSteps:
+    index = yield from qa_index_steps(text)
+
+    with trace_span("qa_retrieve", chunks=len(index.spans)) as span:
+        hits = index.bm25.search(question, top_k or QA_TOP_K)
+        span.set(hits=len(hits))
+    if not hits:
+        print("Warning: no passage of the document matches the question's terms; answering from the outline only.")
+
+    # Excerpts go to the model in document order, labeled with their line range
+    excerpts = []
+    for n, (number, score) in enumerate(sorted(hits), start=1):
+        start, end = index.spans[number]
+        first_line = text.count('\n', 0, start) + 1
+        last_line = first_line + text.count('\n', start, end)
+        print(f"  Excerpt {n}: lines {first_line}-{last_line} (score {score:.2f})")
+        excerpts.append(f"--- EXCERPT {n} (lines {first_line}-{last_line}) ---\n{text[start:end]}")
+
+    prompt = "\n\n".join(excerpts) if excerpts else "(No excerpt of the document matches the question.)"
+    return (yield LLMRequest(f"{prompt}\n\nQUESTION: {question}", system_prompt=build_answer_prompt(index.structure)))
+
+def answer_question(text: str, question: str, source: Optional[str] = None, top_k: Optional[int] = None) -> str:
+    """
+    Answers question from the top_k (default QA_TOP_K) chunks of text that
+    match it best instead of summarizing the whole document. The first question
+    about a document builds its index and outline; later ones take one LLM call.
+    """
+    token = _routing_key.set(_document_routing_key(text, source))
+    try:
+        return run_llm_steps(answer_steps(text, question, top_k))
+    finally:
+        _routing_key.reset(token)
+
+def ask_document(file_path: str, question: str):
+    """Reads a TXT, PDF or Google Doc file and prints the answer to question (`--ask`)"""
+    file_type = os.path.splitext(file_path)[1].lstrip('.').lower()
+    if not file_path.lower().endswith(SUPPORTED_EXTENSIONS):
+        print(f"Unsupported file type: {file_path}")
+        return
+    docs_service = DocsServiceLoader().get() if file_type == 'gdoc' else None
+    if file_type == 'gdoc' and not docs_service:
+        return
+    try:
+        content = read_file_content(file_path, file_type, docs_service=docs_service, content_hash=hash_file(file_path))
+    except Exception as e:
+        print(f"Error reading file: {e}")
+        return
+    if not content.strip():
+        print(f"Empty file: {file_path}")
+        return
+
+    started = time.monotonic()
+    answer = answer_question(content, question, source=file_path)
+    print(f"\n{'='*60}")
+    print(f"QUESTION: {question}")
+    print(f"{'='*60}")
+    print(answer)
+    print(f"{'='*60}")
+    print(f"Answered in {time.monotonic() - started:.1f}s.")
 
-    return files_to_process
+# =============================================================================
+# SUMMARY SEARCH
+# =============================================================================
 
-def process_discovered_files():
+@dataclass
+class SearchHit:
+    summary_path: str
+    source_path: Optional[str]
+    score: float
+    snippet: str
+
+def parse_search_query(query: str) -> Tuple[List[str], List[List[str]]]:
+    """Splits a query into its words and its "quoted phrases" (as word lists), lowercased"""
+    phrases = [words for words in ([m.group(0).lower() for m in _QA_TERM.finditer(phrase)]
+                                   for phrase in re.findall(r'"([^"]*)"', query)) if words]
+    words = [m.group(0).lower() for m in _QA_TERM.finditer(query)]
+    return list(dict.fromkeys(words)), phrases
+
+class SummarySearchIndex(SQLiteStore):
+    """
+    Positional inverted index over the summary files. Each (term, summary)
+    posting holds the term frequency and the word positions as packed uint32,
+    which phrase queries check for consecutive runs. A summary is reindexed
+    whenever it is written; reindex() catches up with files changed or
+    removed outside the pipeline.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS summaries (
+            doc_id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            source_path TEXT,
+            length INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS postings (
+            term TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            frequency INTEGER NOT NULL,
+            positions BLOB NOT NULL,
+            PRIMARY KEY (term, doc_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id)",
+    ]
+
+    def index_file(self, path: str, source_path: Optional[str] = None):
+        """(Re)indexes one summary file; an existing entry keeps its source path unless a new one is given"""
+        path = os.path.abspath(path)
+        with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+            text = file.read()
+        stat = os.stat(path)
+        positions: Dict[str, List[int]] = {}
+        length = 0
+        for length, match in enumerate(_QA_TERM.finditer(text), start=1):
+            positions.setdefault(match.group(0).lower(), []).append(length - 1)
+
+        with self._write_transaction() as conn:
+            row = conn.execute("SELECT doc_id FROM summaries WHERE path = ?", (path,)).fetchone()
+            if row:
+                doc_id = row[0]
+                conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+                conn.execute(
+                    "UPDATE summaries SET source_path = COALESCE(?, source_path), length = ?, size = ?, mtime_ns = ? "
+                    "WHERE doc_id = ?", (source_path, length, stat.st_size, stat.st_mtime_ns, doc_id)
+                )
+            else:
+                doc_id = conn.execute(
+                    "INSERT INTO summaries (path, source_path, length, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                    (path, source_path, length, stat.st_size, stat.st_mtime_ns)
+                ).lastrowid
+            conn.executemany(
+                "INSERT INTO postings (term, doc_id, frequency, positions) VALUES (?, ?, ?, ?)",
+                [(term, doc_id, len(found), np.array(found, dtype=np.uint32).tobytes()) for term, found in positions.items()]
+            )
+
+    def remove(self, path: str):
+        with self._write_transaction() as conn:
+            row = conn.execute("SELECT doc_id FROM summaries WHERE path = ?", (path,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM postings WHERE doc_id = ?", (row[0],))
+                conn.execute("DELETE FROM summaries WHERE doc_id = ?", (row[0],))
+
+    def reindex(self, directory: str, sources: Dict[str, str]) -> Tuple[int, int]:
+        """
+        Indexes *_ai_summary.txt files under directory that are new or changed
+        since they were indexed and drops entries whose file is gone. sources
+        maps summary paths to source paths. Returns (indexed, removed).
+        """
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self._connection().execute("SELECT path, size, mtime_ns FROM summaries")}
+        seen = set()
+        indexed = 0
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                if not filename.endswith('_ai_summary.txt'):
+                    continue
+                path = os.path.abspath(os.path.join(root, filename))
+                seen.add(path)
+                stat = os.stat(path)
+                if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                    self.index_file(path, sources.get(path))
+                    indexed += 1
+        removed = [path for path in known if path not in seen]
+        for path in removed:
+            self.remove(path)
+        return indexed, len(removed)
+
+    def _positions(self, term: str, doc_id: int) -> np.ndarray:
+        row = self._connection().execute(
+            "SELECT positions FROM postings WHERE term = ? AND doc_id = ?", (term, doc_id)
+        ).fetchone()
+        return np.frombuffer(row[0], dtype=np.uint32) if row else np.empty(0, dtype=np.uint32)
+
+    def _phrase_start(self, phrase: List[str], doc_id: int) -> Optional[int]:
+        """Word position where phrase first occurs in the summary, or None"""
+        starts = self._positions(phrase[0], doc_id).astype(np.int64)
+        for offset, term in enumerate(phrase[1:], start=1):
+            if not len(starts):
+                return None
+            starts = np.intersect1d(starts, self._positions(term, doc_id).astype(np.int64) - offset)
+        return int(starts[0]) if len(starts) else None
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[SearchHit]:
+        """
+        Summaries matching query, best first. Any word may match, ranked by
+        BM25; every "quoted phrase" in the query must appear word for word.
+        """
+        words, phrases = parse_search_query(query)
+        if not words:
+            return []
+        conn = self._connection()
+        count, average_length = conn.execute("SELECT COUNT(*), AVG(length) FROM summaries").fetchone()
+        if not count:
+            return []
+
+        scores: Dict[int, float] = {}
+        for term in words:
+            rows = conn.execute(
+                "SELECT p.doc_id, p.frequency, s.length FROM postings p JOIN summaries s ON s.doc_id = p.doc_id "
+                "WHERE p.term = ?", (term,)
+            ).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            for doc_id, frequency, length in rows:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / max(average_length, 1e-9))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        anchors: Dict[int, Optional[int]] = {}
+        if phrases:
+            ranked = []
+            for doc_id, score in sorted(scores.items(), key=lambda item: -item[1]):
+                starts = [self._phrase_start(phrase, doc_id) for phrase in phrases]
+                if all(start is not None for start in starts):
+                    anchors[doc_id] = min(starts)
+                    ranked.append((doc_id, score))
+                    if len(ranked) == (limit or SEARCH_RESULTS):
+                        break
+        else:
+            ranked = heapq.nlargest(limit or SEARCH_RESULTS, scores.items(), key=lambda item: item[1])
+
+        hits = []
+        for doc_id, score in ranked:
+            path, source_path = conn.execute(
+                "SELECT path, source_path FROM summaries WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            try:
+                snippet = search_snippet(path, set(words), anchors.get(doc_id))
+            except OSError:
+                continue
+            hits.append(SearchHit(path, source_path, score, snippet))
+        return hits
+
+def search_snippet(path: str, terms: set, anchor: Optional[int] = None) -> str:
+    """
+    About SEARCH_SNIPPET_WORDS words of the summary around the word at anchor,
+    or around the first word in terms, with matching words in [brackets]
+    """
+    with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+        text = file.read()
+    matches = list(_QA_TERM.finditer(text))
+    if not matches:
+        return ""
+    if anchor is None:
+        anchor = next((i for i, m in enumerate(matches) if m.group(0).lower() in terms), 0)
+    first = max(0, anchor - SEARCH_SNIPPET_WORDS // 3)
+    last = min(len(matches), first + SEARCH_SNIPPET_WORDS) - 1
+    pieces = []
+    position = matches[first].start()
+    for match in matches[first:last + 1]:
+        pieces.append(text[position:match.start()])
+        pieces.append(f"[{match.group(0)}]" if match.group(0).lower() in terms else match.group(0))
+        position = match.end()
+    snippet = " ".join("".join(pieces).split())
+    return f"{'... ' if first > 0 else ''}{snippet}{' ...' if last < len(matches) - 1 else ''}"
+
+_summary_search_index: Optional[SummarySearchIndex] = None
+
+def get_summary_search_index() -> SummarySearchIndex:
+    global _summary_search_index
+    with _shared_state_lock:
+        if _summary_search_index is None:
+            _summary_search_index = SummarySearchIndex(os.path.join(CACHE_DIR, "search.sqlite3"))
+        return _summary_search_index
+
+def reindex_summaries():
+    """Brings the search index up to date with AI_SUMMARIES_DIR, e.g. for summaries written before it existed"""
+    if not os.path.isdir(AI_SUMMARIES_DIR):
+        print(f"Directory '{AI_SUMMARIES_DIR}' not found. Nothing to index.")
+        return
+    sources = {entry.summary_path: path for path, entry in get_source_manifest().load().items() if entry.summary_path}
+    indexed, removed = get_summary_search_index().reindex(AI_SUMMARIES_DIR, sources)
+    print(f"Search index updated: {indexed} summary(ies) indexed, {removed} removed.")
+
+def search_summaries(query: str, limit: Optional[int] = None):
+    """Prints the summaries best matching query with a snippet and their source document (`--search`)"""
+    started = time.perf_counter()
+    hits = get_summary_search_index().search(query, limit)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for rank, hit in enumerate(hits, start=1):
+        print(f"\n{rank}. {hit.summary_path}  (score {hit.score:.2f})")
+        print(f"   Source: {hit.source_path or 'unknown'}")
+        print(f"   {hit.snippet}")
+    print(f"\n{len(hits)} result(s) in {elapsed_ms:.1f} ms.")
+
+# =============================================================================
+# JOB QUEUE
+# =============================================================================
+
+@dataclass
+class Job:
+    path: str
+    attempt: int
+    cost: int
+    attempt_id: int
+
+def estimate_job_cost(path: str, size: int) -> int:
+    """
+    Rough token count of a source from its file size, used to run short
+    documents first. Text is ~4 bytes per token; PDFs carry fonts, images and
+    layout, so far fewer of their bytes are text. A .gdoc is only a link.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.gdoc':
+        return MEDIUM_DOC_THRESHOLD
+    return size // (40 if extension == '.pdf' else 4)
+
+def job_retry_delay(attempt: int) -> float:
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+def job_owner_id() -> str:
+    """Identifies this process in the queue; leases are renewed per process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class JobQueue(SQLiteStore):
+    """
+    Durable queue of documents to summarize, shared by every worker process on
+    the host. A job moves pending -> running -> done; a failure sends it back
+    to pending with a backoff, or to failed once JOB_MAX_ATTEMPTS is used up.
+    Workers claim the ready job with the smallest estimated cost
+    (shortest-job-first) inside an immediate transaction, so two processes
+    never get the same job. Claimed jobs hold a lease that their process keeps
+    renewing; if it lapses the job is returned to the queue and the lost run
+    counts as an attempt. A source that changes while its job is running is
+    marked dirty and queued again when the job completes. Every attempt is
+    kept in the attempts table.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            path TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            cost INTEGER NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_expires_at REAL,
+            last_error TEXT,
+            dirty INTEGER NOT NULL DEFAULT 0,
+            enqueued_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, cost)",
+        """CREATE TABLE IF NOT EXISTS attempts (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            attempt INTEGER NOT NULL,
+            worker TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            status TEXT,
+            message TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS attempts_by_path ON attempts (path, id)",
+        "CREATE INDEX IF NOT EXISTS attempts_by_start ON attempts (started_at)",
+    ]
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        columns = {row[1] for row in self._connection().execute("PRAGMA table_info(jobs)")}
+        if "dirty" not in columns:
+            self._connection().execute("ALTER TABLE jobs ADD COLUMN dirty INTEGER NOT NULL DEFAULT 0")
+
+    def enqueue_many(self, paths: List[str], retry_failed: bool = False) -> int:
+        """
+        Queues sources as pending. Finished jobs are queued again; failed ones
+        only when the file changed since or retry_failed is set. Pending jobs
+        are left alone, and running ones are marked dirty if the file changed
+        since they were queued. Returns the number of jobs queued.
+        """
+        rows = []
+        now = time.time()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rows.append((path, estimate_job_cost(path, stat.st_size), stat.st_size, stat.st_mtime_ns, now, now))
+        if not rows:
+            return 0
+        with self._write_transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT INTO jobs (path, state, cost, size, mtime_ns, enqueued_at, updated_at) "
+                "VALUES (?, 'pending', ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state = 'pending', cost = excluded.cost, size = excluded.size, "
+                "mtime_ns = excluded.mtime_ns, attempts = 0, next_attempt_at = 0, last_error = NULL, "
+                "enqueued_at = excluded.enqueued_at, updated_at = excluded.updated_at "
+                "WHERE jobs.state = 'done' OR (jobs.state = 'failed' AND "
+                f"({int(retry_failed)} OR jobs.size IS NOT excluded.size OR jobs.mtime_ns IS NOT excluded.mtime_ns))",
+                rows
+            )
+            queued = conn.total_changes - before
+            # The running attempt may have read the file before this change
+            conn.executemany(
+                "UPDATE jobs SET dirty = 1, size = ?, mtime_ns = ? WHERE path = ? AND state = 'running' "
+                "AND (size IS NOT ? OR mtime_ns IS NOT ?)",
+                [(size, mtime_ns, path, size, mtime_ns) for path, _, size, mtime_ns, _, _ in rows]
+            )
+            return queued
+
+    def _reclaim_expired(self, conn: sqlite3.Connection, now: float):
+        expired = conn.execute(
+            "SELECT path, attempts, dirty FROM jobs WHERE state = 'running' AND lease_expires_at < ?", (now,)
+        ).fetchall()
+        for path, attempts, dirty in expired:
+            print(f"Warning: lease expired for {path}; returning it to the queue.")
+            conn.execute(
+                "UPDATE attempts SET finished_at = ?, status = 'lost', message = 'worker stopped renewing its lease' "
+                "WHERE path = ? AND finished_at IS NULL", (now, path)
+            )
+            conn.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_expires_at = NULL, next_attempt_at = ?, dirty = 0, "
+                "last_error = 'worker lost', updated_at = ? WHERE path = ?",
+                ("failed" if attempts >= JOB_MAX_ATTEMPTS and not dirty else "pending", now, now, path)
+            )
+
+    def claim(self, owner: str, worker: str) -> Optional[Job]:
+        """Takes the cheapest ready job for this process, or returns None"""
+        now = time.time()
+        with self._write_transaction() as conn:
+            self._reclaim_expired(conn, now)
+            row = conn.execute(
+                "SELECT path, attempts, cost FROM jobs WHERE state = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY cost, enqueued_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            path, attempts, cost = row
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, owner = ?, lease_expires_at = ?, "
+                "updated_at = ? WHERE path = ?", (owner, now + JOB_LEASE_SECONDS, now, path)
+            )
+            cursor = conn.execute(
+                "INSERT INTO attempts (path, attempt, worker, started_at) VALUES (?, ?, ?, ?)",
+                (path, attempts + 1, worker, now)
+            )
+            return Job(path, attempts + 1, cost, cursor.lastrowid)
+
+    def complete(self, job: Job, owner: str, result: FileResult) -> Tuple[str, float]:
+        """
+        Records the attempt's outcome; returns the job's new state and the retry
+        delay. The state is "requeued" when the source changed during the
+        attempt (the job is pending again with its attempts reset) and "lost"
+        if the job was reclaimed.
+        """
+        now = time.time()
+        delay = 0.0
+        if result.status != "failed":
+            state = "done"
+        elif job.attempt >= JOB_MAX_ATTEMPTS:
+            state = "failed"
+        else:
+            state, delay = "pending", job_retry_delay(job.attempt)
+        with self._write_transaction() as conn:
+            conn.execute(
+                "UPDATE attempts SET finished_at = ?, status = ?, message = ? WHERE id = ? AND finished_at IS NULL",
+                (now, result.status, result.message, job.attempt_id)
+            )
+            row = conn.execute(
+                "SELECT dirty FROM jobs WHERE path = ? AND owner = ? AND state = 'running'", (job.path, owner)
+            ).fetchone()
+            if row is None:
+                # The lease ran out and another worker took the job over meanwhile
+                return "lost", 0.0
+            if row[0]:
+                conn.execute(
+                    "UPDATE jobs SET state = 'pending', attempts = 0, next_attempt_at = 0, dirty = 0, owner = NULL, "
+                    "lease_expires_at = NULL, last_error = NULL, updated_at = ? WHERE path = ?", (now, job.path)
+                )
+                return "requeued", 0.0
+            conn.execute(
+                "UPDATE jobs SET state = ?, next_attempt_at = ?, owner = NULL, lease_expires_at = NULL, "
+                "last_error = ?, updated_at = ? WHERE path = ?",
+                (state, now + delay, result.message if result.status == "failed" else None, now, job.path)
+            )
+        return state, delay
+
+    def release(self, owner: str):
+        """Returns this process's running jobs to the queue without counting the attempt"""
+        now = time.time()
+        with self._write_transaction() as conn:
+            paths = [row[0] for row in conn.execute(
+                "SELECT path FROM jobs WHERE state = 'running' AND owner = ?", (owner,))]
+            for path in paths:
+                conn.execute(
+                    "UPDATE attempts SET finished_at = ?, status = 'interrupted' WHERE path = ? AND finished_at IS NULL",
+                    (now, path)
+                )
+            conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = attempts - 1, owner = NULL, lease_expires_at = NULL, "
+                "dirty = 0, updated_at = ? WHERE state = 'running' AND owner = ?", (now, owner)
+            )
+
+    def renew_leases(self, owner: str):
+        self._connection().execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE state = 'running' AND owner = ?",
+            (time.time() + JOB_LEASE_SECONDS, owner)
+        )
+
+    def remove(self, path: str):
+        self._connection().execute("DELETE FROM jobs WHERE path = ?", (path,))
+
+    def seconds_until_ready(self) -> Optional[float]:
+        """Time until the next pending job may be claimed, or None when nothing is pending"""
+        row = self._connection().execute("SELECT MIN(next_attempt_at) FROM jobs WHERE state = 'pending'").fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def results_since(self, since: float) -> List[FileResult]:
+        """The latest finished attempt of every job attempted since the given time"""
+        rows = self._connection().execute(
+            "SELECT path, status, message, finished_at - started_at FROM attempts WHERE id IN ("
+            "SELECT MAX(id) FROM attempts WHERE started_at >= ? AND finished_at IS NOT NULL "
+            "AND status != 'interrupted' GROUP BY path)", (since,)
+        )
+        return [FileResult(path, "failed" if status == "lost" else status, message or "", elapsed)
+                for path, status, message, elapsed in rows]
+
+_job_queue: Optional[JobQueue] = None
+
+def get_job_queue() -> JobQueue:
+    global _job_queue
+    with _shared_state_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(os.path.join(CACHE_DIR, "jobs.sqlite3"))
+        return _job_queue
+
+class LeaseKeeper:
+    """Background thread that renews this process's job leases while documents are in progress"""
+
+    def __init__(self, job_queue: JobQueue, owner: str):
+        self.job_queue = job_queue
+        self.owner = owner
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-leases", daemon=True)
+
+    def start(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                self.job_queue.renew_leases(self.owner)
+            except sqlite3.Error as e:
+                print(f"Warning: could not renew job leases: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class DocsServiceLoader:
+    """Initializes the Google Docs service the first time a .gdoc job needs it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._service: Optional[Any] = None
+
+    def get(self) -> Optional[Any]:
+        with self._lock:
+            if not self._loaded:
+                print("\nFound a Google Doc to process, initializing Google Docs API service...")
+                self._service = get_docs_service()
+                if not self._service:
+                    print("Failed to initialize Google Docs service. Skipping .gdoc files for this run.")
+                self._loaded = True
+            return self._service
+
+def run_job_worker(job_queue: JobQueue, owner: str, stop: threading.Event, docs: DocsServiceLoader,
+                   router: Optional[DocumentLogRouter] = None, exit_when_idle: bool = True,
+                   on_result: Optional[Callable[[FileResult], None]] = None):
+    """
+    Claims and processes jobs until stop is set. With exit_when_idle the worker
+    returns once nothing is pending, waiting out retry backoffs first;
+    otherwise it keeps polling for new jobs.
+    """
+    worker = f"{owner}/{threading.current_thread().name}"
+    while not stop.is_set():
+        job = job_queue.claim(owner, worker)
+        if job is None:
+            wait = job_queue.seconds_until_ready() if exit_when_idle else 1.0
+            if wait is None:
+                return
+            stop.wait(min(max(wait, 0.05), 1.0))
+            continue
+        if not os.path.exists(job.path):
+            print(f"Source removed before it was processed: {job.path}")
+            job_queue.remove(job.path)
+            continue
+
+        service = docs.get() if job.path.lower().endswith('.gdoc') else None
+        try:
+            result = _process_file_tagged(router, job.path, service) if router else process_single_file(job.path, service)
+        except Exception as e:
+            result = FileResult(job.path, "failed", str(e), 0.0)
+        state, delay = job_queue.complete(job, owner, result)
+        if state == "requeued":
+            print(f"{job.path} changed while it was processed; queued again.")
+        elif state == "pending":
+            print(f"Attempt {job.attempt} of {JOB_MAX_ATTEMPTS} failed for {job.path}; retrying in {delay:.0f}s.")
+        elif state == "failed":
+            print(f"Giving up on {job.path} after {job.attempt} attempt(s): {result.message}")
+        if on_result:
+            on_result(result)
+
+def drain_job_queue(job_queue: JobQueue, workers: Optional[int] = None, tag_output: bool = False):
+    """
+    Processes queued jobs in this process with `workers` threads (default
+    MAX_CONCURRENT_DOCUMENTS) until none are pending. On Ctrl+C the jobs in
+    progress are returned to the queue.
+    """
+    workers = max(1, workers or MAX_CONCURRENT_DOCUMENTS)
+    owner = job_owner_id()
+    stop = threading.Event()
+    docs = DocsServiceLoader()
+    router = DocumentLogRouter(sys.stdout) if workers > 1 or tag_output else None
+    original_stdout = sys.stdout
+    if router:
+        sys.stdout = router
+    leases = LeaseKeeper(job_queue, owner).start()
+    threads = [
+        threading.Thread(target=run_job_worker, args=(job_queue, owner, stop, docs, router),
+                         name=f"doc-{i}", daemon=True)
+        for i in range(workers)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        job_queue.release(owner)
+        raise
+    finally:
+        leases.stop()
+        sys.stdout = original_stdout
+
+def _config_snapshot() -> Dict[str, Any]:
+    """The script configuration (including command-line overrides) for spawned workers"""
+    return {name: value for name, value in globals().items()
+            if name.isupper() and isinstance(value, (str, int, float, bool, list, tuple, dict, type(None)))}
+
+def _job_worker_process(config: Dict[str, Any]):
+    globals().update(config)
+    try:
+        drain_job_queue(get_job_queue(), tag_output=True)
+    except KeyboardInterrupt:
+        pass
+
+def run_worker_processes(count: int):
+    """Drains the queue with `count` spawned worker processes and waits for them"""
+    context = multiprocessing.get_context("spawn")
+    config = _config_snapshot()
+    processes = [context.Process(target=_job_worker_process, args=(config,), name=f"construct-ai-worker-{i}")
+                 for i in range(count)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers got the same Ctrl+C and hand their jobs back before exiting
+        for process in processes:
+            process.join()
+        raise
+    for process in processes:
+        if process.exitcode:
+            print(f"Warning: {process.name} exited with code {process.exitcode}; "
+                  f"its jobs are retried once their leases expire.")
+
+def process_discovered_files(retry_failed: bool = False) -> List[FileResult]:
     """
     New main processing function that discovers files directly without using a CSV.
+    Up to MAX_CONCURRENT_DOCUMENTS files are processed at once; the number of
+    simultaneous LLM requests is bounded separately by MAX_CONCURRENT_LLM_REQUESTS.
     """
     print("Starting file discovery process...")
     
     # Discover files that need processing from the current working directory
     files_to_process = discover_files_to_process(os.getcwd(), FOLDERS_TO_PROCESS)
-    
-    if not files_to_process:
+    job_queue = get_job_queue()
+    job_queue.enqueue_many(files_to_process, retry_failed=retry_failed)
+    counts = job_queue.counts()
+
+    if not counts.get("pending"):
         print("\nNo new files to summarize at this time. All summaries are up to date.")
-        return
-        
-    print(f"\nFound {len(files_to_process)} new file(s) to process.")
-    
+        if counts.get("failed"):
+            print(f"{counts['failed']} file(s) failed {JOB_MAX_ATTEMPTS} times and are skipped until they "
+                  f"change; run with --retry-failed to try them again.")
+        return []
+
+    print(f"\nFound {len(files_to_process)} new file(s); {counts['pending']} job(s) queued.")
+
     ensure_ai_summaries_dir()
-    
-    docs_service = None
-    # Check if any .gdoc files need processing before initializing the service
-    if any(f.lower().endswith('.gdoc') for f in files_to_process):
-        print("\nFound Google Doc files to process, initializing Google Docs API service...")
-        docs_service = get_docs_service()
-        if not docs_service:
-            print("Failed to initialize Google Docs service. Skipping .gdoc files for this run.")
-
-    for file_path in files_to_process:
-        file_name = os.path.basename(file_path)
-        file_type = os.path.splitext(file_name)[1].lstrip('.').lower()
-        
-        if file_type == 'gdoc' and not docs_service:
-            print(f"Skipping .gdoc because Google service is unavailable: {file_name}")
-            continue
 
-        print(f"\n{'='*50}")
-        print(f"Processing: {file_name} ({file_type.upper()})")
-        print(f"Path: {file_path}")
-        print(f"{'='*50}")
-        
+    started = time.time()
+    processes = max(1, JOB_WORKER_PROCESSES)
+    workers = max(1, MAX_CONCURRENT_DOCUMENTS)
+    if processes > 1 or workers > 1:
+        print(f"Processing with {processes} worker process(es) x {workers} document(s) in flight, "
+              f"at most {MAX_CONCURRENT_LLM_REQUESTS} concurrent LLM request(s) per process.")
+    if processes > 1:
+        run_worker_processes(processes)
+    else:
+        drain_job_queue(job_queue)
+    results = job_queue.results_since(started)
+
+    print_processing_report(results)
+    counts = job_queue.counts()
+    if counts.get("pending") or counts.get("failed"):
+        print(f"Job queue: {counts.get('pending', 0)} pending, {counts.get('failed', 0)} failed "
+              f"after {JOB_MAX_ATTEMPTS} attempts.")
+    print(prefill_stats.report())
+    if ADAPTIVE_CONCURRENCY:
+        print(get_llm_slots().report())
+    if len(get_endpoint_pool()) > 1:
+        print(get_endpoint_pool().report())
+    if DEDUP_ENABLED:
+        print(dedup_stats.report())
+    metrics_path = write_trace_metrics()
+    if metrics_path:
+        print(f"Trace written to {get_tracer().trace_path}, metrics to {metrics_path}")
+    cache = get_llm_cache()
+    if cache:
+        stats = cache.stats()
+        print(f"LLM cache: {stats['hits']} hit(s), {stats['misses']} miss(es), "
+              f"{stats['evictions']} eviction(s), {stats['entries']} entries ({stats['bytes'] / 1e6:.1f} MB)")
+    print(f"\nAll processing complete!")
+    return results
+
+# =============================================================================
+# WATCH MODE
+# =============================================================================
+
+class PollingWatcher:
+    """Detects new and modified source files by rescanning the folders every WATCH_POLL_INTERVAL seconds"""
+
+    name = "polling"
+
+    def __init__(self, roots: List[str]):
+        self.roots = roots
+        self.overflowed = False
+        self._snapshot = {path: (st.st_size, st.st_mtime_ns) for path, st in scan_source_files(roots).items()}
+        self._next_poll = time.monotonic() + WATCH_POLL_INTERVAL
+
+    def changes(self, timeout: float) -> List[str]:
+        wait = self._next_poll - time.monotonic()
+        if wait > 0:
+            time.sleep(min(timeout, wait))
+            return []
+        self._next_poll = time.monotonic() + WATCH_POLL_INTERVAL
+        current = {path: (st.st_size, st.st_mtime_ns) for path, st in scan_source_files(self.roots).items()}
+        changed = [path for path, key in current.items() if self._snapshot.get(path) != key]
+        self._snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Linux inotify watcher over ctypes (no extra dependency). Every directory
+    under the roots is watched; directories created later are added as they
+    appear, and files already inside them are reported. If the kernel queue
+    overflows, `overflowed` is set so the caller can fall back to a rescan.
+    """
+
+    name = "inotify"
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, roots: List[str]):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self._skip_dirs = {os.path.abspath(AI_SUMMARIES_DIR), os.path.abspath(CACHE_DIR)}
+        self._directories: Dict[int, str] = {}
+        self.overflowed = False
         try:
-            # --- 1. Read file content ---
+            for root in roots:
+                if os.path.isdir(root):
+                    self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, top: str) -> List[str]:
+        """Watches top and its subdirectories; returns the supported files found in them"""
+        files = []
+        for directory, subdirs, names in os.walk(top):
+            subdirs[:] = [d for d in subdirs if os.path.join(directory, d) not in self._skip_dirs]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"cannot watch {directory}: {os.strerror(errno)} "
+                                     f"(see /proc/sys/fs/inotify/max_user_watches)")
+            self._directories[wd] = directory
+            files.extend(os.path.join(directory, n) for n in names if n.lower().endswith(SUPPORTED_EXTENSIONS))
+        return files
+
+    def changes(self, timeout: float) -> List[str]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        data = b""
+        while True:
             try:
-                content = read_file_content(file_path, file_type, docs_service=docs_service)
-            except Exception as e:
-                print(f"Error reading file: {e}")
+                piece = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not piece:
+                break
+            data += piece
+
+        changed = []
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _cookie, length = self._EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self._EVENT.size:offset + self._EVENT.size + length].rstrip(b"\0"))
+            offset += self._EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
                 continue
-            
-            if not content.strip():
-                print(f"Skipping empty file: {file_name}")
+            directory = self._directories.get(wd)
+            if mask & self.IN_IGNORED:
+                self._directories.pop(wd, None)
                 continue
-            
-            # --- 2. Summarize the document ---
-            summary = summarize_document(content)
-            
-            # --- 3. Construct the output path for the summary ---
-            base_name = os.path.splitext(file_name)[0]
-            summary_filename = f"{base_name}_ai_summary.txt"
-            
-            original_dir = os.path.dirname(file_path)
-            
-            # Get the directory relative to the CWD to replicate it inside "ai summaries"
-            relative_dir = os.path.relpath(original_dir, os.getcwd())
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and path not in self._skip_dirs:
+                    try:
+                        changed.extend(self._watch_tree(path))
+                    except OSError as e:
+                        print(f"Warning: {e}")
+                        self.overflowed = True
+            elif name.lower().endswith(SUPPORTED_EXTENSIONS):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+def create_watcher(roots: List[str]):
+    """Returns an inotify watcher where possible, otherwise a polling one"""
+    try:
+        return InotifyWatcher(roots)
+    except (OSError, AttributeError) as e:
+        print(f"Warning: inotify unavailable ({e}); polling every {WATCH_POLL_INTERVAL:g}s instead.")
+        return PollingWatcher(roots)
 
-            if relative_dir == '.':
-                 target_summary_dir = os.path.abspath(AI_SUMMARIES_DIR)
-            else:
-                target_summary_dir = os.path.join(os.path.abspath(AI_SUMMARIES_DIR), relative_dir)
-            
-            os.makedirs(target_summary_dir, exist_ok=True)
-            
-            summary_path = os.path.join(target_summary_dir, summary_filename)
+class FileDebouncer:
+    """
+    Holds changed files until they are complete: a file is released once its
+    size and mtime have stayed the same, and its mtime is at least
+    quiet_seconds old. Files that disappear are dropped.
+    """
 
-            # --- 4. Save the summary ---
-            with open(summary_path, 'w', encoding='utf-8') as file:
-                file.write(summary)
-            
-            print(f"Summary saved to: {summary_path}")
-            
-        except Exception as e:
-            print(f"An unexpected error occurred while processing {file_name}: {e}")
-            continue
-    
-    print(f"\nAll processing complete!")
+    def __init__(self, quiet_seconds: float):
+        self.quiet_seconds = quiet_seconds
+        self._pending: Dict[str, Tuple[int, int, float]] = {}
+
+    def observe(self, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        previous = self._pending.get(path)
+        if previous is None or previous[:2] != (stat.st_size, stat.st_mtime_ns):
+            self._pending[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def ready(self) -> List[str]:
+        released = []
+        now = time.monotonic()
+        for path, (size, mtime_ns, seen_at) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - seen_at >= self.quiet_seconds or time.time() - mtime_ns / 1e9 >= self.quiet_seconds:
+                del self._pending[path]
+                released.append(path)
+        return sorted(released)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+def source_needs_processing(path: str, root_dir: str) -> bool:
+    """Checks one file against the source manifest, like discovery does for a full scan"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    manifest = get_source_manifest()
+    status, update = classify_source(path, stat, manifest.get(path), root_dir)
+    if update is not None:
+        manifest.upsert_many([update])
+    return status != "unchanged"
+
+def watch_and_process():
+    """
+    Long-running mode: watches FOLDERS_TO_PROCESS and summarizes documents as
+    they arrive. Changed files are debounced, checked against the manifest and
+    added to the job queue, which MAX_CONCURRENT_DOCUMENTS worker threads drain
+    (other --worker processes can help). The Ollama client (and its pooled
+    connections) lives for the whole session, and the model is kept loaded
+    while idle. On SIGTERM or Ctrl+C no new jobs are started and documents in
+    progress are finished before exiting; queued ones stay in the job queue.
+    A second signal stops immediately.
+    """
+    root_dir = os.getcwd()
+    roots = get_scan_roots(root_dir, FOLDERS_TO_PROCESS)
+    job_queue = get_job_queue()
+    owner = job_owner_id()
+    stop = threading.Event()
+    started = time.time()
+    last_activity = [time.monotonic()]
+
+    def request_stop(signum, frame):
+        print(f"\nReceived {signal.Signals(signum).name}; finishing documents in progress (signal again to stop now)...")
+        stop.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def on_result(result: FileResult):
+        print(f"[{result.status.upper()}] {result.file_path} ({result.elapsed_seconds:.1f}s)")
+        last_activity[0] = time.monotonic()
+
+    watcher = create_watcher(roots)
+    previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+    workers = max(1, MAX_CONCURRENT_DOCUMENTS)
+    router = DocumentLogRouter(sys.stdout) if workers > 1 else None
+    original_stdout = sys.stdout
+    if router:
+        sys.stdout = router
+    leases = LeaseKeeper(job_queue, owner).start()
+    docs = DocsServiceLoader()
+    threads = [
+        threading.Thread(target=run_job_worker, args=(job_queue, owner, stop, docs, router, False, on_result),
+                         name=f"watch-doc-{i}", daemon=True)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    debouncer = FileDebouncer(WATCH_DEBOUNCE_SECONDS)
+    pool = get_endpoint_pool()
+    next_rescan = 0.0
+    last_warm_up = 0.0
+    print(f"Watching {len(roots)} folder(s) with {watcher.name}; press Ctrl+C or send SIGTERM to stop.")
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            if now >= next_rescan or watcher.overflowed:
+                watcher.overflowed = False
+                for path in discover_files_to_process(root_dir, FOLDERS_TO_PROCESS):
+                    debouncer.observe(path)
+                next_rescan = now + WATCH_RESCAN_INTERVAL
+
+            for path in watcher.changes(timeout=1.0):
+                debouncer.observe(path)
+            ready = [path for path in debouncer.ready() if source_needs_processing(path, root_dir)]
+            if ready and job_queue.enqueue_many(ready):
+                for path in ready:
+                    print(f"Queued: {path}")
+                last_activity[0] = time.monotonic()
+
+            if time.monotonic() - max(last_warm_up, last_activity[0]) >= WATCH_KEEP_WARM_INTERVAL:
+                pool.warm_up()
+                last_warm_up = time.monotonic()
+
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        job_queue.release(owner)
+        raise
+    finally:
+        stop.set()
+        watcher.close()
+        leases.stop()
+        sys.stdout = original_stdout
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+
+    results = job_queue.results_since(started)
+    if results:
+        print_processing_report(results)
+    print("Watch mode stopped.")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Summarize TXT, PDF and Google Doc files with a local LLM.")
+    parser.add_argument("--clear-text-cache", action="store_true",
+                        help="delete the cached extracted text and exit")
+    parser.add_argument("--clear-qa-cache", action="store_true",
+                        help="delete the stored question indexes (see --ask) and exit")
+    parser.add_argument("--clean-summaries", action="store_true",
+                        help="sanitize existing summaries not yet recorded as clean (for migrations) and exit")
+    parser.add_argument("--search", metavar="QUERY",
+                        help='search the summaries (words, or "exact phrases") and exit')
+    parser.add_argument("--reindex-summaries", action="store_true",
+                        help="add summaries changed or written outside the pipeline to the search index and exit")
+    parser.add_argument("--ask", nargs=2, metavar=("FILE", "QUESTION"),
+                        help="answer a question about one document from its most relevant passages and exit")
+    parser.add_argument("--trace", action="store_true",
+                        help="record per-stage timings and token counts (see TRACE_ENABLED)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and summarize documents as they appear in FOLDERS_TO_PROCESS")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="worker processes draining the job queue (see JOB_WORKER_PROCESSES)")
+    parser.add_argument("--worker", action="store_true",
+                        help="only help drain the existing job queue (e.g. next to a running --watch), then exit")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="queue documents that failed JOB_MAX_ATTEMPTS times again even if unchanged")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    global TRACE_ENABLED, JOB_WORKER_PROCESSES
+    args = parse_args(argv)
+    if args.trace:
+        TRACE_ENABLED = True
+    if args.workers:
+        JOB_WORKER_PROCESSES = args.workers
+    if args.clear_text_cache:
+        clear_text_cache()
+        return
+    if args.clear_qa_cache:
+        clear_qa_cache()
+        return
+    if args.clean_summaries:
+        clean_ai_summaries()
+        return
+    if args.reindex_summaries:
+        reindex_summaries()
+        return
+    if args.search:
+        search_summaries(args.search)
+        return
 
-def main():
     print("Document Summarization System - Text, PDF, and Google Doc Processing")
     print(f"Server: {BASE_URL}")
+    if OLLAMA_ENDPOINTS:
+        print(f"Additional endpoints: {OLLAMA_ENDPOINTS}")
     print(f"Model: {MODEL_NAME}")
     print(f"AI Summaries Directory: {AI_SUMMARIES_DIR}")
     print("Supported file types: TXT, PDF, GDOC")
@@ -1128,23 +5780,42 @@ def main():
         print("\nProcessing all folders (no specific folders configured).")
     
     print("\nTesting server connection...")
-    models = get_available_models(BASE_URL)
-    if not models:
-        print("Cannot connect to server or no models found.")
-        return
-    
-    if MODEL_NAME not in models:
-        print(f"Warning: Model '{MODEL_NAME}' not found on server.")
-        print(f"Available models: {models}")
-        return
+    pool = get_endpoint_pool()
+    if len(pool) > 1:
+        pool.check_health()
+        healthy = sum(1 for endpoint in pool.endpoints if endpoint.healthy)
+        print(f"{healthy} of {len(pool)} endpoint(s) ready for {MODEL_NAME}.")
+        if not healthy:
+            print("No endpoint is reachable with the model available.")
+            return
+    else:
+        models = get_available_models(BASE_URL)
+        if not models:
+            print("Cannot connect to server or no models found.")
+            return
+
+        if MODEL_NAME not in models:
+            print(f"Warning: Model '{MODEL_NAME}' not found on server.")
+            print(f"Available models: {models}")
+            return
     
     print("Server connection successful.")
+
+    if args.ask:
+        ask_document(*args.ask)
+        return
+
+    if args.worker:
+        ensure_ai_summaries_dir()
+        drain_job_queue(get_job_queue())
+        return
+
+    if args.watch:
+        watch_and_process()
+        return
     
     # Process files by discovering them directly
-    process_discovered_files()
-
-    # Clean the newly created summaries after processing is complete
-    clean_ai_summaries()
+    process_discovered_files(retry_failed=args.retry_failed)
     
     print("\nAll operations complete!")
 
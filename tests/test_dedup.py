@@ -0,0 +1,182 @@
+import dataclasses
+import random
+
+import numpy as np
+import pytest
+
+import construct_ai as ca
+
+
+def make_text(seed: int, paragraphs: int = 40) -> str:
+    rng = random.Random(seed)
+    words = [f"w{n}" for n in range(2000)]
+    sentences = []
+    for p in range(paragraphs):
+        paragraph = " ".join(
+            " ".join(rng.choice(words) for _ in range(rng.randint(12, 25))).capitalize() + "."
+            for _ in range(8)
+        )
+        sentences.append(paragraph)
+    return "\n\n".join(sentences)
+
+
+def jaccard(a: str, b: str) -> float:
+    sa, sb = set(ca.shingle_hashes(a).tolist()), set(ca.shingle_hashes(b).tolist())
+    return len(sa & sb) / len(sa | sb)
+
+
+def edit_words(text: str, count: int, seed: int = 1) -> str:
+    rng = random.Random(seed)
+    words = text.split(" ")
+    for i in rng.sample(range(len(words)), count):
+        words[i] = f"changed{i}"
+    return " ".join(words)
+
+
+def run_steps(steps, reply="revised"):
+    """Drives a pipeline generator, answering every request with reply; returns (result, requests)"""
+    requests = []
+    result = None
+    while True:
+        try:
+            request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value, requests
+        requests.append(request)
+        result = [reply] * len(request) if isinstance(request, list) else reply
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(ca, "CACHE_DIR", str(tmp_path))
+    return ca.DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+
+
+def test_minhash_estimates_jaccard():
+    base = make_text(1)
+    assert ca.minhash_similarity(ca.minhash_signature(ca.shingle_hashes(base)),
+                                 ca.minhash_signature(ca.shingle_hashes(base))) == 1.0
+    for count in (20, 200, 600):
+        edited = edit_words(base, count)
+        estimate = ca.minhash_similarity(ca.minhash_signature(ca.shingle_hashes(base)),
+                                         ca.minhash_signature(ca.shingle_hashes(edited)))
+        assert abs(estimate - jaccard(base, edited)) < 0.15
+
+
+def test_unrelated_documents_are_dissimilar():
+    a, b = make_text(1), make_text(2)
+    estimate = ca.minhash_similarity(ca.minhash_signature(ca.shingle_hashes(a)),
+                                     ca.minhash_signature(ca.shingle_hashes(b)))
+    assert estimate < 0.1
+
+
+def test_band_bucketing_finds_near_duplicates_only():
+    base = make_text(1)
+    bands = ca.minhash_bands(ca.minhash_signature(ca.shingle_hashes(base)))
+    assert len(bands) == ca.MINHASH_BANDS
+
+    near = edit_words(base, 40)
+    assert jaccard(base, near) >= ca.NEAR_DUPLICATE_THRESHOLD
+    near_bands = ca.minhash_bands(ca.minhash_signature(ca.shingle_hashes(near)))
+    assert any(x == y for x, y in zip(bands, near_bands))
+
+    other_bands = ca.minhash_bands(ca.minhash_signature(ca.shingle_hashes(make_text(2))))
+    assert not any(x == y for x, y in zip(bands, other_bands))
+
+
+def test_band_keys_depend_on_band_position():
+    signature = np.full(ca.MINHASH_PERMUTATIONS, 7, dtype=np.uint64)
+    bands = ca.minhash_bands(signature)
+    assert len(set(bands)) == len(bands)
+
+
+def test_content_defined_blocks_are_local():
+    base = make_text(1)
+    blocks = ca.content_defined_blocks(base)
+    assert "".join(block.text for block in blocks) == base
+    middle = len(base) // 2
+    edited = base[:middle] + " Inserted sentence here." + base[middle:]
+    before = {ca.text_digest(block.text) for block in blocks}
+    after = [ca.text_digest(block.text) for block in ca.content_defined_blocks(edited)]
+    assert sum(1 for digest in after if digest not in before) <= 2
+
+
+def test_only_identical_text_reuses_summary(index):
+    config = ca.get_strategy_config(20000)
+    base = make_text(1)
+    index.record_document(ca.DocumentFingerprint.of(base), "v1.pdf", "summary of v1")
+
+    summary, requests = run_steps(ca.near_duplicate_steps(index, ca.DocumentFingerprint.of(base), config, 20000))
+    assert summary == "summary of v1" and requests == []
+
+    # A revision that only changes a few figures is still revised, never reused as is
+    revised = base.replace(base.split(" ")[100], "42.7", 1)
+    fingerprint = ca.DocumentFingerprint.of(revised)
+    assert index.find_document(fingerprint).similarity > 0.95
+    summary, requests = run_steps(ca.near_duplicate_steps(index, fingerprint, config, 20000))
+    assert summary == "revised"
+    assert len(requests) == 1
+    prompt = requests[0].prompt
+    assert "PASSAGES REMOVED FROM THE EARLIER VERSION" in prompt
+    assert "NEW OR CHANGED PASSAGES" in prompt and "42.7" in prompt
+
+
+def test_removed_passages_are_shown(index):
+    config = ca.get_strategy_config(20000)
+    base = make_text(1)
+    paragraphs = base.split("\n\n")
+    shortened = "\n\n".join(paragraphs[:20] + paragraphs[22:])
+    index.record_document(ca.DocumentFingerprint.of(base), "v1.pdf", "summary of v1")
+
+    summary, requests = run_steps(ca.near_duplicate_steps(index, ca.DocumentFingerprint.of(shortened), config, 20000))
+    assert summary == "revised"
+    prompt = requests[0].prompt
+    assert "PASSAGES REMOVED FROM THE EARLIER VERSION" in prompt
+    assert paragraphs[20][:60] in prompt
+
+
+def test_unrelated_document_is_summarized_from_scratch(index):
+    config = ca.get_strategy_config(20000)
+    index.record_document(ca.DocumentFingerprint.of(make_text(1)), "a.pdf", "summary of a")
+    summary, requests = run_steps(
+        ca.near_duplicate_steps(index, ca.DocumentFingerprint.of(make_text(2)), config, 20000))
+    assert summary is None and requests == []
+
+
+def test_chunk_reuse_requires_exact_text_and_prompt(index):
+    prompt = ca.text_digest("outline A")
+    index.record_chunk(ca.text_digest("chunk text."), prompt, "chunk summary")
+    assert index.find_chunk(ca.text_digest("chunk text."), prompt) == "chunk summary"
+    assert index.find_chunk(ca.text_digest("chunk text!"), prompt) is None
+    assert index.find_chunk(ca.text_digest("chunk text."), ca.text_digest("outline B")) is None
+
+
+def test_chunk_summaries_are_evicted(index, monkeypatch):
+    monkeypatch.setattr(ca, "CHUNK_SUMMARY_MAX_ENTRIES", 3)
+    prompt = ca.text_digest("outline")
+    for n in range(5):
+        index.record_chunk(ca.text_digest(f"chunk {n}"), prompt, f"summary {n}")
+    count = index._connection().execute("SELECT COUNT(*) FROM chunk_partials").fetchone()[0]
+    assert count == 3
+    assert index.find_chunk(ca.text_digest("chunk 0"), prompt) is None
+    assert index.find_chunk(ca.text_digest("chunk 4"), prompt) == "summary 4"
+
+
+def test_large_edit_is_split_into_chunk_sized_calls(index):
+    base = make_text(1, paragraphs=300)
+    paragraphs = base.split("\n\n")
+    rewritten = make_text(3, paragraphs=60).split("\n\n")
+    edited = "\n\n".join(paragraphs[:100] + rewritten + paragraphs[160:])
+    token_count = ca.count_tokens(edited)
+    config = dataclasses.replace(ca.get_strategy_config(token_count), chunk_size=3000)
+    index.record_document(ca.DocumentFingerprint.of(base), "v1.pdf", "summary of v1")
+
+    summary, requests = run_steps(ca.near_duplicate_steps(index, ca.DocumentFingerprint.of(edited), config, token_count))
+    assert summary == "revised"
+    assert len(requests) > 1
+    for request in requests:
+        passages = request.prompt.split("\n\n", 1)[1]
+        assert ca.count_tokens(passages) <= config.chunk_size + 50
+        # The old text of the edit is always shown next to its replacement
+        assert "PASSAGES REMOVED FROM THE EARLIER VERSION" in request.prompt
+        assert "NEW OR CHANGED PASSAGES" in request.prompt
@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+import construct_ai as ca
+
+
+def write_source(directory, name: str, size: int) -> str:
+    path = str(directory / name)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("x" * size)
+    return path
+
+
+def touch_changed(path: str):
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(" more text")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def failed(path: str) -> ca.FileResult:
+    return ca.FileResult(path, "failed", "boom", 0.0)
+
+
+def succeeded(path: str) -> ca.FileResult:
+    return ca.FileResult(path, "success", "", 0.0)
+
+
+def job_row(queue: ca.JobQueue, path: str):
+    return queue._connection().execute(
+        "SELECT state, attempts, dirty FROM jobs WHERE path = ?", (path,)).fetchone()
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(ca, "JOB_RETRY_BASE_SECONDS", 0.0)
+    return ca.JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_claims_shortest_job_first(queue, tmp_path):
+    large = write_source(tmp_path, "large.txt", 40000)
+    small = write_source(tmp_path, "small.txt", 400)
+    medium = write_source(tmp_path, "medium.txt", 4000)
+    assert queue.enqueue_many([large, small, medium]) == 3
+
+    claimed = [queue.claim("owner", "worker").path for _ in range(3)]
+    assert claimed == [small, medium, large]
+    assert queue.claim("owner", "worker") is None
+
+
+def test_failed_job_is_retried_until_attempts_run_out(queue, tmp_path):
+    path = write_source(tmp_path, "doc.txt", 400)
+    queue.enqueue_many([path])
+    for attempt in range(1, ca.JOB_MAX_ATTEMPTS + 1):
+        job = queue.claim("owner", "worker")
+        assert job is not None and job.attempt == attempt
+        state, _ = queue.complete(job, "owner", failed(path))
+        assert state == ("failed" if attempt == ca.JOB_MAX_ATTEMPTS else "pending")
+    assert queue.claim("owner", "worker") is None
+    assert job_row(queue, path)[:2] == ("failed", ca.JOB_MAX_ATTEMPTS)
+
+
+def test_expired_lease_is_reclaimed(queue, tmp_path, monkeypatch):
+    path = write_source(tmp_path, "doc.txt", 400)
+    queue.enqueue_many([path])
+    monkeypatch.setattr(ca, "JOB_LEASE_SECONDS", -1.0)
+    lost = queue.claim("dead-owner", "worker")
+
+    monkeypatch.setattr(ca, "JOB_LEASE_SECONDS", 120.0)
+    job = queue.claim("owner", "worker")
+    assert job is not None and job.path == path and job.attempt == 2
+    statuses = [row[0] for row in queue._connection().execute(
+        "SELECT status FROM attempts WHERE path = ? ORDER BY id", (path,))]
+    assert statuses == ["lost", None]
+
+    # The stale worker finishing late does not overwrite the new attempt
+    assert queue.complete(lost, "dead-owner", succeeded(path)) == ("lost", 0.0)
+    assert queue.complete(job, "owner", succeeded(path))[0] == "done"
+
+
+def test_source_changed_while_running_is_requeued(queue, tmp_path):
+    path = write_source(tmp_path, "doc.txt", 400)
+    queue.enqueue_many([path])
+    job = queue.claim("owner", "worker")
+
+    touch_changed(path)
+    assert queue.enqueue_many([path]) == 0
+    assert job_row(queue, path) == ("running", 1, 1)
+
+    assert queue.complete(job, "owner", succeeded(path)) == ("requeued", 0.0)
+    assert job_row(queue, path) == ("pending", 0, 0)
+    assert queue.claim("owner", "worker").path == path
+
+
+def test_enqueue_leaves_pending_and_unchanged_running_jobs_alone(queue, tmp_path):
+    pending = write_source(tmp_path, "pending.txt", 4000)
+    running = write_source(tmp_path, "running.txt", 400)
+    queue.enqueue_many([pending, running])
+    job = queue.claim("owner", "worker")
+    assert job.path == running
+
+    assert queue.enqueue_many([pending, running]) == 0
+    assert job_row(queue, pending) == ("pending", 0, 0)
+    assert job_row(queue, running) == ("running", 1, 0)
+    assert queue.complete(job, "owner", succeeded(running))[0] == "done"
+
+    # A finished job is queued again
+    assert queue.enqueue_many([running]) == 1
+    assert job_row(queue, running) == ("pending", 0, 0)
+
+
+def test_release_does_not_count_the_attempt(queue, tmp_path):
+    path = write_source(tmp_path, "doc.txt", 400)
+    queue.enqueue_many([path])
+    queue.claim("owner", "worker")
+    queue.release("owner")
+    assert job_row(queue, path) == ("pending", 0, 0)
+    assert queue.claim("owner", "worker").attempt == 1